@@ -0,0 +1,53 @@
+"""Процессный LRU-кэш с ограничением времени жизни записей."""
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional
+
+from app import metrics
+
+class TTLCache:
+    """
+    Ограниченный по размеру LRU-кэш, записи которого устаревают через ttl секунд.
+
+    Попадания и промахи считаются в app.metrics как "<name>.hits" / "<name>.misses".
+    """
+
+    def __init__(self, name: str, max_size: int = 10000, ttl: float = 300.0):
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl
+        self._items: "OrderedDict[Hashable, tuple]" = OrderedDict()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        item = self._items.get(key)
+        if item is not None:
+            expires_at, value = item
+            if expires_at > time.monotonic():
+                self._items.move_to_end(key)
+                metrics.inc(f"{self.name}.hits")
+                return value
+            del self._items[key]
+        metrics.inc(f"{self.name}.misses")
+        return None
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        self._items[key] = (time.monotonic() + (ttl or self.ttl), value)
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    def delete(self, key: Hashable) -> None:
+        self._items.pop(key, None)
+
+    def clear(self) -> None:
+        self._items.clear()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "size": len(self._items),
+            "hits": metrics.get(f"{self.name}.hits"),
+            "misses": metrics.get(f"{self.name}.misses"),
+        }
@@ -0,0 +1,57 @@
+"""
+Разовая компактизация: переписывает несжатые тексты планов в сжатом формате.
+
+Запуск: python -m app.compact_plans [--batch-size 500]
+"""
+import argparse
+import asyncio
+import logging
+
+from sqlalchemy import Integer, Text, column, select, table, update
+
+from app.compression import compress_text, is_compressed, PLAN_COMPRESSION
+from app.db import engine, init_db
+
+# Сырое представление таблицы: тексты читаются без распаковки CompressedText
+plans_raw = table("plans", column("id", Integer), column("body", Text))
+
+async def compact_plans(batch_size: int = 500) -> int:
+    """Сжимает планы пачками по возрастанию id. Возвращает число переписанных строк."""
+    last_id = 0
+    rewritten = 0
+    while True:
+        async with engine.begin() as conn:
+            rows = (await conn.execute(
+                select(plans_raw.c.id, plans_raw.c.body)
+                .where(plans_raw.c.id > last_id)
+                .order_by(plans_raw.c.id)
+                .limit(batch_size)
+            )).all()
+            if not rows:
+                break
+            for plan_id, body in rows:
+                if body is None or is_compressed(body):
+                    continue
+                compressed = compress_text(body)
+                if compressed != body:
+                    await conn.execute(
+                        update(plans_raw).where(plans_raw.c.id == plan_id).values(body=compressed)
+                    )
+                    rewritten += 1
+            last_id = rows[-1].id
+        logging.info(f"Compacted plans up to id {last_id}, rewritten {rewritten}")
+    return rewritten
+
+async def main():
+    parser = argparse.ArgumentParser(description="Сжатие сохраненных планов")
+    parser.add_argument("--batch-size", type=int, default=500)
+    args = parser.parse_args()
+
+    await init_db()
+    rewritten = await compact_plans(args.batch_size)
+    logging.info(f"Done: {rewritten} plans rewritten with {PLAN_COMPRESSION}")
+    await engine.dispose()
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(name)s - %(message)s')
+    asyncio.run(main())
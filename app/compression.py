@@ -0,0 +1,73 @@
+"""Прозрачное сжатие больших текстов (планов) для хранения в БД."""
+import base64
+import logging
+import os
+import zlib
+
+from sqlalchemy.types import Text, TypeDecorator
+
+try:
+    import zstandard
+except ImportError:  # zstd необязателен, по умолчанию используется zlib
+    zstandard = None
+
+# Алгоритм для новых записей: zlib, zstd или none
+PLAN_COMPRESSION = os.getenv("PLAN_COMPRESSION", "zlib")
+# Тексты короче этого порога хранятся как есть
+COMPRESSION_MIN_LENGTH = int(os.getenv("COMPRESSION_MIN_LENGTH", "256"))
+
+# Маркеры формата. Символ \x01 не встречается в Markdown, поэтому
+# старые несжатые строки однозначно отличаются от сжатых.
+ZLIB_MARKER = "\x01zlib:"
+ZSTD_MARKER = "\x01zstd:"
+
+if PLAN_COMPRESSION == "zstd" and zstandard is None:
+    logging.warning("PLAN_COMPRESSION=zstd, но пакет zstandard не установлен. Используется zlib.")
+    PLAN_COMPRESSION = "zlib"
+
+def is_compressed(value: str) -> bool:
+    return value.startswith(ZLIB_MARKER) or value.startswith(ZSTD_MARKER)
+
+def compress_text(value: str, algorithm: str = PLAN_COMPRESSION) -> str:
+    """
+    Сжимает текст и возвращает строку с маркером формата.
+
+    Если сжатие выключено, текст короткий или сжатие не дало выигрыша,
+    возвращает исходный текст.
+    """
+    if algorithm == "none" or len(value) < COMPRESSION_MIN_LENGTH or is_compressed(value):
+        return value
+    raw = value.encode("utf-8")
+    if algorithm == "zstd":
+        marker, packed = ZSTD_MARKER, zstandard.ZstdCompressor(level=10).compress(raw)
+    else:
+        marker, packed = ZLIB_MARKER, zlib.compress(raw, 9)
+    encoded = marker + base64.b64encode(packed).decode("ascii")
+    # Сравниваем в байтах: кириллица в UTF-8 занимает 2 байта на символ
+    return encoded if len(encoded) < len(raw) else value
+
+def decompress_text(value: str) -> str:
+    """Распаковывает строку, сохраненную compress_text; несжатые строки возвращает как есть."""
+    if value.startswith(ZLIB_MARKER):
+        return zlib.decompress(base64.b64decode(value[len(ZLIB_MARKER):])).decode("utf-8")
+    if value.startswith(ZSTD_MARKER):
+        if zstandard is None:
+            raise RuntimeError("Для чтения zstd-записей нужен пакет zstandard")
+        packed = base64.b64decode(value[len(ZSTD_MARKER):])
+        return zstandard.ZstdDecompressor().decompress(packed).decode("utf-8")
+    return value
+
+class CompressedText(TypeDecorator):
+    """Текстовая колонка, которая сжимается при записи и распаковывается при чтении."""
+    impl = Text
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return compress_text(value)
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return decompress_text(value)
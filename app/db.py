@@ -1,22 +1,41 @@
+import asyncio
 import logging
+from collections import OrderedDict
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.orm import declarative_base, sessionmaker
-from sqlalchemy import Column, String, JSON, select, insert, update
+from sqlalchemy import Column, String, JSON, DateTime, select, insert, update, delete, tuple_, cast, func, literal, inspect, text
 from sqlalchemy.ext.asyncio import AsyncEngine
+from aiogram.fsm.state import State
 from aiogram.fsm.storage.base import BaseStorage, StorageKey, StateType
 from sqlalchemy.exc import SQLAlchemyError
-from typing import Dict, Any, Optional, List, Set
+from typing import Dict, Any, Optional, List, Set, Callable, Awaitable
 import json
 import os
 from app.config import DATABASE_URL
-from app.models import Base
+from app.db_profile import DatabaseProfile
+from app.models import Base, User
 
-# Создаем движок для SQLite
-engine = create_async_engine(
-    DATABASE_URL,
-    echo=True,  # Логируем SQL запросы
-    future=True
-)
+# Режим хранилища FSM: "sql" - каждый вызов идет в БД, "cached" - write-behind кэш
+FSM_STORAGE = os.getenv("FSM_STORAGE", "sql")
+# Максимальное число ключей (chat_id, user_id) в памяти
+FSM_CACHE_SIZE = int(os.getenv("FSM_CACHE_SIZE", "10000"))
+# Окно долговечности: как часто (в секундах) грязные записи сбрасываются в БД
+FSM_FLUSH_INTERVAL = float(os.getenv("FSM_FLUSH_INTERVAL", "2.0"))
+# Через сколько дней без изменений запись fsm_states считается брошенной
+FSM_STATE_TTL_DAYS = float(os.getenv("FSM_STATE_TTL_DAYS", "30"))
+# Как часто запускать очистку (секунды) и сколько строк удалять за одну транзакцию
+FSM_SWEEP_INTERVAL = float(os.getenv("FSM_SWEEP_INTERVAL", "3600"))
+FSM_SWEEP_BATCH_SIZE = int(os.getenv("FSM_SWEEP_BATCH_SIZE", "1000"))
+# Режим очистки: delete - удалять, archive - переносить в fsm_states_archive
+FSM_SWEEP_MODE = os.getenv("FSM_SWEEP_MODE", "delete")
+
+# Создаем движок с настройками из профиля производительности (DB_PROFILE, DB_*)
+db_profile = DatabaseProfile.from_env()
+engine = create_async_engine(DATABASE_URL, **db_profile.engine_kwargs(DATABASE_URL))
+db_profile.apply(engine)
 
 # Создаем фабрику сессий
 async_session_factory = sessionmaker(
@@ -33,17 +52,299 @@ class FSMState(Base):
     user_id = Column(String, primary_key=True)
     state = Column(String, nullable=True)
     data = Column(JSON, nullable=True)
+    # Время последней записи (UTC) - по нему очищаются брошенные состояния
+    updated_at = Column(DateTime, nullable=True, index=True,
+                        default=datetime.utcnow, onupdate=datetime.utcnow)
     
     def __repr__(self):
         return f"<FSMState(chat_id={self.chat_id}, user_id={self.user_id})>"
 
+# Архив очищенных состояний (FSM_SWEEP_MODE=archive)
+class FSMStateArchive(Base):
+    __tablename__ = "fsm_states_archive"
+
+    chat_id = Column(String, primary_key=True)
+    user_id = Column(String, primary_key=True)
+    state = Column(String, nullable=True)
+    data = Column(JSON, nullable=True)
+    updated_at = Column(DateTime, nullable=True)
+    archived_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+# --- UPSERT ---
+def upsert_insert(model):
+    """
+    Возвращает INSERT для модели с поддержкой ON CONFLICT DO UPDATE.
+
+    Поддерживаются PostgreSQL и SQLite; для остальных диалектов возвращает None,
+    и вызывающий код откатывается к SELECT + изменение ORM-объекта.
+    """
+    dialect = engine.dialect.name
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert as pg_insert
+        return pg_insert(model)
+    if dialect == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+        return sqlite_insert(model)
+    return None
+
+def json_merge_expression(column, data: Dict[str, Any]):
+    """
+    SQL-выражение, которое сливает data в JSON-колонку на стороне сервера
+    (аналог dict.update). None, если диалект этого не умеет или ключи
+    нельзя выразить путем JSON - тогда вызывающий код сливает в Python.
+    """
+    dialect = engine.dialect.name
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import JSONB
+        current = func.coalesce(cast(column, JSONB), cast("{}", JSONB), type_=JSONB)
+        return cast(current.op("||")(cast(json.dumps(data), JSONB)), JSON)
+    if dialect == "sqlite":
+        # В пути '$."ключ"' кавычку внутри ключа не экранировать
+        if any('"' in name for name in data):
+            return None
+        # json_set, а не json_patch: json_patch удаляет ключи со значением null
+        args = []
+        for name, value in data.items():
+            args.append(literal('$."' + name + '"'))
+            args.append(func.json(literal(json.dumps(value))))
+        return func.json_set(func.coalesce(column, "{}"), *args, type_=JSON)
+    return None
+
+async def write_fsm_rows(session: AsyncSession, rows: Dict[tuple, tuple]) -> None:
+    """
+    Записывает пачку состояний FSM {(chat_id, user_id): (state, data)} в сессию.
+
+    На PostgreSQL и SQLite - одна многострочная инструкция UPSERT.
+    Коммит остается за вызывающим кодом.
+    """
+    stmt = upsert_insert(FSMState)
+    if stmt is not None:
+        now = datetime.utcnow()
+        stmt = stmt.values([
+            {"chat_id": chat_id, "user_id": user_id, "state": state,
+             "data": data, "updated_at": now}
+            for (chat_id, user_id), (state, data) in rows.items()
+        ])
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[FSMState.chat_id, FSMState.user_id],
+            set_={"state": stmt.excluded.state, "data": stmt.excluded.data,
+                  "updated_at": stmt.excluded.updated_at}
+        )
+        await session.execute(stmt)
+        return
+
+    result = await session.execute(
+        select(FSMState).where(
+            tuple_(FSMState.chat_id, FSMState.user_id).in_(list(rows))
+        )
+    )
+    existing = {(row.chat_id, row.user_id): row for row in result.scalars()}
+    for (chat_id, user_id), (state, data) in rows.items():
+        row = existing.get((chat_id, user_id))
+        if row:
+            row.state = state
+            row.data = data
+        else:
+            session.add(FSMState(chat_id=chat_id, user_id=user_id, state=state, data=data))
+
+async def upsert_user(session: AsyncSession, telegram_id: int, data: Dict[str, Any]) -> None:
+    """
+    Создает или обновляет пользователя одной инструкцией UPSERT.
+
+    Ключи, которых нет среди колонок users, игнорируются.
+    Коммит остается за вызывающим кодом.
+    """
+    values = {k: v for k, v in data.items() if k in User.__table__.columns}
+    stmt = upsert_insert(User)
+    if stmt is not None:
+        stmt = stmt.values(telegram_id=telegram_id, **values)
+        if values:
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[User.telegram_id],
+                set_={k: stmt.excluded[k] for k in values}
+            )
+        else:
+            stmt = stmt.on_conflict_do_nothing(index_elements=[User.telegram_id])
+        await session.execute(stmt)
+        return
+
+    user = await session.get(User, telegram_id)
+    if user:
+        for key, value in values.items():
+            setattr(user, key, value)
+    else:
+        session.add(User(telegram_id=telegram_id, **values))
+
+# --- Unit of Work ---
+@dataclass
+class _CacheEntry:
+    state: Optional[str] = None
+    data: Dict[str, Any] = field(default_factory=dict)
+    dirty: bool = False
+    # Что именно изменено (UnitOfWork пишет в БД только это, а не снимок целиком)
+    state_changed: bool = False
+    data_replaced: bool = False
+    changed_keys: Set[str] = field(default_factory=set)
+
+    def mark_clean(self) -> None:
+        self.dirty = self.state_changed = self.data_replaced = False
+        self.changed_keys.clear()
+
+# Единица работы текущего апдейта (выставляется UnitOfWorkMiddleware)
+current_uow: ContextVar[Optional["UnitOfWork"]] = ContextVar("current_uow", default=None)
+
+class UnitOfWork:
+    """
+    Единица работы на один апдейт Telegram.
+
+    Держит одну сессию, снимок FSM и отложенные изменения пользователей.
+    Все изменения FSMState и User записываются одной транзакцией в commit().
+    Соединение с БД занято только на время чтения снимка и самого commit(),
+    поэтому долгие обработчики (генерация планов) не держат пул.
+    """
+
+    def __init__(self):
+        self.session = async_session_factory()
+        self.fsm: Dict[tuple, _CacheEntry] = {}
+        self.users: Dict[int, Dict[str, Any]] = {}
+        self._after_commit: List[Callable[[], Awaitable[None]]] = []
+
+    async def fsm_entry(self, key: StorageKey) -> _CacheEntry:
+        cache_key = (str(key.chat_id), str(key.user_id))
+        entry = self.fsm.get(cache_key)
+        if entry is None:
+            result = await self.session.execute(
+                select(FSMState.state, FSMState.data).where(
+                    FSMState.chat_id == cache_key[0],
+                    FSMState.user_id == cache_key[1]
+                )
+            )
+            row = result.one_or_none()
+            # Снимок прочитан - возвращаем соединение в пул до commit()
+            await self.session.rollback()
+            entry = _CacheEntry(row.state, dict(row.data or {})) if row else _CacheEntry()
+            self.fsm[cache_key] = entry
+        return entry
+
+    async def set_fsm_state(self, key: StorageKey, state: Optional[str]) -> None:
+        entry = await self.fsm_entry(key)
+        entry.state = state
+        entry.dirty = entry.state_changed = True
+
+    async def set_fsm_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        entry = await self.fsm_entry(key)
+        entry.data = dict(data)
+        entry.dirty = entry.data_replaced = True
+
+    async def update_fsm_data(self, key: StorageKey, data: Dict[str, Any]) -> Dict[str, Any]:
+        entry = await self.fsm_entry(key)
+        entry.data.update(data)
+        entry.changed_keys.update(data)
+        entry.dirty = True
+        return dict(entry.data)
+
+    def stage_user(self, telegram_id: int, data: Dict[str, Any]) -> None:
+        """Откладывает сохранение данных пользователя до commit()."""
+        self.users.setdefault(telegram_id, {}).update(data)
+
+    def after_commit(self, callback: Callable[[], Awaitable[None]]) -> None:
+        """Регистрирует корутину, которая выполнится после успешного commit()."""
+        self._after_commit.append(callback)
+
+    async def _write_fsm(self, dirty: Dict[tuple, _CacheEntry]) -> None:
+        """
+        Записывает только измененное: состояние - если его меняли, данные -
+        целиком после set_data или слиянием измененных ключей после update_data.
+        Так параллельный апдейт того же пользователя не теряет свои ключи.
+        """
+        if upsert_insert(FSMState) is None:
+            # Диалект без ON CONFLICT - строки целиком
+            await write_fsm_rows(self.session, {k: (e.state, dict(e.data)) for k, e in dirty.items()})
+            return
+        now = datetime.utcnow()
+        for (chat_id, user_id), entry in dirty.items():
+            set_ = {"updated_at": now}
+            if entry.state_changed:
+                set_["state"] = entry.state
+            if entry.data_replaced:
+                set_["data"] = dict(entry.data)
+            elif entry.changed_keys:
+                changed = {name: entry.data[name] for name in entry.changed_keys}
+                merged = json_merge_expression(FSMState.data, changed)
+                set_["data"] = merged if merged is not None else dict(entry.data)
+            stmt = upsert_insert(FSMState).values(
+                chat_id=chat_id, user_id=user_id, state=entry.state,
+                data=dict(entry.data), updated_at=now
+            ).on_conflict_do_update(
+                index_elements=[FSMState.chat_id, FSMState.user_id], set_=set_
+            )
+            await self.session.execute(stmt)
+
+    async def commit(self) -> None:
+        """
+        Фиксирует изменения. Может вызываться и раньше конца апдейта
+        (save_onboarding_data); при ошибке транзакция откатывается,
+        изменения остаются отложенными, а исключение пробрасывается.
+        """
+        dirty = {k: e for k, e in self.fsm.items() if e.dirty}
+        if not dirty and not self.users and not self._after_commit:
+            return
+        try:
+            for telegram_id, data in self.users.items():
+                await upsert_user(self.session, telegram_id, data)
+            if dirty:
+                await self._write_fsm(dirty)
+            await self.session.commit()
+        except Exception:
+            await self.session.rollback()
+            raise
+        for entry in dirty.values():
+            entry.mark_clean()
+        self.users.clear()
+        callbacks, self._after_commit = self._after_commit, []
+        for callback in callbacks:
+            await callback()
+
+    async def close(self) -> None:
+        await self.session.close()
+
 # Класс хранилища для FSM на базе SQLAlchemy
 class SQLAlchemyStorage(BaseStorage):
     def __init__(self, engine):
         self.engine = engine
-    
+
+    async def _upsert(self, key: StorageKey, insert_values: Dict[str, Any],
+                      update_values: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Одна инструкция INSERT ... ON CONFLICT DO UPDATE для ключа FSM."""
+        now = datetime.utcnow()
+        stmt = upsert_insert(FSMState).values(
+            chat_id=str(key.chat_id),
+            user_id=str(key.user_id),
+            updated_at=now,
+            **insert_values
+        ).on_conflict_do_update(
+            index_elements=[FSMState.chat_id, FSMState.user_id],
+            set_={**update_values, "updated_at": now}
+        )
+        returning = self.engine.dialect.insert_returning
+        if returning:
+            stmt = stmt.returning(FSMState.data)
+        async with async_session_factory() as session:
+            result = await session.execute(stmt)
+            data = result.scalar_one() if returning else None
+            await session.commit()
+            return data
+
     async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        state = state.state if isinstance(state, State) else state
         try:
+            uow = current_uow.get()
+            if uow is not None:
+                await uow.set_fsm_state(key, state)
+                return
+            if upsert_insert(FSMState) is not None:
+                await self._upsert(key, {"state": state, "data": {}}, {"state": state})
+                return
             async with async_session_factory() as session:
                 result = await session.execute(
                     select(FSMState).where(
@@ -54,12 +355,12 @@ class SQLAlchemyStorage(BaseStorage):
                 state_row = result.scalar_one_or_none()
                 
                 if state_row:
-                    state_row.state = state.state if state else None
+                    state_row.state = state
                 else:
                     state_row = FSMState(
                         chat_id=str(key.chat_id),
                         user_id=str(key.user_id),
-                        state=state.state if state else None,
+                        state=state,
                         data={}
                     )
                     session.add(state_row)
@@ -70,6 +371,9 @@ class SQLAlchemyStorage(BaseStorage):
             
     async def get_state(self, key: StorageKey) -> Optional[str]:
         try:
+            uow = current_uow.get()
+            if uow is not None:
+                return (await uow.fsm_entry(key)).state
             async with async_session_factory() as session:
                 result = await session.execute(
                     select(FSMState.state).where(
@@ -85,6 +389,13 @@ class SQLAlchemyStorage(BaseStorage):
             
     async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
         try:
+            uow = current_uow.get()
+            if uow is not None:
+                await uow.set_fsm_data(key, data)
+                return
+            if upsert_insert(FSMState) is not None:
+                await self._upsert(key, {"data": data}, {"data": data})
+                return
             async with async_session_factory() as session:
                 result = await session.execute(
                     select(FSMState).where(
@@ -110,6 +421,9 @@ class SQLAlchemyStorage(BaseStorage):
             
     async def get_data(self, key: StorageKey) -> Dict[str, Any]:
         try:
+            uow = current_uow.get()
+            if uow is not None:
+                return dict((await uow.fsm_entry(key)).data)
             async with async_session_factory() as session:
                 result = await session.execute(
                     select(FSMState.data).where(
@@ -125,6 +439,16 @@ class SQLAlchemyStorage(BaseStorage):
             
     async def update_data(self, key: StorageKey, data: Dict[str, Any]) -> Dict[str, Any]:
         try:
+            uow = current_uow.get()
+            if uow is not None:
+                return await uow.update_fsm_data(key, data)
+            merged = json_merge_expression(FSMState.data, data)
+            if merged is not None:
+                result = await self._upsert(key, {"data": data}, {"data": merged})
+                if result is None:
+                    # Диалект без RETURNING - дочитываем результат отдельно
+                    result = await self.get_data(key)
+                return result or {}
             async with async_session_factory() as session:
                 result = await session.execute(
                     select(FSMState).where(
@@ -135,7 +459,7 @@ class SQLAlchemyStorage(BaseStorage):
                 state_row = result.scalar_one_or_none()
                 
                 if state_row:
-                    current_data = state_row.data or {}
+                    current_data = dict(state_row.data or {})
                     current_data.update(data)
                     state_row.data = current_data
                 else:
@@ -154,9 +478,305 @@ class SQLAlchemyStorage(BaseStorage):
             
     async def close(self) -> None:
         pass
-        
+
+# Кэширующее хранилище FSM с отложенной записью (write-behind)
+class CachedSQLAlchemyStorage(SQLAlchemyStorage):
+    """
+    Хранит состояния FSM в ограниченном LRU-кэше и читает их из памяти.
+
+    Записи помечаются как "грязные" и сбрасываются в fsm_states пачками
+    по таймеру (не реже чем раз в flush_interval секунд) и при закрытии.
+    При сбое процесса могут потеряться изменения не старше flush_interval.
+    Кэш не согласован между процессами: только для одного процесса бота.
+    """
+
+    def __init__(self, engine, max_size: int = FSM_CACHE_SIZE,
+                 flush_interval: float = FSM_FLUSH_INTERVAL):
+        super().__init__(engine)
+        self.max_size = max_size
+        self.flush_interval = flush_interval
+        self._entries: "OrderedDict[tuple, _CacheEntry]" = OrderedDict()
+        # Вытесненные из LRU, но еще не записанные в БД записи
+        self._evicted: Dict[tuple, _CacheEntry] = {}
+        # Записи, которые прямо сейчас пишутся в БД
+        self._inflight: Dict[tuple, _CacheEntry] = {}
+        self._flush_lock = asyncio.Lock()
+        self._flush_task: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def _cache_key(key: StorageKey) -> tuple:
+        return (str(key.chat_id), str(key.user_id))
+
+    async def _get_entry(self, key: StorageKey) -> _CacheEntry:
+        cache_key = self._cache_key(key)
+        entry = self._entries.get(cache_key)
+        if entry is not None:
+            self._entries.move_to_end(cache_key)
+            return entry
+
+        entry = self._evicted.pop(cache_key, None) or self._inflight.get(cache_key)
+        if entry is None:
+            entry = _CacheEntry()
+            try:
+                async with async_session_factory() as session:
+                    result = await session.execute(
+                        select(FSMState.state, FSMState.data).where(
+                            FSMState.chat_id == cache_key[0],
+                            FSMState.user_id == cache_key[1]
+                        )
+                    )
+                    row = result.one_or_none()
+                    if row:
+                        entry.state = row.state
+                        entry.data = dict(row.data or {})
+            except Exception as e:
+                # Пустую запись не кэшируем: следующий сброс затер бы ею настоящую строку
+                logging.error(f"Error loading FSM entry {cache_key}: {e}")
+                raise
+
+        # Пока ждали БД, запись могла появиться от конкурентного вызова
+        existing = self._entries.get(cache_key)
+        if existing is not None:
+            return existing
+
+        self._entries[cache_key] = entry
+        while len(self._entries) > self.max_size:
+            old_key, old_entry = self._entries.popitem(last=False)
+            if old_entry.dirty:
+                self._evicted[old_key] = old_entry
+        return entry
+
+    def _mark_dirty(self, entry: _CacheEntry) -> None:
+        entry.dirty = True
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        entry = await self._get_entry(key)
+        entry.state = state.state if isinstance(state, State) else state
+        self._mark_dirty(entry)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        entry = await self._get_entry(key)
+        return entry.state
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        entry = await self._get_entry(key)
+        entry.data = dict(data)
+        self._mark_dirty(entry)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        entry = await self._get_entry(key)
+        return dict(entry.data)
+
+    async def update_data(self, key: StorageKey, data: Dict[str, Any]) -> Dict[str, Any]:
+        entry = await self._get_entry(key)
+        entry.data.update(data)
+        self._mark_dirty(entry)
+        return dict(entry.data)
+
+    async def _flush_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+            if not self._evicted and not any(e.dirty for e in self._entries.values()):
+                # Нечего писать - останавливаем таймер до следующей записи
+                return
+
+    async def flush(self) -> None:
+        """Записывает все грязные записи в БД одной транзакцией."""
+        async with self._flush_lock:
+            batch: Dict[tuple, _CacheEntry] = dict(self._evicted)
+            for cache_key, entry in self._entries.items():
+                if entry.dirty:
+                    batch[cache_key] = entry
+            if not batch:
+                return
+
+            # Снимок значений: записи могут меняться, пока идет запись в БД
+            snapshot = {k: (e.state, dict(e.data)) for k, e in batch.items()}
+            for entry in batch.values():
+                entry.dirty = False
+            self._inflight = batch
+
+            try:
+                async with async_session_factory() as session:
+                    await write_fsm_rows(session, snapshot)
+                    await session.commit()
+                for cache_key, entry in list(self._evicted.items()):
+                    if not entry.dirty:
+                        del self._evicted[cache_key]
+                logging.debug(f"Flushed {len(snapshot)} FSM entries")
+            except Exception as e:
+                logging.error(f"Error flushing FSM cache: {e}")
+                # Возвращаем записи в очередь на запись
+                for cache_key, entry in batch.items():
+                    entry.dirty = True
+                    if cache_key not in self._entries:
+                        self._evicted.setdefault(cache_key, entry)
+            finally:
+                self._inflight = {}
+
+    async def close(self) -> None:
+        if self._flush_task and not self._flush_task.done():
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+        await self.flush()
+
+# --- Очистка брошенных состояний FSM ---
+async def sweep_expired_fsm_states(max_age: timedelta = timedelta(days=FSM_STATE_TTL_DAYS),
+                                   batch_size: int = FSM_SWEEP_BATCH_SIZE,
+                                   mode: str = FSM_SWEEP_MODE) -> int:
+    """
+    Удаляет (или архивирует) записи fsm_states, не менявшиеся дольше max_age.
+
+    Работает пачками по batch_size строк, каждая пачка - отдельная короткая
+    транзакция, чтобы не держать блокировки на большой таблице.
+    В режиме archive удаление и запись в архив идут в одной транзакции.
+
+    Returns:
+        int: Количество очищенных записей
+    """
+    cutoff = datetime.utcnow() - max_age
+    total = 0
+    while True:
+        async with async_session_factory() as session:
+            result = await session.execute(
+                select(FSMState.chat_id, FSMState.user_id)
+                .where(FSMState.updated_at < cutoff)
+                .limit(batch_size)
+            )
+            keys = [tuple(row) for row in result]
+            if not keys:
+                break
+            in_batch = tuple_(FSMState.chat_id, FSMState.user_id).in_(keys)
+            # Повторная проверка cutoff: запись могла обновиться после SELECT
+            expired = delete(FSMState).where(in_batch, FSMState.updated_at < cutoff)
+            if mode == "archive":
+                # В архив попадают ровно удаленные строки (DELETE ... RETURNING):
+                # запись, обновленная между выборкой и удалением, не архивируется
+                rows = (await session.execute(
+                    expired.returning(FSMState.chat_id, FSMState.user_id, FSMState.state,
+                                      FSMState.data, FSMState.updated_at)
+                )).all()
+                if rows:
+                    # Повторно брошенный ключ заменяет старую запись архива
+                    await session.execute(
+                        delete(FSMStateArchive).where(
+                            tuple_(FSMStateArchive.chat_id, FSMStateArchive.user_id).in_(
+                                [(row.chat_id, row.user_id) for row in rows]
+                            )
+                        )
+                    )
+                    await session.execute(insert(FSMStateArchive), [row._asdict() for row in rows])
+            else:
+                await session.execute(expired)
+            await session.commit()
+        total += len(keys)
+        if len(keys) < batch_size:
+            break
+        await asyncio.sleep(0)  # Отдаем управление обработчикам апдейтов между пачками
+    return total
+
+async def run_fsm_sweeper(interval: float = FSM_SWEEP_INTERVAL) -> None:
+    """Фоновая задача: периодически очищает брошенные состояния FSM."""
+    while True:
+        try:
+            removed = await sweep_expired_fsm_states()
+            if removed:
+                logging.info(f"FSM sweeper: {FSM_SWEEP_MODE} {removed} expired rows")
+        except Exception as e:
+            logging.error(f"FSM sweeper error: {e}")
+        await asyncio.sleep(interval)
+
+def _add_missing_columns(sync_conn) -> List[str]:
+    """
+    Добавляет в существующие таблицы колонки и индексы, появившиеся в моделях.
+
+    create_all создает только отсутствующие таблицы, поэтому без этого
+    новые колонки не попали бы в уже развернутые базы.
+    """
+    inspector = inspect(sync_conn)
+    added = []
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing:
+                column_type = column.type.compile(dialect=sync_conn.dialect)
+                sync_conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"))
+                added.append(f"{table.name}.{column.name}")
+        for index in table.indexes:
+            index.create(sync_conn, checkfirst=True)
+    return added
+
+def _fail_duplicate_plan_jobs(sync_conn) -> int:
+    """
+    Перед созданием уникального индекса uq_plan_jobs_active: дубли активных
+    заданий (пользователь, вид), оставшиеся от старой проверки без индекса,
+    кроме самого раннего, помечаются failed - иначе индекс не создастся.
+    """
+    inspector = inspect(sync_conn)
+    if any(index["name"] == "uq_plan_jobs_active" for index in inspector.get_indexes("plan_jobs")):
+        return 0
+    result = sync_conn.execute(text(
+        "UPDATE plan_jobs SET status = 'failed', error = 'duplicate active job', locked_until = NULL "
+        "WHERE status IN ('pending', 'running') AND id NOT IN ("
+        "SELECT MIN(id) FROM plan_jobs WHERE status IN ('pending', 'running') "
+        "GROUP BY telegram_id, kind)"
+    ))
+    return result.rowcount
+
+def _migrate_legacy_plans(sync_conn) -> int:
+    """
+    Переносит планы из старых колонок users.workout_plan / users.meal_plan
+    в таблицу plans (версия 1) и очищает их, чтобы строка users оставалась узкой.
+    """
+    columns = {column["name"] for column in inspect(sync_conn).get_columns("users")}
+    moved = 0
+    for kind, column in (("workout", "workout_plan"), ("meal", "meal_plan")):
+        if column not in columns:
+            continue
+        pending = sync_conn.execute(
+            text(f"SELECT 1 FROM users WHERE {column} IS NOT NULL LIMIT 1")
+        ).first()
+        if not pending:
+            continue
+        result = sync_conn.execute(
+            text(
+                f"INSERT INTO plans (telegram_id, kind, version, created_at, body) "
+                f"SELECT telegram_id, :kind, 1, :now, {column} FROM users "
+                f"WHERE {column} IS NOT NULL AND NOT EXISTS ("
+                f"SELECT 1 FROM plans WHERE plans.telegram_id = users.telegram_id "
+                f"AND plans.kind = :kind)"
+            ),
+            {"kind": kind, "now": datetime.utcnow()}
+        )
+        moved += result.rowcount
+        sync_conn.execute(text(f"UPDATE users SET {column} = NULL WHERE {column} IS NOT NULL"))
+    return moved
+
 # Функция для создания таблиц
 async def init_db():
+    logging.info(f"Database profile: {db_profile.describe(engine.dialect.name)}")
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+        duplicates = await conn.run_sync(_fail_duplicate_plan_jobs)
+        if duplicates:
+            logging.warning(f"Marked {duplicates} duplicate active plan jobs as failed")
+        added = await conn.run_sync(_add_missing_columns)
+        if added:
+            logging.info(f"Added columns: {', '.join(added)}")
+        if "fsm_states.updated_at" in added:
+            # Старые записи получают отсчет TTL с момента миграции
+            await conn.execute(
+                update(FSMState).where(FSMState.updated_at.is_(None)).values(updated_at=datetime.utcnow())
+            )
+        moved = await conn.run_sync(_migrate_legacy_plans)
+        if moved:
+            logging.info(f"Moved {moved} legacy plans from users to plans")
     logging.info("Database initialized")
@@ -0,0 +1,102 @@
+"""Профиль производительности движка БД (пул, логирование SQL, PRAGMA SQLite)."""
+import os
+from dataclasses import dataclass, asdict
+from typing import Any, Dict
+
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+# Базовые наборы настроек; любое значение можно переопределить переменной окружения
+PROFILES: Dict[str, Dict[str, Any]] = {
+    "production": {"echo": False, "pool_size": 10, "max_overflow": 20},
+    "debug": {"echo": True, "pool_size": 2, "max_overflow": 0},
+}
+
+def _env(name: str, default, cast=str):
+    value = os.getenv(name)
+    if value is None or value == "":
+        return default
+    if cast is bool:
+        return value.lower() in ("1", "true", "yes", "on")
+    return cast(value)
+
+@dataclass
+class DatabaseProfile:
+    name: str = "production"
+    echo: bool = False
+    pool_size: int = 10
+    max_overflow: int = 20
+    pool_timeout: float = 30.0
+    pool_pre_ping: bool = True
+    pool_recycle: int = 1800  # секунд; меньше idle-таймаутов PgBouncer/балансировщиков
+    # Кэш подготовленных выражений адаптера asyncpg (0 - выключить, нужно для PgBouncer)
+    statement_cache_size: int = 100
+    # PRAGMA для SQLite
+    sqlite_journal_mode: str = "WAL"
+    sqlite_synchronous: str = "NORMAL"
+    sqlite_busy_timeout: int = 5000  # мс
+
+    @classmethod
+    def from_env(cls) -> "DatabaseProfile":
+        """Собирает профиль: пресет DB_PROFILE + переопределения из DB_* переменных."""
+        name = os.getenv("DB_PROFILE", "production")
+        base = {**asdict(cls()), **PROFILES.get(name, {}), "name": name}
+        return cls(
+            name=name,
+            echo=_env("DB_ECHO", base["echo"], bool),
+            pool_size=_env("DB_POOL_SIZE", base["pool_size"], int),
+            max_overflow=_env("DB_MAX_OVERFLOW", base["max_overflow"], int),
+            pool_timeout=_env("DB_POOL_TIMEOUT", base["pool_timeout"], float),
+            pool_pre_ping=_env("DB_POOL_PRE_PING", base["pool_pre_ping"], bool),
+            pool_recycle=_env("DB_POOL_RECYCLE", base["pool_recycle"], int),
+            statement_cache_size=_env("DB_STATEMENT_CACHE_SIZE", base["statement_cache_size"], int),
+            sqlite_journal_mode=_env("SQLITE_JOURNAL_MODE", base["sqlite_journal_mode"]),
+            sqlite_synchronous=_env("SQLITE_SYNCHRONOUS", base["sqlite_synchronous"]),
+            sqlite_busy_timeout=_env("SQLITE_BUSY_TIMEOUT", base["sqlite_busy_timeout"], int),
+        )
+
+    def engine_kwargs(self, url: str) -> Dict[str, Any]:
+        """Аргументы create_async_engine для диалекта из url."""
+        parsed = make_url(url)
+        kwargs: Dict[str, Any] = {"echo": self.echo, "future": True}
+        if parsed.get_backend_name() == "sqlite":
+            if parsed.database in (None, "", ":memory:"):
+                # База в памяти живет в единственном соединении - пул не настраиваем
+                return kwargs
+            # По умолчанию aiosqlite открывает новое соединение на каждую сессию
+            kwargs["poolclass"] = AsyncAdaptedQueuePool
+        kwargs.update(
+            pool_size=self.pool_size,
+            max_overflow=self.max_overflow,
+            pool_timeout=self.pool_timeout,
+            pool_pre_ping=self.pool_pre_ping,
+            pool_recycle=self.pool_recycle,
+        )
+        if parsed.get_driver_name() == "asyncpg":
+            kwargs["connect_args"] = {"prepared_statement_cache_size": self.statement_cache_size}
+        return kwargs
+
+    def apply(self, async_engine) -> None:
+        """Навешивает PRAGMA на каждое новое соединение SQLite."""
+        if async_engine.dialect.name != "sqlite":
+            return
+
+        @event.listens_for(async_engine.sync_engine, "connect")
+        def _set_sqlite_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            cursor.execute(f"PRAGMA journal_mode={self.sqlite_journal_mode}")
+            cursor.execute(f"PRAGMA synchronous={self.sqlite_synchronous}")
+            cursor.execute(f"PRAGMA busy_timeout={self.sqlite_busy_timeout}")
+            cursor.close()
+
+    def describe(self, dialect: str) -> str:
+        """Строка для лога при старте."""
+        if dialect == "sqlite":
+            details = (f"journal_mode={self.sqlite_journal_mode}, synchronous={self.sqlite_synchronous}, "
+                       f"busy_timeout={self.sqlite_busy_timeout}ms, pool_size={self.pool_size}")
+        else:
+            details = (f"pool_size={self.pool_size}, max_overflow={self.max_overflow}, "
+                       f"pre_ping={self.pool_pre_ping}, recycle={self.pool_recycle}s, "
+                       f"statement_cache_size={self.statement_cache_size}")
+        return f"{self.name} ({dialect}): echo={self.echo}, {details}"
@@ -4,14 +4,13 @@ from aiogram.types import Message, CallbackQuery, ReplyKeyboardRemove
 from aiogram.fsm.context import FSMContext
 from aiogram.filters import Command, StateFilter
 from aiogram.fsm.state import default_state
-from sqlalchemy import select
 
 # Import necessary functions/data (e.g., for fetching user profile)
 # from app.db import get_user_profile_dict # Renamed hypothetical function
 from app.handlers.onboarding import cmd_onboard, get_user_profile_dict # To reuse onboarding logic for /update
 from app.ui_elements import format_message, format_profile
 from app.models import User
-from app.db import async_session_factory
+from app.profile_cache import get_cached_user
 from app.keyboards import goal_keyboard, next_step_kb
 from app.states import OnboardingStates
 
@@ -218,13 +217,9 @@ async def handle_unknown_callback(callback: CallbackQuery):
         pass # Ignore if deletion fails (e.g., message too old)
 
 async def get_user_from_db(telegram_id: int) -> User | None:
-    """Получает пользователя из базы данных по telegram_id."""
+    """Получает пользователя по telegram_id (через кэш профилей)."""
     try:
-        async with async_session_factory() as session:
-            result = await session.execute(
-                select(User).where(User.telegram_id == telegram_id)
-            )
-            return result.scalar_one_or_none()
+        return await get_cached_user(telegram_id)
     except Exception as e:
         logging.error(f"Error getting user {telegram_id}: {e}")
         return None
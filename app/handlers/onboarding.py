@@ -3,65 +3,49 @@ from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.types import Message, CallbackQuery
 import logging
-from sqlalchemy import select
 from sqlalchemy.exc import SQLAlchemyError
 
 from app.states import OnboardingStates
 from app.keyboards import (goal_keyboard, experience_keyboard, gender_keyboard,
                          injuries_keyboard, location_keyboard, next_step_kb)
 from app.ui_elements import format_message, format_onboarding_complete
-from app.models import User
-from app.db import async_session_factory
+from app.db import async_session_factory, current_uow, upsert_user
+from app.profile_cache import profile_cache, get_cached_user
 
 onboarding_router = Router()
 
 # --- Utility Functions ---
 async def save_onboarding_data(user_id: int, data: dict):
     """Сохраняет данные онбординга в БД."""
+    uow = current_uow.get()
     try:
-        async with async_session_factory() as session:
-            # Проверяем, существует ли пользователь
-            result = await session.execute(
-                select(User).where(User.telegram_id == user_id)
-            )
-            user = result.scalar_one_or_none()
-            
-            if user:
-                # Обновляем существующего пользователя
-                for key, value in data.items():
-                    if hasattr(user, key):
-                        setattr(user, key, value)
-            else:
-                # Создаем нового пользователя
-                user = User(telegram_id=user_id, **data)
-                session.add(user)
-            
-            await session.commit()
-            logging.info(f"User data saved for {user_id}: {data}")
-            return True
+        if uow is not None:
+            # Коммит единицы работы сразу, а не после обработчика: об успехе
+            # сообщаем только после записи, и чтения профиля в этом апдейте ее видят
+            uow.stage_user(user_id, data)
+            uow.after_commit(lambda: profile_cache.invalidate(user_id))
+            await uow.commit()
+        else:
+            async with async_session_factory() as session:
+                await upsert_user(session, user_id, data)
+                await session.commit()
+            await profile_cache.invalidate(user_id)
+        logging.info(f"User data saved for {user_id}: {data}")
+        return True
     except SQLAlchemyError as e:
         logging.error(f"Database error saving user {user_id}: {e}")
-        await session.rollback()
         return False
     except Exception as e:
         logging.error(f"Unexpected error saving user {user_id}: {e}", exc_info=True)
-        if 'session' in locals() and session:
-            await session.rollback()
         return False
 
 async def get_user_profile_dict(user_id: int):
     """Получает данные пользователя из БД в виде словаря."""
     try:
-        async with async_session_factory() as session:
-            result = await session.execute(
-                select(User).where(User.telegram_id == user_id)
-            )
-            user = result.scalar_one_or_none()
-            
-            if not user:
-                return None
-            
-            return user.to_dict()
+        user = await get_cached_user(user_id)
+        if not user:
+            return None
+        return user.to_dict()
     except Exception as e:
         logging.error(f"Error fetching profile for user {user_id}: {e}")
         return None
@@ -1,17 +1,17 @@
 import logging
+import os
 import random
-import asyncio
 from aiogram import Router, F
 from aiogram.types import Message, CallbackQuery
 from aiogram.fsm.context import FSMContext
-from sqlalchemy.exc import SQLAlchemyError
 from aiogram.filters import Command
 
-from app.models import User
-from app.db import async_session_factory
-from app.prompts import create_workout_prompt, create_meal_plan_prompt
-from app.llm_service import generate_with_gemini
-from app.keyboards import suggest_meal_plan_kb, suggest_workout_plan_kb, next_step_kb
+from app.plan_store import get_plan_page
+from app.plan_generation import (PLAN_FLOWS, deliver_plan, deliver_similar_plan, error_message,
+                                 render_plan_page)
+from app.jobs import enqueue_plan_job
+from app.singleflight import SingleFlight
+from app.keyboards import next_step_kb
 from app.config import bot
 
 from .common import get_user_from_db, safe_message_answer, safe_message_edit
@@ -19,25 +19,30 @@ from .common import get_user_from_db, safe_message_answer, safe_message_edit
 router = Router()
 print("✅ plans.py загружен")
 
-# Константы для сообщений загрузки
-GENERATING_WORKOUT_MSG = [
-    "⚡️ Генерирую твой персональный план тренировок...",
-    "💪 Создаю идеальную программу для твоих целей...",
-    "🔥 Подбираю оптимальные упражнения..."
-]
-GENERATING_MEAL_MSG = [
-    "🍏 Составляю твой план питания...",
-    "🥗 Создаю сбалансированное меню...",
-    "🍽 Готовлю персональные рекомендации..."
-]
+# inline - генерация в обработчике, queue - задание в plan_jobs для воркера (python -m app.worker)
+PLAN_GENERATION = os.getenv("PLAN_GENERATION", "inline")
+
+# Генерации в процессе по ключу (telegram_id, вид плана)
+plan_requests = SingleFlight("plan_requests")
 
 # --- Генерация планов --- #
 
-@router.callback_query(F.data == "create_workout")
-async def create_workout_plan_handler(callback: CallbackQuery):
+async def generate_plan_flow(callback: CallbackQuery, kind: str, reuse: bool = True):
+    """
+    Общий сценарий генерации плана: текст модели по мере готовности
+    выводится в сообщение загрузки, затем план сохраняется и
+    показывается целиком с разметкой. В режиме queue то же самое
+    делает воркер по заданию из plan_jobs.
+
+    При reuse=True сначала ищется готовый план похожего профиля и
+    показывается мгновенный план по шаблону (см. INSTANT_PLAN); reuse=False -
+    пользователь просит персональный план.
+    """
+    flow = PLAN_FLOWS[kind]
     telegram_id = callback.from_user.id
-    await callback.answer("Начинаю генерацию плана тренировок...")
-    loading_msg = await safe_message_answer(callback, random.choice(GENERATING_WORKOUT_MSG))
+    await callback.answer(flow["started"])
+    loading_text = random.choice(flow["loading"])
+    loading_msg = await safe_message_answer(callback, loading_text)
     await bot.send_chat_action(chat_id=telegram_id, action="typing")
 
     user = await get_user_from_db(telegram_id)
@@ -45,124 +50,110 @@ async def create_workout_plan_handler(callback: CallbackQuery):
         await safe_message_edit(loading_msg, "❌ Не удалось найти ваш профиль. Пожалуйста, пройдите онбординг сначала (/start).")
         return
 
-    try:
-        prompt = create_workout_prompt(user.to_dict())
-        generated_plan = await generate_with_gemini(prompt)
-
-        if not generated_plan:
-            raise ValueError("LLM returned empty workout plan")
+    if reuse and kind != "full" and await deliver_similar_plan(loading_msg, telegram_id, kind, user.to_dict()):
+        return
 
-        # Пытаемся сохранить план в БД
-        plan_saved = False
+    if PLAN_GENERATION == "queue":
+        # Бот только ставит задание; генерирует и правит loading_msg воркер
         try:
-            async with async_session_factory() as session:
-                user_to_update = await session.get(User, user.telegram_id)
-                if user_to_update:
-                    user_to_update.workout_plan = generated_plan
-                    await session.commit()
-                    logging.info(f"Workout plan saved for {telegram_id}")
-                    plan_saved = True
-                else:
-                    logging.error(f"User {telegram_id} not found in session for workout plan update.")
-        except SQLAlchemyError as e:
-            logging.error(f"DB error saving workout plan for {telegram_id}: {e}")
-        except Exception as e_inner:
-            logging.error(f"Unexpected error saving workout plan {telegram_id}: {e_inner}", exc_info=True)
-
-        result_text = f"🎉 *Твой План Тренировок Готов!* 🎉\n\n{generated_plan}"
-        if plan_saved:
-            result_text += "\n\n✅ *План сохранен в твоем профиле.*"
-        else:
-            result_text += "\n\n⚠️ *Не удалось сохранить план в профиле из-за ошибки. Скопируй его сейчас.*"
-
-        await safe_message_edit(loading_msg, result_text, parse_mode="Markdown")
-
-        await asyncio.sleep(1)
-        await safe_message_answer(
-            callback,
-            "✨ *Отличная работа!*\n\nХочешь теперь получить *план питания*? 👇",
-            reply_markup=suggest_meal_plan_kb,
-            parse_mode="Markdown"
-        )
+            job, created = await enqueue_plan_job(
+                telegram_id, kind, callback.message.chat.id,
+                message_id=loading_msg.message_id if loading_msg else None,
+                loading_text=loading_text
+            )
+            if not created:
+                # Задание уже в очереди (например, после нажатия в другом процессе бота)
+                await safe_message_edit(loading_msg, "⏳ Этот план уже генерируется, результат появится в сообщении выше.")
+        except Exception as e:
+            logging.error(f"Error queueing {kind} plan for {telegram_id}: {e}", exc_info=True)
+            await safe_message_edit(loading_msg, error_message(kind), parse_mode="Markdown")
+        return
 
+    try:
+        await deliver_plan(loading_msg, telegram_id, kind, user.to_dict(), loading_text, personal=not reuse)
     except Exception as e:
-        logging.error(f"Error generating/processing workout plan for {telegram_id}: {e}", exc_info=True)
-        error_message = "😔 *Упс! Что-то пошло не так...*\n\nНе удалось сгенерировать план тренировок. Попробуй позже!"
+        logging.error(f"Error generating/processing {kind} plan for {telegram_id}: {e}", exc_info=True)
         if loading_msg:
-            await safe_message_edit(loading_msg, error_message, parse_mode="Markdown")
+            await safe_message_edit(loading_msg, error_message(kind), parse_mode="Markdown")
         else:
-            await safe_message_answer(callback, error_message, parse_mode="Markdown")
+            await safe_message_answer(callback, error_message(kind), parse_mode="Markdown")
+
+async def start_plan_generation(callback: CallbackQuery, kind: str, reuse: bool = True):
+    """Запускает генерацию, если такой же план этого пользователя еще не генерируется."""
+    future, leader = plan_requests.start(
+        (callback.from_user.id, kind), lambda: generate_plan_flow(callback, kind, reuse)
+    )
+    if not leader:
+        # Повторное нажатие: подтверждаем, но вторую генерацию не запускаем
+        await callback.answer("⏳ Этот план уже генерируется, подожди немного!")
+        return
+    await future
+
+@router.callback_query(F.data == "create_workout")
+async def create_workout_plan_handler(callback: CallbackQuery):
+    await start_plan_generation(callback, "workout")
 
 @router.callback_query(F.data == "create_meal_plan")
 async def create_meal_plan_handler(callback: CallbackQuery):
-    telegram_id = callback.from_user.id
-    await callback.answer("Начинаю генерацию плана питания...")
-    loading_msg = await safe_message_answer(callback, random.choice(GENERATING_MEAL_MSG))
-    await bot.send_chat_action(chat_id=telegram_id, action="typing")
+    await start_plan_generation(callback, "meal")
 
-    user = await get_user_from_db(telegram_id)
-    if not user:
-        await safe_message_edit(loading_msg, "❌ Не удалось найти ваш профиль. Пожалуйста, пройдите онбординг сначала (/start).")
-        return
+# Полная программа: планы тренировок и питания одновременно
+@router.callback_query(F.data == "create_full_program")
+async def create_full_program_handler(callback: CallbackQuery):
+    await start_plan_generation(callback, "full")
 
-    try:
-        prompt = create_meal_plan_prompt(user.to_dict())
-        generated_plan = await generate_with_gemini(prompt)
+# Персональная генерация вместо показанного плана похожего профиля
+@router.callback_query(F.data == "refine_workout")
+async def refine_workout_plan_handler(callback: CallbackQuery):
+    await start_plan_generation(callback, "workout", reuse=False)
 
-        if not generated_plan:
-            raise ValueError("LLM returned empty meal plan")
-
-        plan_saved = False
-        try:
-            async with async_session_factory() as session:
-                user_to_update = await session.get(User, user.telegram_id)
-                if user_to_update:
-                    user_to_update.meal_plan = generated_plan
-                    await session.commit()
-                    logging.info(f"Meal plan saved for {telegram_id}")
-                    plan_saved = True
-                else:
-                    logging.error(f"User {telegram_id} not found in session for meal plan update.")
-        except SQLAlchemyError as e:
-            logging.error(f"DB error saving meal plan for {telegram_id}: {e}")
-        except Exception as e_inner:
-            logging.error(f"Unexpected error saving meal plan {telegram_id}: {e_inner}", exc_info=True)
-
-        result_text = f"🍏 *Твой План Питания Готов!* 🍏\n\n{generated_plan}"
-        if plan_saved:
-            result_text += "\n\n✅ *План сохранен в твоем профиле.*"
-        else:
-            result_text += "\n\n⚠️ *Не удалось сохранить план в профиле из-за ошибки. Скопируй его сейчас.*"
+@router.callback_query(F.data == "refine_meal_plan")
+async def refine_meal_plan_handler(callback: CallbackQuery):
+    await start_plan_generation(callback, "meal", reuse=False)
 
-        await safe_message_edit(loading_msg, result_text, parse_mode="Markdown")
+# --- Просмотр планов --- #
 
-        await asyncio.sleep(1)
-        await safe_message_answer(
-            callback,
-            "✨ *Отличная работа!*\n\nХочешь теперь получить *план тренировок*? 👇",
-            reply_markup=suggest_workout_plan_kb,
-            parse_mode="Markdown"
-        )
+async def edit_markdown(message: Message, text: str, **kwargs) -> bool:
+    """Правка с разметкой; если текст модели ломает Markdown - простым текстом."""
+    if await safe_message_edit(message, text, parse_mode="Markdown", **kwargs):
+        return True
+    return await safe_message_edit(message, text, **kwargs)
 
-    except Exception as e:
-        logging.error(f"Error generating/processing meal plan for {telegram_id}: {e}", exc_info=True)
-        error_message = "😔 *Упс! Что-то пошло не так...*\n\nНе удалось сгенерировать план питания. Попробуй позже!"
-        if loading_msg:
-            await safe_message_edit(loading_msg, error_message, parse_mode="Markdown")
-        else:
-            await safe_message_answer(callback, error_message, parse_mode="Markdown")
+# Страница структурированного плана: plan_page:<вид>:<версия>:<страница>
+@router.callback_query(F.data.startswith("plan_page:"))
+async def plan_page_handler(callback: CallbackQuery):
+    try:
+        _, kind, version, page = callback.data.split(":")
+        version, page = int(version), int(page)
+    except ValueError:
+        # Кнопка текущей страницы (plan_page:current)
+        await callback.answer()
+        return
 
-# --- Просмотр планов --- #
+    # План ищется по пользователю, нажавшему кнопку: чужой план не откроется
+    plan, day = await get_plan_page(callback.from_user.id, kind, page, version)
+    meta = (plan.meta or {}) if plan else {}
+    if meta.get("format") != "json" or not 0 <= page < meta["pages"]:
+        await callback.answer("Этот план больше недоступен 🤔", show_alert=True)
+        return
+    await callback.answer()
+    text, pages_kb = render_plan_page(kind, plan, day, page)
+    await edit_markdown(callback.message, text, reply_markup=pages_kb)
 
 @router.message(Command("myworkoutplan"))
 async def show_workout_plan_handler(message: Message, state: FSMContext):
     telegram_id = message.from_user.id
     loading_msg = await safe_message_answer(message, "🔍 Ищу твой план тренировок...")
     await bot.send_chat_action(chat_id=telegram_id, action="typing")
-    user = await get_user_from_db(telegram_id)
-
-    if user and user.workout_plan:
-        await safe_message_edit(loading_msg, f"*Твой Сохраненный План Тренировок:* 💪\n\n{user.workout_plan}", parse_mode="Markdown")
+    # Структурированный план показывается с первой страницы: читается только первый день
+    plan, day = await get_plan_page(telegram_id, "workout", 0)
+    user = None if plan else await get_user_from_db(telegram_id)
+
+    if plan and (plan.meta or {}).get("format") == "json":
+        text, pages_kb = render_plan_page("workout", plan, day, 0)
+        await edit_markdown(loading_msg, text, reply_markup=pages_kb)
+    elif plan:
+        await safe_message_edit(loading_msg, f"*Твой Сохраненный План Тренировок:* 💪\n\n{plan.body}", parse_mode="Markdown")
     elif user:
         await safe_message_edit(
             loading_msg,
@@ -181,10 +172,15 @@ async def show_meal_plan_handler(message: Message, state: FSMContext):
     telegram_id = message.from_user.id
     loading_msg = await safe_message_answer(message, "🔍 Ищу твой план питания...")
     await bot.send_chat_action(chat_id=telegram_id, action="typing")
-    user = await get_user_from_db(telegram_id)
-
-    if user and user.meal_plan:
-        await safe_message_edit(loading_msg, f"*Твой Сохраненный План Питания:* 🥗\n\n{user.meal_plan}", parse_mode="Markdown")
+    # Структурированный план показывается с первой страницы: читается только первый день
+    plan, day = await get_plan_page(telegram_id, "meal", 0)
+    user = None if plan else await get_user_from_db(telegram_id)
+
+    if plan and (plan.meta or {}).get("format") == "json":
+        text, pages_kb = render_plan_page("meal", plan, day, 0)
+        await edit_markdown(loading_msg, text, reply_markup=pages_kb)
+    elif plan:
+        await safe_message_edit(loading_msg, f"*Твой Сохраненный План Питания:* 🥗\n\n{plan.body}", parse_mode="Markdown")
     elif user:
         await safe_message_edit(
             loading_msg,
@@ -0,0 +1,170 @@
+"""Очередь заданий на генерацию планов в таблице plan_jobs."""
+import logging
+import os
+import uuid
+from datetime import datetime, timedelta
+from typing import Any, Dict, Optional, Tuple
+
+from sqlalchemy import and_, or_, select, update
+from sqlalchemy.exc import IntegrityError
+
+from app.db import async_session_factory, upsert_insert
+from app.models import PlanJob
+
+# Сколько раз пробовать задание, прежде чем пометить его failed
+PLAN_JOB_MAX_ATTEMPTS = int(os.getenv("PLAN_JOB_MAX_ATTEMPTS", "3"))
+# Аренда задания воркером, секунд. Пока задание выполняется, воркер продлевает
+# ее каждую треть срока; упавший воркер отдает задание другому через этот срок
+PLAN_JOB_LEASE = float(os.getenv("PLAN_JOB_LEASE", "60"))
+# Базовая задержка повтора после ошибки, секунд (удваивается с каждой попыткой)
+PLAN_JOB_RETRY_DELAY = float(os.getenv("PLAN_JOB_RETRY_DELAY", "10"))
+
+ACTIVE_STATUSES = ("pending", "running")
+
+async def enqueue_plan_job(telegram_id: int, kind: str, chat_id: int,
+                           message_id: Optional[int] = None,
+                           loading_text: Optional[str] = None) -> Tuple[Optional[PlanJob], bool]:
+    """
+    Ставит задание в очередь.
+
+    Если у пользователя уже есть активное задание того же вида, новое не
+    создается: это гарантирует уникальный индекс uq_plan_jobs_active,
+    поэтому два одновременных нажатия не создадут два задания.
+    Returns: (задание, created); задание None, если существовавшее уже успело завершиться.
+    """
+    values = {"telegram_id": telegram_id, "kind": kind, "chat_id": chat_id,
+              "message_id": message_id, "loading_text": loading_text}
+    async with async_session_factory() as session:
+        stmt = upsert_insert(PlanJob)
+        if stmt is not None:
+            now = datetime.utcnow()
+            job_id = (await session.execute(
+                stmt.values(**values, status="pending", attempts=0,
+                            created_at=now, updated_at=now, run_after=now)
+                .on_conflict_do_nothing(
+                    index_elements=[PlanJob.telegram_id, PlanJob.kind],
+                    index_where=PlanJob.status.in_(ACTIVE_STATUSES)
+                )
+                .returning(PlanJob.id)
+            )).scalar_one_or_none()
+            await session.commit()
+        else:
+            job = PlanJob(**values)
+            session.add(job)
+            try:
+                await session.commit()
+                job_id = job.id
+            except IntegrityError:
+                await session.rollback()
+                job_id = None
+        if job_id is not None:
+            logging.info(f"Plan job {job_id} queued: {kind} for {telegram_id}")
+            return await session.get(PlanJob, job_id), True
+        # Активное задание уже есть (возможно, только что создано параллельным вызовом)
+        existing = (await session.execute(
+            select(PlanJob).where(
+                PlanJob.telegram_id == telegram_id,
+                PlanJob.kind == kind,
+                PlanJob.status.in_(ACTIVE_STATUSES)
+            ).limit(1)
+        )).scalar_one_or_none()
+        return existing, False
+
+def _claimable(now: datetime, max_attempts: int):
+    return or_(
+        and_(PlanJob.status == "pending", PlanJob.run_after <= now),
+        # Воркер перестал продлевать аренду (extend_plan_job_lease) - скорее всего, упал.
+        # Попытки считаются при захвате, поэтому задание, роняющее воркер, не крутится вечно
+        and_(PlanJob.status == "running", PlanJob.locked_until < now,
+             PlanJob.attempts < max_attempts),
+    )
+
+def _owned(job: PlanJob):
+    """Задание все еще выполняется этим захватом (аренду не перехватил другой воркер)."""
+    return and_(PlanJob.id == job.id, PlanJob.status == "running", PlanJob.locked_by == job.locked_by)
+
+async def claim_plan_job(lease: float = PLAN_JOB_LEASE,
+                         max_attempts: int = PLAN_JOB_MAX_ATTEMPTS) -> Optional[PlanJob]:
+    """
+    Забирает следующее задание: pending -> running, attempts + 1, новый токен locked_by.
+
+    Захват - условный UPDATE по id с повторной проверкой статуса, поэтому
+    одно задание не достанется двум воркерам и без SELECT ... FOR UPDATE.
+    """
+    async with async_session_factory() as session:
+        now = datetime.utcnow()
+        # Брошенные задания без оставшихся попыток больше никто не возьмет
+        abandoned = await session.execute(
+            update(PlanJob)
+            .where(PlanJob.status == "running", PlanJob.locked_until < now,
+                   PlanJob.attempts >= max_attempts)
+            .values(status="failed", error="worker lease expired", locked_until=None,
+                    locked_by=None, updated_at=now)
+        )
+        await session.commit()
+        if abandoned.rowcount:
+            logging.warning(f"Plan jobs: {abandoned.rowcount} abandoned jobs marked failed")
+
+        for _ in range(5):
+            now = datetime.utcnow()
+            job_id = (await session.execute(
+                select(PlanJob.id).where(_claimable(now, max_attempts))
+                .order_by(PlanJob.run_after, PlanJob.id).limit(1)
+            )).scalar_one_or_none()
+            if job_id is None:
+                await session.rollback()
+                return None
+            result = await session.execute(
+                update(PlanJob)
+                .where(PlanJob.id == job_id, _claimable(now, max_attempts))
+                .values(status="running", attempts=PlanJob.attempts + 1,
+                        locked_until=now + timedelta(seconds=lease),
+                        locked_by=uuid.uuid4().hex, updated_at=now)
+            )
+            await session.commit()
+            if result.rowcount == 1:
+                return await session.get(PlanJob, job_id)
+            # Задание перехватил другой воркер - пробуем следующее
+        return None
+
+async def extend_plan_job_lease(job: PlanJob, lease: float = PLAN_JOB_LEASE) -> bool:
+    """Продлевает аренду задания. Returns: False, если аренду уже перехватили."""
+    now = datetime.utcnow()
+    async with async_session_factory() as session:
+        result = await session.execute(
+            update(PlanJob).where(_owned(job))
+            .values(locked_until=now + timedelta(seconds=lease), updated_at=now)
+        )
+        await session.commit()
+    return result.rowcount == 1
+
+async def complete_plan_job(job: PlanJob, result: Dict[str, Any]) -> bool:
+    """Returns: False, если задание уже не принадлежит этому захвату."""
+    async with async_session_factory() as session:
+        updated = await session.execute(
+            update(PlanJob).where(_owned(job))
+            .values(status="done", result=result, error=None, locked_until=None,
+                    locked_by=None, updated_at=datetime.utcnow())
+        )
+        await session.commit()
+    return updated.rowcount == 1
+
+async def fail_plan_job(job: PlanJob, error: str,
+                        max_attempts: int = PLAN_JOB_MAX_ATTEMPTS) -> bool:
+    """
+    Отмечает ошибку. Пока попытки не исчерпаны, задание возвращается в очередь
+    с экспоненциальной задержкой. Если задание уже не принадлежит этому
+    захвату, ничего не меняет. Returns: True, если задание окончательно failed.
+    """
+    now = datetime.utcnow()
+    final = job.attempts >= max_attempts
+    values = {"error": error[:2000], "locked_until": None, "locked_by": None, "updated_at": now}
+    if final:
+        values["status"] = "failed"
+    else:
+        values["status"] = "pending"
+        values["run_after"] = now + timedelta(seconds=PLAN_JOB_RETRY_DELAY * 2 ** (job.attempts - 1))
+    async with async_session_factory() as session:
+        updated = await session.execute(update(PlanJob).where(_owned(job)).values(**values))
+        await session.commit()
+    return final and updated.rowcount == 1
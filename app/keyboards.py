@@ -1,3 +1,5 @@
+from typing import Optional
+
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 
@@ -102,6 +104,7 @@ next_step_kb = InlineKeyboardMarkup(
     inline_keyboard=[
         [InlineKeyboardButton(text="💪 План тренировок", callback_data="create_workout")],
         [InlineKeyboardButton(text="🥗 План питания", callback_data="create_meal_plan")],
+        [InlineKeyboardButton(text="🚀 Полная программа (оба плана сразу)", callback_data="create_full_program")],
         [InlineKeyboardButton(text="✏️ Изменить ответы", callback_data="edit_profile")],
     ]
 )
@@ -120,4 +123,35 @@ suggest_workout_plan_kb = InlineKeyboardMarkup(
         [InlineKeyboardButton(text="💪 Да, план тренировок!", callback_data="create_workout")],
         [InlineKeyboardButton(text="❌ Нет, спасибо", callback_data="cancel")]
     ]
-)
\ No newline at end of file
+)
+# --- Клавиатуры для готового плана похожего профиля --- #
+
+refine_workout_plan_kb = InlineKeyboardMarkup(
+    inline_keyboard=[
+        [InlineKeyboardButton(text="✨ Составить персонально для меня", callback_data="refine_workout")]
+    ]
+)
+
+refine_meal_plan_kb = InlineKeyboardMarkup(
+    inline_keyboard=[
+        [InlineKeyboardButton(text="✨ Составить персонально для меня", callback_data="refine_meal_plan")]
+    ]
+)
+
+# --- Страницы структурированного плана --- #
+
+def plan_pages_kb(kind: str, version: int, page: int, days: int, pages: int,
+                  footer: Optional[InlineKeyboardMarkup] = None) -> InlineKeyboardMarkup:
+    """Кнопки страниц плана: номер дня или 🛒 (список покупок), текущая страница выделена."""
+    builder = InlineKeyboardBuilder()
+    for index in range(pages):
+        label = str(index + 1) if index < days else "🛒"
+        if index == page:
+            builder.button(text=f"· {label} ·", callback_data="plan_page:current")
+        else:
+            builder.button(text=label, callback_data=f"plan_page:{kind}:{version}:{index}")
+    builder.adjust(8)
+    if footer is not None:
+        for row in footer.inline_keyboard:
+            builder.row(*row)
+    return builder.as_markup()
@@ -0,0 +1,210 @@
+"""Кэш ответов LLM с точным совпадением по хэшу итогового промпта."""
+import asyncio
+import hashlib
+import logging
+import os
+from datetime import datetime, timedelta
+from typing import AsyncIterator, Awaitable, Callable, Optional
+
+from sqlalchemy import delete, select
+
+from app import metrics
+from app.cache import TTLCache
+from app.db import async_session_factory, upsert_insert
+from app.models import LLMCacheEntry
+from app.prompts import PROMPT_TEMPLATE_VERSION
+from app.singleflight import SingleFlight
+
+# Постоянный уровень: db (таблица llm_cache), redis, none (только память), off (кэш выключен)
+LLM_CACHE_BACKEND = os.getenv("LLM_CACHE_BACKEND", "db")
+LLM_CACHE_REDIS_URL = os.getenv("LLM_CACHE_REDIS_URL", os.getenv("REDIS_URL", "redis://localhost:6379/0"))
+LLM_CACHE_TTL = float(os.getenv("LLM_CACHE_TTL", str(7 * 24 * 3600)))  # секунд
+LLM_CACHE_SIZE = int(os.getenv("LLM_CACHE_SIZE", "1000"))
+# Период удаления просроченных записей из таблицы llm_cache, секунд
+LLM_CACHE_PURGE_INTERVAL = float(os.getenv("LLM_CACHE_PURGE_INTERVAL", "3600"))
+
+def cache_key(prompt: str, model: str, template_version: str = PROMPT_TEMPLATE_VERSION) -> str:
+    """Ключ кэша: sha256 от версии шаблона, модели и итогового промпта."""
+    digest = hashlib.sha256()
+    for part in (template_version, model, prompt):
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\x00")
+    return digest.hexdigest()
+
+class LLMResponseCache:
+    """
+    Двухуровневый кэш ответов: LRU в памяти процесса + постоянный уровень
+    (БД или Redis), общий для всех процессов и переживающий рестарт.
+
+    Счетчики в app.metrics: llm_cache.hits / llm_cache.misses (память),
+    llm_cache.persistent_hits, llm_cache.stores.
+    """
+
+    def __init__(self, backend: str = LLM_CACHE_BACKEND, ttl: float = LLM_CACHE_TTL,
+                 max_size: int = LLM_CACHE_SIZE, redis=None):
+        self.backend = backend
+        self.ttl = ttl
+        self.local = TTLCache("llm_cache", max_size=max_size, ttl=ttl)
+        self.redis = redis
+        if backend == "redis" and redis is None:
+            from redis.asyncio import Redis
+            self.redis = Redis.from_url(LLM_CACHE_REDIS_URL)
+
+    async def get(self, key: str) -> Optional[str]:
+        value = self.local.get(key)
+        if value is not None:
+            return value
+        try:
+            value = await self._get_persistent(key)
+        except Exception as e:
+            logging.warning(f"LLM cache read failed: {e}")
+            value = None
+        if value is not None:
+            metrics.inc("llm_cache.persistent_hits")
+            self.local.set(key, value)
+        return value
+
+    async def set(self, key: str, value: str, model: Optional[str] = None) -> None:
+        self.local.set(key, value)
+        metrics.inc("llm_cache.stores")
+        try:
+            await self._set_persistent(key, value, model)
+        except Exception as e:
+            logging.warning(f"LLM cache write failed: {e}")
+
+    async def _get_persistent(self, key: str) -> Optional[str]:
+        if self.backend == "db":
+            async with async_session_factory() as session:
+                result = await session.execute(
+                    select(LLMCacheEntry.response).where(
+                        LLMCacheEntry.key == key,
+                        LLMCacheEntry.expires_at > datetime.utcnow()
+                    )
+                )
+                return result.scalar_one_or_none()
+        if self.backend == "redis":
+            raw = await self.redis.get(f"llm:{key}")
+            return raw.decode("utf-8") if isinstance(raw, bytes) else raw
+        return None
+
+    async def _set_persistent(self, key: str, value: str, model: Optional[str]) -> None:
+        if self.backend == "db":
+            now = datetime.utcnow()
+            values = {"key": key, "model": model, "response": value,
+                      "created_at": now, "expires_at": now + timedelta(seconds=self.ttl)}
+            async with async_session_factory() as session:
+                stmt = upsert_insert(LLMCacheEntry)
+                if stmt is not None:
+                    stmt = stmt.values(**values)
+                    stmt = stmt.on_conflict_do_update(
+                        index_elements=[LLMCacheEntry.key],
+                        set_={k: stmt.excluded[k] for k in ("model", "response", "created_at", "expires_at")}
+                    )
+                    await session.execute(stmt)
+                else:
+                    await session.merge(LLMCacheEntry(**values))
+                await session.commit()
+        elif self.backend == "redis":
+            await self.redis.set(f"llm:{key}", value, ex=int(self.ttl))
+
+    async def purge_expired(self) -> int:
+        """Удаляет просроченные записи из таблицы llm_cache."""
+        if self.backend != "db":
+            return 0
+        async with async_session_factory() as session:
+            result = await session.execute(
+                delete(LLMCacheEntry).where(LLMCacheEntry.expires_at <= datetime.utcnow())
+            )
+            await session.commit()
+            return result.rowcount
+
+    def stats(self) -> dict:
+        stats = self.local.stats()
+        stats["persistent_hits"] = metrics.get("llm_cache.persistent_hits")
+        stats["stores"] = metrics.get("llm_cache.stores")
+        return stats
+
+llm_cache = LLMResponseCache()
+
+# Одинаковые промпты, которые генерируются одновременно, объединяются
+llm_requests = SingleFlight("llm_requests")
+
+async def cached_completion(prompt: str, model: str, generate: Callable[[], Awaitable[str]],
+                            key_prompt: Optional[str] = None) -> str:
+    """
+    Возвращает ответ из кэша или вызывает generate() и кэширует результат.
+
+    generate() должен выбрасывать исключение при ошибке: кэшируются только
+    успешные непустые ответы. Одновременные вызовы с тем же промптом
+    ждут один общий вызов generate(). key_prompt - текст для ключа кэша
+    вместо prompt (общий ответ для похожих промптов).
+    """
+    key = cache_key(key_prompt or prompt, model)
+
+    async def load() -> str:
+        if LLM_CACHE_BACKEND == "off":
+            return await generate()
+        cached = await llm_cache.get(key)
+        if cached is not None:
+            return cached
+        text = await generate()
+        if text:
+            await llm_cache.set(key, text, model)
+        return text
+
+    return await llm_requests.do(key, load)
+
+async def cached_stream(prompt: str, model: str,
+                        stream: Callable[[], AsyncIterator[str]],
+                        key_prompt: Optional[str] = None) -> AsyncIterator[str]:
+    """
+    Потоковый вариант cached_completion: при попадании отдает весь ответ
+    одним фрагментом, иначе транслирует фрагменты stream() и кэширует
+    собранный ответ после успешного завершения потока.
+
+    Если тот же промпт уже генерируется, второй поток не запускается:
+    ответ отдается одним фрагментом, когда первый поток завершится.
+    """
+    key = cache_key(key_prompt or prompt, model)
+    queue: asyncio.Queue = asyncio.Queue()
+
+    async def produce() -> str:
+        try:
+            if LLM_CACHE_BACKEND != "off":
+                cached = await llm_cache.get(key)
+                if cached is not None:
+                    queue.put_nowait(cached)
+                    return cached
+            parts = []
+            async for chunk in stream():
+                parts.append(chunk)
+                queue.put_nowait(chunk)
+            text = "".join(parts).strip()
+            if text and LLM_CACHE_BACKEND != "off":
+                await llm_cache.set(key, text, model)
+            return text
+        finally:
+            queue.put_nowait(None)
+
+    future, leader = llm_requests.start(key, produce)
+    if not leader:
+        yield await asyncio.shield(future)
+        return
+    while True:
+        chunk = await queue.get()
+        if chunk is None:
+            break
+        yield chunk
+    # Пробрасываем ошибку генерации, если она была
+    await asyncio.shield(future)
+
+async def run_llm_cache_purger(interval: float = LLM_CACHE_PURGE_INTERVAL) -> None:
+    """Фоновая задача: периодически удаляет просроченные записи кэша LLM."""
+    while True:
+        try:
+            removed = await llm_cache.purge_expired()
+            if removed:
+                logging.info(f"LLM cache purger: removed {removed} expired entries")
+        except Exception as e:
+            logging.error(f"LLM cache purger error: {e}")
+        await asyncio.sleep(interval)
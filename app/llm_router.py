@@ -0,0 +1,391 @@
+"""
+Маршрутизатор запросов между провайдерами LLM (Gemini, OpenAI).
+
+- статистика задержек и ошибок по каждому провайдеру;
+- хеджирование: если основной провайдер не ответил за p95 своей задержки,
+  тот же запрос параллельно уходит следующему, побеждает первый ответ;
+- переключение на следующий провайдер при 429, 5xx и сетевых ошибках,
+  а если не ответил никто - повтор всего маршрута (app.rate_limit.with_retry);
+- автомат отключения (circuit breaker): провайдер с серией ошибок
+  исключается из маршрута на время охлаждения.
+"""
+import asyncio
+import logging
+import os
+import time
+from abc import ABC, abstractmethod
+from collections import deque
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from app import metrics
+from app.llm_cache import cached_completion, cached_stream
+from app.llm_service import (GOOGLE_API_KEY, GEMINI_MODEL, LLMEmptyResponseError, gemini_provider,
+                             is_retryable, llm_service)
+from app.rate_limit import with_retry
+
+# Порядок провайдеров: первый - основной
+LLM_PROVIDERS = [name.strip() for name in os.getenv("LLM_PROVIDERS", "gemini,openai").split(",") if name.strip()]
+LLM_HEDGE_ENABLED = os.getenv("LLM_HEDGE_ENABLED", "1") == "1"
+LLM_HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE", "0.95"))
+# Задержка хеджа, пока статистики мало, и нижняя граница задержки, секунд
+LLM_HEDGE_DEFAULT_DELAY = float(os.getenv("LLM_HEDGE_DEFAULT_DELAY", "10"))
+LLM_HEDGE_MIN_DELAY = float(os.getenv("LLM_HEDGE_MIN_DELAY", "1"))
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20"))
+LLM_STATS_WINDOW = int(os.getenv("LLM_STATS_WINDOW", "200"))
+# Ошибок подряд до отключения провайдера и длительность отключения, секунд
+LLM_BREAKER_THRESHOLD = int(os.getenv("LLM_BREAKER_THRESHOLD", "5"))
+LLM_BREAKER_COOLDOWN = float(os.getenv("LLM_BREAKER_COOLDOWN", "30"))
+LLM_MAX_TOKENS = int(os.getenv("LLM_MAX_TOKENS", "2048"))
+
+class LLMUnavailableError(Exception):
+    """Ни один провайдер сейчас не может принять запрос."""
+
+def _should_retry(error: BaseException) -> bool:
+    # Все провайдеры отключены автоматом - повтор до конца охлаждения бесполезен
+    return is_retryable(error) and not isinstance(error, LLMUnavailableError)
+
+class LLMProvider(ABC):
+    """Провайдер для маршрутизатора: имя, модель и две операции, которые при ошибке выбрасывают исключение."""
+
+    name = "base"
+    model = ""
+
+    @property
+    def available(self) -> bool:
+        return True
+
+    @abstractmethod
+    async def generate(self, prompt: str) -> str:
+        ...
+
+    @abstractmethod
+    def stream(self, prompt: str) -> AsyncIterator[str]:
+        ...
+
+class GeminiRouteProvider(LLMProvider):
+    name = "gemini"
+    model = GEMINI_MODEL
+
+    @property
+    def available(self) -> bool:
+        return bool(GOOGLE_API_KEY)
+
+    async def generate(self, prompt: str) -> str:
+        return await gemini_provider.generate(prompt, self.model)
+
+    def stream(self, prompt: str) -> AsyncIterator[str]:
+        return gemini_provider.stream(prompt, self.model)
+
+class OpenAIRouteProvider(LLMProvider):
+    name = "openai"
+
+    def __init__(self, service=llm_service, max_tokens: int = LLM_MAX_TOKENS):
+        self.service = service
+        self.model = service.model
+        self.max_tokens = max_tokens
+
+    @property
+    def available(self) -> bool:
+        return bool(self.service.api_key)
+
+    async def generate(self, prompt: str) -> str:
+        return await self.service._complete(prompt, self.max_tokens)
+
+    def stream(self, prompt: str) -> AsyncIterator[str]:
+        return self.service._stream(prompt, self.max_tokens)
+
+class CircuitBreaker:
+    """
+    closed -> (threshold ошибок подряд) -> open -> (cooldown) -> half-open:
+    пропускается один пробный запрос; успех закрывает автомат, ошибка снова открывает.
+    """
+
+    def __init__(self, threshold: int = LLM_BREAKER_THRESHOLD, cooldown: float = LLM_BREAKER_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._trial = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.cooldown:
+            return "half-open"
+        return "open"
+
+    @property
+    def passable(self) -> bool:
+        """Пропустит ли автомат запрос сейчас (без захвата пробного запроса)."""
+        state = self.state
+        return state == "closed" or (state == "half-open" and not self._trial)
+
+    def allow(self) -> bool:
+        """Разрешение на запрос; в half-open занимает единственный пробный запрос."""
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half-open" and not self._trial:
+            self._trial = True
+            return True
+        return False
+
+    def release(self) -> None:
+        """Пробный запрос отменен или его результат не учтен - следующий запрос снова может быть пробным."""
+        self._trial = False
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+
+    def record_failure(self) -> bool:
+        """Возвращает True, если автомат только что открылся."""
+        self.failures += 1
+        if self._trial or (self.opened_at is None and self.failures >= self.threshold):
+            self.opened_at = time.monotonic()
+            self._trial = False
+            return True
+        return False
+
+class ProviderStats:
+    """Скользящее окно задержек (полный ответ и первый фрагмент потока) и счетчики ошибок."""
+
+    def __init__(self, window: int = LLM_STATS_WINDOW):
+        self.latencies: Dict[str, deque] = {"complete": deque(maxlen=window), "first_chunk": deque(maxlen=window)}
+        self.requests = 0
+        self.errors = 0
+
+    def record_success(self, kind: str, latency: float) -> None:
+        self.requests += 1
+        self.latencies[kind].append(latency)
+
+    def record_error(self) -> None:
+        self.requests += 1
+        self.errors += 1
+
+    def percentile(self, kind: str, q: float) -> Optional[float]:
+        samples = self.latencies[kind]
+        if not samples:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    @property
+    def error_rate(self) -> float:
+        return self.errors / self.requests if self.requests else 0.0
+
+class LLMRouter:
+    """
+    Отправляет запрос провайдерам по порядку с хеджированием и переключением.
+
+    Метрики app.metrics: llm_router.hedged, llm_router.hedge_wins,
+    llm_router.failovers, llm_router.breaker_opened,
+    llm.<provider>.errors, llm.<provider>.latency (count/sum/max).
+    """
+
+    def __init__(self, providers: List[LLMProvider], hedge: bool = LLM_HEDGE_ENABLED,
+                 hedge_percentile: float = LLM_HEDGE_PERCENTILE,
+                 hedge_default_delay: float = LLM_HEDGE_DEFAULT_DELAY,
+                 hedge_min_delay: float = LLM_HEDGE_MIN_DELAY,
+                 hedge_min_samples: int = LLM_HEDGE_MIN_SAMPLES,
+                 breaker_threshold: int = LLM_BREAKER_THRESHOLD,
+                 breaker_cooldown: float = LLM_BREAKER_COOLDOWN):
+        self.providers = providers
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.hedge_default_delay = hedge_default_delay
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_min_samples = hedge_min_samples
+        self.stats = {p.name: ProviderStats() for p in providers}
+        self.breakers = {p.name: CircuitBreaker(breaker_threshold, breaker_cooldown) for p in providers}
+        # Ключ кэша не зависит от того, какой провайдер ответил
+        self.cache_model = "router:" + ",".join(f"{p.name}/{p.model}" for p in providers)
+
+    def hedge_delay(self, provider: LLMProvider, kind: str) -> float:
+        """Через сколько секунд без ответа дублировать запрос следующему провайдеру."""
+        stats = self.stats[provider.name]
+        if len(stats.latencies[kind]) < self.hedge_min_samples:
+            return self.hedge_default_delay
+        return max(self.hedge_min_delay, stats.percentile(kind, self.hedge_percentile))
+
+    def _candidates(self) -> List[LLMProvider]:
+        # Пробный запрос half-open занимается только при запуске (_race.launch)
+        return [p for p in self.providers if p.available and self.breakers[p.name].passable]
+
+    def _record_failure(self, provider: LLMProvider, error: BaseException, trial: bool = False) -> None:
+        self.stats[provider.name].record_error()
+        metrics.inc(f"llm.{provider.name}.errors")
+        breaker = self.breakers[provider.name]
+        # Ошибки запроса (400 и т.п.) не говорят о нездоровье провайдера
+        if not is_retryable(error):
+            if trial:
+                breaker.release()
+        elif breaker.record_failure():
+            metrics.inc("llm_router.breaker_opened")
+            logging.warning(f"LLM provider {provider.name} disabled for {breaker.cooldown}s: {error}")
+
+    def _record_success(self, provider: LLMProvider, kind: str, latency: float) -> None:
+        self.stats[provider.name].record_success(kind, latency)
+        self.breakers[provider.name].record_success()
+        metrics.observe(f"llm.{provider.name}.latency", latency)
+
+    async def _race(self, start: Callable[[LLMProvider], Awaitable[Any]], kind: str,
+                    discard: Optional[Callable[[Any], Awaitable[None]]] = None) -> Tuple[LLMProvider, Any]:
+        """
+        Запускает start(provider) у основного провайдера; по таймауту хеджа или
+        после повторяемой ошибки - у следующего. Возвращает первый успех.
+        """
+        candidates = self._candidates()
+        if not candidates:
+            raise LLMUnavailableError("Все провайдеры LLM временно недоступны")
+
+        pending: Dict[asyncio.Future, Tuple[LLMProvider, float]] = {}
+        # Задачи, занявшие пробный запрос автомата в half-open
+        trials = set()
+        launched = 0
+        hedged = False
+        last_error: Optional[BaseException] = None
+
+        def launch() -> bool:
+            """Запускает следующего кандидата, чей автомат пропускает запрос."""
+            nonlocal launched
+            while launched < len(candidates):
+                provider = candidates[launched]
+                launched += 1
+                breaker = self.breakers[provider.name]
+                trial = breaker.state == "half-open"
+                # Пробный запрос мог занять параллельный вызов - тогда берем следующего
+                if breaker.allow():
+                    task = asyncio.ensure_future(start(provider))
+                    pending[task] = (provider, time.monotonic())
+                    if trial:
+                        trials.add(task)
+                    return True
+            return False
+
+        if not launch():
+            raise LLMUnavailableError("Все провайдеры LLM временно недоступны")
+        try:
+            while pending:
+                timeout = None
+                if self.hedge and not hedged and launched < len(candidates) and len(pending) == 1:
+                    provider, started = next(iter(pending.values()))
+                    timeout = max(0.0, started + self.hedge_delay(provider, kind) - time.monotonic())
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    hedged = True
+                    metrics.inc("llm_router.hedged")
+                    launch()
+                    continue
+                for task in done:
+                    provider, started = pending.pop(task)
+                    error = task.exception()
+                    if error is None:
+                        self._record_success(provider, kind, time.monotonic() - started)
+                        if provider is not candidates[0]:
+                            metrics.inc("llm_router.hedge_wins" if hedged else "llm_router.failovers")
+                        return provider, task.result()
+                    self._record_failure(provider, error, trial=task in trials)
+                    logging.warning(f"LLM provider {provider.name} failed: {error!r}")
+                    if not is_retryable(error):
+                        raise error
+                    last_error = error
+                    if not pending and launched < len(candidates):
+                        launch()
+            raise last_error
+        finally:
+            for task, (provider, _) in pending.items():
+                task.cancel()
+                # Результат проигравшего не учитывается - пробный запрос автомата не израсходован
+                if task in trials:
+                    self.breakers[provider.name].release()
+            for task in pending:
+                # Одновременно завершившийся проигравший: освобождаем его ресурсы
+                if task.done() and not task.cancelled() and task.exception() is None and discard:
+                    await discard(task.result())
+
+    async def generate(self, prompt: str, info: Optional[Dict[str, str]] = None,
+                       cache_prompt: Optional[str] = None) -> str:
+        """
+        Полный ответ первого успешного провайдера (с кэшем по промпту или
+        по cache_prompt, если он задан).
+        """
+        async def load() -> str:
+            provider, text = await with_retry(
+                lambda: self._race(lambda p: p.generate(prompt), "complete"), _should_retry
+            )
+            if info is not None:
+                info.update(provider=provider.name, model=provider.model)
+            return text
+        return await cached_completion(prompt, self.cache_model, load, key_prompt=cache_prompt)
+
+    async def stream(self, prompt: str, info: Optional[Dict[str, str]] = None,
+                     cache_prompt: Optional[str] = None) -> AsyncIterator[str]:
+        """
+        Потоковый ответ. Хедж и переключение действуют до первого фрагмента:
+        после него поток идет от одного провайдера, а ошибка пробрасывается.
+        В info записываются provider и model ответившего (при попадании в кэш - не записываются).
+        cache_prompt - как в generate().
+        """
+        async for chunk in cached_stream(prompt, self.cache_model, lambda: self._stream(prompt, info),
+                                         key_prompt=cache_prompt):
+            yield chunk
+
+    async def _stream(self, prompt: str, info: Optional[Dict[str, str]]) -> AsyncIterator[str]:
+        async def first_chunk(provider: LLMProvider):
+            agen = provider.stream(prompt)
+            try:
+                chunk = await agen.__anext__()
+            except StopAsyncIteration:
+                raise LLMEmptyResponseError(f"{provider.name} returned empty stream")
+            except BaseException:
+                await agen.aclose()
+                raise
+            return agen, chunk
+
+        async def discard(result) -> None:
+            await result[0].aclose()
+
+        provider, (agen, chunk) = await with_retry(
+            lambda: self._race(first_chunk, "first_chunk", discard), _should_retry
+        )
+        if info is not None:
+            info.update(provider=provider.name, model=provider.model)
+        try:
+            yield chunk
+            async for chunk in agen:
+                yield chunk
+        except Exception as e:
+            self._record_failure(provider, e)
+            raise
+        finally:
+            await agen.aclose()
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        """Состояние провайдеров для логов и мониторинга."""
+        return {
+            p.name: {
+                "state": self.breakers[p.name].state,
+                "requests": self.stats[p.name].requests,
+                "error_rate": round(self.stats[p.name].error_rate, 3),
+                "p95_complete": self.stats[p.name].percentile("complete", 0.95),
+                "p95_first_chunk": self.stats[p.name].percentile("first_chunk", 0.95),
+            }
+            for p in self.providers
+        }
+
+_PROVIDER_FACTORIES = {"gemini": GeminiRouteProvider, "openai": OpenAIRouteProvider}
+
+def _create_router() -> LLMRouter:
+    providers = []
+    for name in LLM_PROVIDERS:
+        factory = _PROVIDER_FACTORIES.get(name)
+        if factory is None:
+            logging.warning(f"Неизвестный провайдер LLM в LLM_PROVIDERS: {name}")
+            continue
+        providers.append(factory())
+    return LLMRouter(providers)
+
+llm_router = _create_router()
@@ -1,12 +1,20 @@
 """Сервис для работы с LLM моделями через API OpenAI и Google Gemini"""
+import asyncio
+import importlib.util
 import os
+import time
 import logging
 import httpx
 import json
 import google.generativeai as genai
-from typing import Dict, Any, Optional
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Any, Optional
 
 from app.prompts import create_workout_prompt, create_meal_plan_prompt
+from app import metrics
+from app.llm_cache import cached_completion, cached_stream
+from app.rate_limit import (RateLimitTimeout, estimate_tokens, get_rate_limiter,
+                            parse_retry_after, with_retry)
 
 # Инициализация Gemini
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
@@ -15,6 +23,140 @@ if GOOGLE_API_KEY:
 else:
     logging.warning("GOOGLE_API_KEY не найден. Функции Gemini будут недоступны.")
 
+GEMINI_MODEL = "gemini-2.0-flash-lite"
+# Максимум одновременных запросов к Gemini и сколько секунд запрос может ждать слот
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "8"))
+GEMINI_QUEUE_TIMEOUT = float(os.getenv("GEMINI_QUEUE_TIMEOUT", "60"))
+
+# Настройки пула HTTP-соединений к OpenAI API
+OPENAI_API_URL = os.getenv("OPENAI_API_URL", "https://api.openai.com/v1/chat/completions")
+OPENAI_HTTP2 = os.getenv("OPENAI_HTTP2", "1") == "1"
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "20"))
+OPENAI_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("OPENAI_MAX_KEEPALIVE_CONNECTIONS", "10"))
+OPENAI_KEEPALIVE_EXPIRY = float(os.getenv("OPENAI_KEEPALIVE_EXPIRY", "60"))  # секунд
+OPENAI_CONNECT_TIMEOUT = float(os.getenv("OPENAI_CONNECT_TIMEOUT", "5"))
+OPENAI_READ_TIMEOUT = float(os.getenv("OPENAI_READ_TIMEOUT", "60"))
+OPENAI_WRITE_TIMEOUT = float(os.getenv("OPENAI_WRITE_TIMEOUT", "10"))
+OPENAI_POOL_TIMEOUT = float(os.getenv("OPENAI_POOL_TIMEOUT", "10"))
+
+class LLMAPIError(Exception):
+    """Ошибочный HTTP-ответ API модели."""
+
+    def __init__(self, status_code: int, message: str = "", retry_after: Optional[float] = None):
+        super().__init__(f"LLM API error {status_code}: {message}")
+        self.status_code = status_code
+        # Пауза из заголовка Retry-After (секунд), если API ее указало
+        self.retry_after = retry_after
+
+class LLMOverloadedError(Exception):
+    """Очередь к модели переполнена: запрос не дождался свободного слота."""
+
+class LLMEmptyResponseError(Exception):
+    """Модель вернула пустой ответ (можно повторить у другого провайдера)."""
+
+def status_code_of(error: BaseException) -> Optional[int]:
+    """HTTP-статус ошибки провайдера (LLMAPIError или исключения google.api_core)."""
+    for attr in ("status_code", "code"):
+        value = getattr(error, attr, None)
+        if isinstance(value, int):
+            return value
+    return None
+
+def is_retryable(error: BaseException) -> bool:
+    """
+    429, 5xx, перегрузка, исчерпанная квота, пустой ответ и сетевые ошибки
+    стоит повторить. Остальные ошибки без HTTP-статуса (TypeError, KeyError,
+    ошибки валидации и т.п.) - баги или неверный запрос: повтор не поможет,
+    а автомат отключения провайдера не должен их считать.
+    """
+    if isinstance(error, (LLMOverloadedError, LLMEmptyResponseError, RateLimitTimeout,
+                          asyncio.TimeoutError, ConnectionError, httpx.TransportError)):
+        return True
+    status = status_code_of(error)
+    if status is None:
+        return False
+    return status == 429 or status >= 500
+
+class GeminiProvider:
+    """
+    Провайдер Gemini: переиспользует объекты GenerativeModel и ограничивает
+    число одновременных запросов к API.
+
+    Запросы сверх лимита ждут в очереди не дольше queue_timeout секунд,
+    после чего отклоняются (LLMOverloadedError), а не уходят в API пачкой.
+    Метрики: gemini.queue_wait (count/sum/max), gemini.rejected.
+    """
+
+    def __init__(self, max_concurrency: int = GEMINI_MAX_CONCURRENCY,
+                 queue_timeout: float = GEMINI_QUEUE_TIMEOUT):
+        self.max_concurrency = max_concurrency
+        self.queue_timeout = queue_timeout
+        self._models: Dict[tuple, Any] = {}
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self.in_flight = 0
+        self.waiting = 0
+
+    def get_model(self, model_name: str = GEMINI_MODEL,
+                  generation_config: Optional[Dict[str, Any]] = None):
+        """Один экземпляр GenerativeModel на пару (модель, параметры генерации)."""
+        key = (model_name, tuple(sorted((generation_config or {}).items())))
+        model = self._models.get(key)
+        if model is None:
+            model = genai.GenerativeModel(model_name, generation_config=generation_config)
+            self._models[key] = model
+        return model
+
+    @asynccontextmanager
+    async def _slot(self):
+        """Занимает слот из лимита одновременных запросов."""
+        if self._semaphore is None:
+            # Создаем внутри работающего цикла событий
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        started = time.monotonic()
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            metrics.inc("gemini.rejected")
+            raise LLMOverloadedError(f"Gemini queue wait exceeded {self.queue_timeout}s")
+        finally:
+            self.waiting -= 1
+        metrics.observe("gemini.queue_wait", time.monotonic() - started)
+
+        self.in_flight += 1
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            self._semaphore.release()
+
+    async def _acquire_quota(self, prompt: str, model_name: str,
+                             generation_config: Optional[Dict[str, Any]]) -> None:
+        max_tokens = (generation_config or {}).get("max_output_tokens", 2048)
+        await get_rate_limiter("gemini", model_name).acquire(estimate_tokens(prompt, max_tokens))
+
+    async def generate(self, prompt: str, model_name: str = GEMINI_MODEL,
+                       generation_config: Optional[Dict[str, Any]] = None) -> str:
+        # Квоту ждем до занятия слота, чтобы не держать его впустую
+        await self._acquire_quota(prompt, model_name, generation_config)
+        async with self._slot():
+            model = self.get_model(model_name, generation_config)
+            response = await model.generate_content_async(prompt)
+            return response.text.strip()
+
+    async def stream(self, prompt: str, model_name: str = GEMINI_MODEL,
+                     generation_config: Optional[Dict[str, Any]] = None) -> AsyncIterator[str]:
+        """Потоковая генерация: отдает текстовые фрагменты по мере готовности."""
+        await self._acquire_quota(prompt, model_name, generation_config)
+        async with self._slot():
+            model = self.get_model(model_name, generation_config)
+            response = await model.generate_content_async(prompt, stream=True)
+            async for chunk in response:
+                if chunk.text:
+                    yield chunk.text
+
+gemini_provider = GeminiProvider()
+
 async def generate_with_gemini(prompt: str) -> str:
     """
     Генерация текста с помощью Google Gemini.
@@ -29,34 +171,98 @@ async def generate_with_gemini(prompt: str) -> str:
         return "API ключ Gemini не настроен. Обратитесь к администратору."
     
     try:
-        model = genai.GenerativeModel('gemini-2.0-flash-lite')
-        response = await model.generate_content_async(prompt)
-        return response.text.strip()
+        # Одинаковые промпты отдаются из кэша без обращения к API
+        # Повторы при 429/5xx с учетом Retry-After в пределах LLM_REQUEST_DEADLINE
+        return await cached_completion(
+            prompt, GEMINI_MODEL,
+            lambda: with_retry(lambda: gemini_provider.generate(prompt), is_retryable)
+        )
+    except LLMOverloadedError as e:
+        logging.warning(f"Gemini overloaded: {e}")
+        return "Сервис генерации сейчас перегружен. Попробуйте через минуту."
     except Exception as e:
         logging.error(f"Error generating text with Gemini: {e}")
         return f"Произошла ошибка при генерации: {str(e)}"
 
+async def stream_with_gemini(prompt: str) -> AsyncIterator[str]:
+    """
+    Потоковая генерация текста с помощью Google Gemini.
+
+    В отличие от generate_with_gemini, при ошибке выбрасывает исключение,
+    а не возвращает текст ошибки, чтобы он не попал в частичный вывод.
+
+    Args:
+        prompt: Текст промпта
+
+    Yields:
+        str: Очередной фрагмент текста
+    """
+    if not GOOGLE_API_KEY:
+        raise RuntimeError("GOOGLE_API_KEY не настроен")
+    async for chunk in cached_stream(prompt, GEMINI_MODEL, lambda: gemini_provider.stream(prompt)):
+        yield chunk
+
 class LLMService:
     """Класс для работы с LLM моделями через API OpenAI"""
     
-    def __init__(self, api_key: Optional[str] = None, model: str = "gpt-3.5-turbo"):
+    def __init__(self, api_key: Optional[str] = None, model: str = "gpt-3.5-turbo",
+                 api_url: str = OPENAI_API_URL, http2: bool = OPENAI_HTTP2,
+                 limits: Optional[httpx.Limits] = None, timeout: Optional[httpx.Timeout] = None):
         """
         Инициализация сервиса LLM.
         
         Args:
             api_key: API-ключ OpenAI, если не указан, будет использоваться переменная окружения OPENAI_API_KEY
             model: Название модели для использования
+            api_url: Адрес chat/completions (для тестов - локальная заглушка)
+            http2: Использовать HTTP/2 (нужен пакет h2)
+            limits: Лимиты пула соединений
+            timeout: Раздельные таймауты connect/read/write/pool
         """
         self.api_key = api_key or os.environ.get("OPENAI_API_KEY")
         if not self.api_key:
             logging.warning("OPENAI_API_KEY не найден. Функции LLM будут недоступны.")
         
         self.model = model
-        self.api_url = "https://api.openai.com/v1/chat/completions"
+        self.api_url = api_url
         self.headers = {
             "Authorization": f"Bearer {self.api_key}",
             "Content-Type": "application/json"
         }
+        if http2 and importlib.util.find_spec("h2") is None:
+            logging.warning("Пакет h2 не установлен, OpenAI-клиент работает по HTTP/1.1.")
+            http2 = False
+        self.http2 = http2
+        self.limits = limits or httpx.Limits(
+            max_connections=OPENAI_MAX_CONNECTIONS,
+            max_keepalive_connections=OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY
+        )
+        self.timeout = timeout or httpx.Timeout(
+            connect=OPENAI_CONNECT_TIMEOUT,
+            read=OPENAI_READ_TIMEOUT,
+            write=OPENAI_WRITE_TIMEOUT,
+            pool=OPENAI_POOL_TIMEOUT
+        )
+        self._client: Optional[httpx.AsyncClient] = None
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        """Общий клиент с пулом keep-alive соединений, создается при первом запросе."""
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                http2=self.http2,
+                limits=self.limits,
+                timeout=self.timeout,
+                headers=self.headers
+            )
+        return self._client
+
+    async def aclose(self) -> None:
+        """Закрывает пул соединений (вызывается при остановке бота)."""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
     
     async def generate_text(self, prompt: str, max_tokens: int = 2048) -> str:
         """
@@ -76,32 +282,91 @@ class LLMService:
             return "API ключ не настроен. Обратитесь к администратору."
         
         try:
-            async with httpx.AsyncClient() as client:
-                payload = {
-                    "model": self.model,
-                    "messages": [{"role": "user", "content": prompt}],
-                    "max_tokens": max_tokens,
-                    "temperature": 0.7
-                }
-                
-                response = await client.post(
-                    self.api_url, 
-                    headers=self.headers,
-                    json=payload,
-                    timeout=60.0
-                )
-                
-                if response.status_code != 200:
-                    logging.error(f"Error from OpenAI API: {response.status_code}, {response.text}")
-                    return f"Ошибка API: {response.status_code}"
-                
-                response_json = response.json()
-                return response_json["choices"][0]["message"]["content"].strip()
-                
+            return await cached_completion(
+                prompt,
+                f"{self.model}:max_tokens={max_tokens}",
+                lambda: with_retry(lambda: self._complete(prompt, max_tokens), is_retryable)
+            )
+        except RateLimitTimeout as e:
+            logging.warning(f"OpenAI rate limit: {e}")
+            return "Сервис генерации сейчас перегружен. Попробуйте через минуту."
+        except LLMAPIError as e:
+            return f"Ошибка API: {e.status_code}"
         except Exception as e:
             logging.error(f"Error generating text: {e}")
             return f"Произошла ошибка: {str(e)}"
     
+    async def stream_text(self, prompt: str, max_tokens: int = 2048) -> AsyncIterator[str]:
+        """
+        Потоковая генерация текста (Server-Sent Events).
+
+        Args:
+            prompt: Текст промпта
+            max_tokens: Максимальное количество токенов в ответе
+
+        Yields:
+            str: Очередной фрагмент текста
+
+        Raises:
+            LLMAPIError: Если API вернуло ошибочный статус
+        """
+        if not self.api_key:
+            raise RuntimeError("OPENAI_API_KEY не настроен")
+        async for chunk in cached_stream(
+            prompt,
+            f"{self.model}:max_tokens={max_tokens}",
+            lambda: self._stream(prompt, max_tokens)
+        ):
+            yield chunk
+
+    async def _stream(self, prompt: str, max_tokens: int) -> AsyncIterator[str]:
+        payload = {
+            "model": self.model,
+            "messages": [{"role": "user", "content": prompt}],
+            "max_tokens": max_tokens,
+            "temperature": 0.7,
+            "stream": True
+        }
+        await self._acquire_quota(prompt, max_tokens)
+        async with self.client.stream("POST", self.api_url, json=payload) as response:
+            if response.status_code != 200:
+                body = (await response.aread()).decode("utf-8", errors="replace")
+                logging.error(f"Error from OpenAI API: {response.status_code}, {body}")
+                raise LLMAPIError(response.status_code, body,
+                                  parse_retry_after(response.headers.get("retry-after")))
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    break
+                delta = json.loads(data)["choices"][0].get("delta", {}).get("content")
+                if delta:
+                    yield delta
+
+    async def _acquire_quota(self, prompt: str, max_tokens: int) -> None:
+        await get_rate_limiter("openai", self.model).acquire(estimate_tokens(prompt, max_tokens))
+
+    async def _complete(self, prompt: str, max_tokens: int) -> str:
+        """Запрос к API без обработки ошибок: при ошибке выбрасывает исключение."""
+        payload = {
+            "model": self.model,
+            "messages": [{"role": "user", "content": prompt}],
+            "max_tokens": max_tokens,
+            "temperature": 0.7
+        }
+        
+        await self._acquire_quota(prompt, max_tokens)
+        response = await self.client.post(self.api_url, json=payload)
+        
+        if response.status_code != 200:
+            logging.error(f"Error from OpenAI API: {response.status_code}, {response.text}")
+            raise LLMAPIError(response.status_code, response.text,
+                              parse_retry_after(response.headers.get("retry-after")))
+        
+        response_json = response.json()
+        return response_json["choices"][0]["message"]["content"].strip()
+    
     async def generate_workout_plan(self, user_data: Dict[str, Any]) -> str:
         """
         Генерация плана тренировок на основе данных пользователя.
@@ -112,7 +377,7 @@ class LLMService:
         Returns:
             str: Сгенерированный план тренировок
         """
-        prompt = create_workout_prompt(user_data)
+        prompt = create_workout_prompt(user_data, output_format="markdown")
         return await self.generate_text(prompt)
     
     async def generate_meal_plan(self, user_data: Dict[str, Any]) -> str:
@@ -125,7 +390,7 @@ class LLMService:
         Returns:
             str: Сгенерированный план питания
         """
-        prompt = create_meal_plan_prompt(user_data)
+        prompt = create_meal_plan_prompt(user_data, output_format="markdown")
         return await self.generate_text(prompt)
 
 # Создаем синглтон для использования в разных частях приложения
@@ -0,0 +1,23 @@
+"""Счетчики процесса для мониторинга (попадания в кэши, объединенные запросы и т.п.)."""
+from collections import Counter
+from typing import Dict
+
+_counters: Counter = Counter()
+
+def inc(name: str, value: float = 1) -> None:
+    """Увеличивает счетчик name на value."""
+    _counters[name] += value
+
+def observe(name: str, value: float) -> None:
+    """Учитывает наблюдение (например, время ожидания): <name>.count, .sum и .max."""
+    _counters[f"{name}.count"] += 1
+    _counters[f"{name}.sum"] += value
+    if value > _counters.get(f"{name}.max", 0):
+        _counters[f"{name}.max"] = value
+
+def get(name: str) -> float:
+    return _counters.get(name, 0)
+
+def snapshot() -> Dict[str, float]:
+    """Возвращает копию всех счетчиков."""
+    return dict(_counters)
@@ -0,0 +1,51 @@
+"""Middleware диспетчера."""
+import logging
+import os
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware, Dispatcher
+from aiogram.types import TelegramObject
+
+from app.db import UnitOfWork, current_uow
+
+# Одна транзакция на апдейт вместо отдельной сессии на каждый вызов FSM/БД
+UNIT_OF_WORK = os.getenv("UNIT_OF_WORK", "1") == "1"
+
+class UnitOfWorkMiddleware(BaseMiddleware):
+    """
+    Открывает одну единицу работы на апдейт.
+
+    Хранилище FSM работает со снимком в памяти, а после возврата
+    обработчика изменения FSMState и User фиксируются одним коммитом
+    (save_onboarding_data фиксирует их раньше, до ответа пользователю).
+    Сессия доступна обработчикам как `session`.
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        uow = UnitOfWork()
+        token = current_uow.set(uow)
+        try:
+            data["session"] = uow.session
+            result = await handler(event, data)
+            try:
+                await uow.commit()
+            except Exception as e:
+                logging.error(f"Error committing unit of work: {e}", exc_info=True)
+            return result
+        finally:
+            current_uow.reset(token)
+            await uow.close()
+
+def setup_unit_of_work(dp: Dispatcher) -> None:
+    """
+    Регистрирует UnitOfWorkMiddleware перед FSM-middleware диспетчера,
+    чтобы и начальное чтение состояния шло через снимок единицы работы.
+    """
+    dp.update.outer_middleware.unregister(dp.fsm)
+    dp.update.outer_middleware(UnitOfWorkMiddleware())
+    dp.update.outer_middleware(dp.fsm)
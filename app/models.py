@@ -1,5 +1,10 @@
-from sqlalchemy import Column, Integer, String, Float, Boolean, Text
+from datetime import datetime
+from sqlalchemy import (Column, Integer, String, Float, Boolean, Text, DateTime, JSON,
+                        ForeignKey, Index, UniqueConstraint, text)
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import deferred
+
+from app.compression import CompressedText
 
 Base = declarative_base()
 
@@ -34,9 +39,7 @@ class User(Base):
     excluded_foods = Column(Text, nullable=True)
     favorite_foods = Column(Text, nullable=True)
     
-    # Сгенерированные планы
-    workout_plan = Column(Text, nullable=True)  # План тренировок
-    meal_plan = Column(Text, nullable=True)  # План питания
+    # Сгенерированные планы хранятся в таблице plans (см. Plan)
     
     def __repr__(self):
         return f"<User(telegram_id={self.telegram_id})>"
@@ -92,4 +95,96 @@ class User(Base):
     @property
     def has_injuries(self):
         """Возвращает информацию о травмах в текстовом формате."""
-        return "Да" if self.injuries else "Нет"
\ No newline at end of file
+        return "Да" if self.injuries else "Нет"
+
+class Plan(Base):
+    """Сгенерированный план пользователя. Каждая генерация - новая версия."""
+    __tablename__ = "plans"
+    __table_args__ = (
+        # Уникальный индекс заодно обслуживает поиск последней версии
+        UniqueConstraint("telegram_id", "kind", "version", name="uq_plans_user_kind_version"),
+    )
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    telegram_id = Column(Integer, ForeignKey("users.telegram_id"), nullable=False)
+    kind = Column(String, nullable=False)  # workout, meal
+    version = Column(Integer, nullable=False)
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+    # Метаданные генерации: провайдер, модель, версия шаблона промпта и т.п.
+    model = Column(String, nullable=True)
+    meta = Column(JSON, nullable=True)
+
+    # Текст плана (сжатый) загружается только при явном обращении.
+    # Для структурированного плана (meta["format"] == "json") - общая часть
+    # в JSON, сами дни лежат в plan_days.
+    body = deferred(Column(CompressedText, nullable=False))
+
+    def __repr__(self):
+        return f"<Plan(telegram_id={self.telegram_id}, kind={self.kind}, version={self.version})>"
+
+
+class PlanDay(Base):
+    """День структурированного плана: страница просмотра читается без остальных дней."""
+    __tablename__ = "plan_days"
+
+    plan_id = Column(Integer, ForeignKey("plans.id", ondelete="CASCADE"), primary_key=True)
+    day = Column(Integer, primary_key=True)  # с 0
+    data = Column(CompressedText, nullable=False)  # минифицированный JSON дня (app.plan_schema)
+
+    def __repr__(self):
+        return f"<PlanDay(plan_id={self.plan_id}, day={self.day})>"
+
+
+class LLMCacheEntry(Base):
+    """Постоянный уровень кэша ответов LLM (ключ - хэш промпта, модели и версии шаблона)."""
+    __tablename__ = "llm_cache"
+
+    key = Column(String(64), primary_key=True)  # sha256 hex
+    model = Column(String, nullable=True)
+    response = Column(CompressedText, nullable=False)
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    expires_at = Column(DateTime, nullable=False, index=True)
+
+    def __repr__(self):
+        return f"<LLMCacheEntry(key={self.key[:12]}, model={self.model})>"
+
+
+class PlanJob(Base):
+    """Задание на генерацию плана для воркера (python -m app.worker)."""
+    __tablename__ = "plan_jobs"
+    __table_args__ = (
+        # Выборка следующего задания: статус + время, с которого его можно брать
+        Index("ix_plan_jobs_status_run_after", "status", "run_after"),
+        # Не больше одного активного задания одного вида на пользователя (enqueue_plan_job)
+        Index("uq_plan_jobs_active", "telegram_id", "kind", unique=True,
+              postgresql_where=text("status IN ('pending', 'running')"),
+              sqlite_where=text("status IN ('pending', 'running')")),
+    )
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    telegram_id = Column(Integer, ForeignKey("users.telegram_id"), nullable=False, index=True)
+    kind = Column(String, nullable=False)  # workout, meal, full (оба плана)
+    status = Column(String, nullable=False, default="pending")  # pending, running, done, failed
+    attempts = Column(Integer, nullable=False, default=0)
+
+    # Куда выводить результат: сообщение загрузки, отправленное ботом
+    chat_id = Column(Integer, nullable=False)
+    message_id = Column(Integer, nullable=True)
+    loading_text = Column(Text, nullable=True)
+
+    # Результат ({"version": ..., "saved": ...}) или текст последней ошибки
+    result = Column(JSON, nullable=True)
+    error = Column(Text, nullable=True)
+
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    updated_at = Column(DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow)
+    # Не брать задание раньше этого времени (отложенный повтор после ошибки)
+    run_after = Column(DateTime, nullable=False, default=datetime.utcnow)
+    # Аренда воркера: если воркер упал, после этого времени задание берет другой.
+    # locked_by - токен захвата: завершить задание может только его владелец
+    locked_until = Column(DateTime, nullable=True)
+    locked_by = Column(String, nullable=True)
+
+    def __repr__(self):
+        return f"<PlanJob(id={self.id}, telegram_id={self.telegram_id}, kind={self.kind}, status={self.status})>"
@@ -0,0 +1,109 @@
+"""
+Расчет суточной нормы калорий и БЖУ.
+
+BMR - по формуле Миффлина - Сан Жеора, TDEE - BMR с коэффициентом
+активности, затем поправка на цель и раскладка по макронутриентам.
+Расчет векторизован (numpy): compute_targets принимает массивы, поэтому
+пакетные задания (предгенерация) считают все профили одной операцией.
+Готовые цифры подставляются в промпт плана питания - модели остается
+только меню.
+"""
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Sequence
+
+import numpy as np
+
+# Коэффициенты активности (User.activity_level), без значения - низкая
+ACTIVITY_FACTORS = {"low": 1.375, "medium": 1.55, "high": 1.725}
+# Поправка к TDEE по цели
+GOAL_FACTORS = {"mass": 1.15, "weight_loss": 0.8, "strength": 1.1, "health": 1.0}
+# Белок и жиры, г на кг веса; углеводы - остаток калорий
+PROTEIN_PER_KG = {"mass": 1.8, "weight_loss": 2.0, "strength": 2.0, "health": 1.5}
+FAT_PER_KG = {"mass": 1.0, "weight_loss": 0.8, "strength": 0.9, "health": 0.9}
+# Поправка формулы по полу: мужчины +5, женщины -161, пол не указан - среднее
+SEX_OFFSETS = {"male": 5.0, "female": -161.0}
+DEFAULT_SEX_OFFSET = -78.0
+# Нижняя граница калорийности при похудении
+MIN_CALORIES = {"male": 1500, "female": 1200}
+DEFAULT_MIN_CALORIES = 1350
+# Значения по умолчанию, если возраст или рост не указаны
+DEFAULT_AGE = 30
+DEFAULT_HEIGHT = 170
+
+@dataclass(frozen=True)
+class NutritionTargets:
+    bmr: int
+    tdee: int
+    calories: int
+    protein: int  # г
+    fat: int  # г
+    carbs: int  # г
+
+    def as_prompt(self) -> str:
+        return (f"{self.calories} ккал в сутки; белки {self.protein} г, "
+                f"жиры {self.fat} г, углеводы {self.carbs} г")
+
+def _lookup(table: Dict[str, float], values: Sequence[Any], default: float) -> np.ndarray:
+    return np.array([table.get(value, default) for value in values], dtype=np.float64)
+
+def compute_targets(age, weight, height, sex_offset, activity_factor, goal_factor,
+                    protein_per_kg, fat_per_kg, min_calories) -> Dict[str, np.ndarray]:
+    """
+    Нормы для массивов параметров одинаковой длины (или скаляров).
+
+    Returns:
+        dict: bmr, tdee, calories, protein, fat, carbs - массивы целых
+    """
+    age, weight, height = (np.asarray(value, dtype=np.float64) for value in (age, weight, height))
+    bmr = 10 * weight + 6.25 * height - 5 * age + sex_offset
+    tdee = bmr * activity_factor
+    calories = np.maximum(tdee * goal_factor, min_calories)
+    protein = weight * protein_per_kg
+    # Жиры не меньше 20% калорий, углеводы - остаток, но не меньше нуля
+    fat = np.maximum(weight * fat_per_kg, calories * 0.2 / 9)
+    carbs = np.maximum(calories - protein * 4 - fat * 9, 0) / 4
+    # Калорийность округляем до 10 ккал, граммы - до целых
+    return {
+        "bmr": np.rint(bmr).astype(np.int64),
+        "tdee": np.rint(tdee).astype(np.int64),
+        "calories": (np.rint(calories / 10) * 10).astype(np.int64),
+        "protein": np.rint(protein).astype(np.int64),
+        "fat": np.rint(fat).astype(np.int64),
+        "carbs": np.rint(carbs).astype(np.int64),
+    }
+
+def nutrition_targets_batch(profiles: Sequence[Dict[str, Any]]) -> List[Optional[NutritionTargets]]:
+    """
+    Нормы для списка профилей (User.to_dict()) одним векторным расчетом.
+    Для профилей без веса - None: без него норма не считается.
+    """
+    known = [index for index, profile in enumerate(profiles) if profile.get("weight")]
+    result: List[Optional[NutritionTargets]] = [None] * len(profiles)
+    if not known:
+        return result
+    rows = [profiles[index] for index in known]
+    goals = [row.get("goal") if row.get("goal") in GOAL_FACTORS else "health" for row in rows]
+    genders = [row.get("gender") for row in rows]
+    targets = compute_targets(
+        age=[row.get("age") or DEFAULT_AGE for row in rows],
+        weight=[row["weight"] for row in rows],
+        height=[row.get("height") or DEFAULT_HEIGHT for row in rows],
+        sex_offset=_lookup(SEX_OFFSETS, genders, DEFAULT_SEX_OFFSET),
+        activity_factor=_lookup(ACTIVITY_FACTORS, [row.get("activity_level") for row in rows],
+                                ACTIVITY_FACTORS["low"]),
+        goal_factor=_lookup(GOAL_FACTORS, goals, 1.0),
+        protein_per_kg=_lookup(PROTEIN_PER_KG, goals, 1.5),
+        fat_per_kg=_lookup(FAT_PER_KG, goals, 0.9),
+        # Нижняя граница действует только при дефиците калорий
+        min_calories=np.where(
+            np.array([goal == "weight_loss" for goal in goals]),
+            _lookup(MIN_CALORIES, genders, DEFAULT_MIN_CALORIES), 0
+        ),
+    )
+    for position, index in enumerate(known):
+        result[index] = NutritionTargets(**{key: int(values[position]) for key, values in targets.items()})
+    return result
+
+def nutrition_targets(profile: Dict[str, Any]) -> Optional[NutritionTargets]:
+    """Нормы для одного профиля или None, если вес не указан."""
+    return nutrition_targets_batch([profile])[0]
@@ -0,0 +1,253 @@
+"""
+Мгновенные планы по правилам, без обращения к LLM.
+
+Каталог упражнений и блюд плюс шаблоны по цели, опыту, частоте, месту
+и травмам. План строится детерминированно за миллисекунды из
+User.to_dict() и имеет ту же структуру, что и ответ модели
+(app.plan_schema), поэтому хранится и показывается так же.
+
+Бенчмарк: python -m benchmarks.bench_plan_engine
+"""
+from typing import Any, Dict, List, NamedTuple, Tuple
+
+from app.nutrition import nutrition_targets
+from app.plan_schema import Exercise, Meal, MealDay, MealPlan, WorkoutDay, WorkoutPlan
+from app.prompts import workout_split
+
+# Версия правил: сохраняется как модель плана, чтобы отличать планы разных версий каталога
+ENGINE_MODEL = "rules-v1"
+
+# --- Упражнения --- #
+
+class CatalogExercise(NamedTuple):
+    name: str
+    pattern: str  # push_h, push_v, pull_h, pull_v, squat, hinge, lunge, biceps, triceps, core, cardio, mobility
+    places: Tuple[str, ...]  # home, gym, outdoor
+    level: int  # минимальный опыт: 0 - новичок, 1 - средний, 2 - продвинутый
+    joint_load: bool  # ударная или осевая нагрузка - не даем при травмах
+    technique: str
+
+_ALL = ("home", "gym", "outdoor")
+
+EXERCISES = [
+    CatalogExercise("Отжимания от пола", "push_h", _ALL, 0, False, "Корпус прямой, локти под 45° к телу."),
+    CatalogExercise("Отжимания с упором на возвышение", "push_h", _ALL, 0, False, "Руки на скамье или стуле, корпус прямой."),
+    CatalogExercise("Жим штанги лежа", "push_h", ("gym",), 1, True, "Лопатки сведены, гриф опускается к низу груди."),
+    CatalogExercise("Жим гантелей лежа", "push_h", ("gym",), 0, False, "Гантели опускаются до уровня груди, локти под 45°."),
+    CatalogExercise("Отжимания на брусьях", "push_h", ("gym", "outdoor"), 1, True, "Небольшой наклон вперед, без глубокого провала в плечах."),
+    CatalogExercise("Пайк-отжимания", "push_v", ("home", "outdoor"), 1, False, "Таз высоко, голова опускается между руками."),
+    CatalogExercise("Жим гантелей сидя", "push_v", ("gym",), 0, False, "Спина прижата к спинке, гантели до уровня ушей."),
+    CatalogExercise("Армейский жим штанги", "push_v", ("gym",), 1, True, "Ягодицы и пресс напряжены, гриф идет вертикально."),
+    CatalogExercise("Тяга гантели в наклоне", "pull_h", ("gym",), 0, False, "Спина ровная, локоть тянется к поясу."),
+    CatalogExercise("Тяга горизонтального блока", "pull_h", ("gym",), 0, False, "Грудь вперед, лопатки сводятся в конце движения."),
+    CatalogExercise("Австралийские подтягивания", "pull_h", ("home", "outdoor"), 0, False, "Тело прямое, грудь тянется к перекладине или столу."),
+    CatalogExercise("Тяга полотенца в дверном проеме", "pull_h", ("home",), 0, False, "Отклонитесь назад и подтягивайте корпус к двери."),
+    CatalogExercise("Подтягивания", "pull_v", ("gym", "outdoor"), 1, False, "Полная амплитуда, без раскачки."),
+    CatalogExercise("Подтягивания с резиной", "pull_v", ("gym", "outdoor"), 0, False, "Резина помогает внизу, вверху подбородок над перекладиной."),
+    CatalogExercise("Тяга верхнего блока", "pull_v", ("gym",), 0, False, "Тяните к верху груди, не отклоняйтесь сильно назад."),
+    CatalogExercise("Супермен с разведением рук", "pull_v", ("home",), 0, False, "Лежа на животе, поднимайте грудь и сводите лопатки."),
+    CatalogExercise("Приседания с весом тела", "squat", _ALL, 0, False, "Колени по линии носков, пятки не отрываются."),
+    CatalogExercise("Гоблет-приседания", "squat", ("gym",), 0, False, "Гантель у груди, спина прямая."),
+    CatalogExercise("Приседания со штангой", "squat", ("gym",), 1, True, "Гриф на трапециях, глубина - до параллели или ниже."),
+    CatalogExercise("Приседания с выпрыгиванием", "squat", ("home", "outdoor"), 1, True, "Мягкое приземление на носки с перекатом на пятку."),
+    CatalogExercise("Ягодичный мост", "hinge", _ALL, 0, False, "Таз вверх за счет ягодиц, поясница не прогибается."),
+    CatalogExercise("Румынская тяга с гантелями", "hinge", ("gym",), 0, False, "Таз назад, спина ровная, легкий сгиб в коленях."),
+    CatalogExercise("Становая тяга", "hinge", ("gym",), 2, True, "Гриф у голеней, спина нейтральна на всей амплитуде."),
+    CatalogExercise("Гиперэкстензия", "hinge", ("gym",), 0, False, "Без переразгибания поясницы вверху."),
+    CatalogExercise("Выпады назад", "lunge", _ALL, 0, False, "Колено передней ноги над стопой, корпус вертикально."),
+    CatalogExercise("Болгарские сплит-приседания", "lunge", _ALL, 1, False, "Задняя нога на опоре, опускайтесь вертикально вниз."),
+    CatalogExercise("Зашагивания на возвышение", "lunge", _ALL, 0, False, "Толчок пяткой ноги на опоре, без помощи задней ноги."),
+    CatalogExercise("Выпады в ходьбе с гантелями", "lunge", ("gym",), 1, True, "Шаг широкий, заднее колено почти касается пола."),
+    CatalogExercise("Сгибания рук с гантелями", "biceps", ("gym",), 0, False, "Локти прижаты, без раскачки корпусом."),
+    CatalogExercise("Сгибания рук с рюкзаком или эспандером", "biceps", ("home", "outdoor"), 0, False, "Локти прижаты, медленное опускание."),
+    CatalogExercise("Подтягивания обратным хватом", "biceps", ("gym", "outdoor"), 1, False, "Ладони к себе, хват на ширине плеч."),
+    CatalogExercise("Разгибания рук на блоке", "triceps", ("gym",), 0, False, "Локти неподвижны, полное разгибание внизу."),
+    CatalogExercise("Обратные отжимания от скамьи", "triceps", _ALL, 0, False, "Спина близко к опоре, локти назад."),
+    CatalogExercise("Алмазные отжимания", "triceps", _ALL, 1, False, "Ладони вместе под грудью, локти вдоль тела."),
+    CatalogExercise("Планка", "core", _ALL, 0, False, "Тело - прямая линия, живот втянут."),
+    CatalogExercise("Мертвый жук", "core", _ALL, 0, False, "Поясница прижата к полу все время."),
+    CatalogExercise("Боковая планка", "core", _ALL, 0, False, "Таз не провисает, корпус в одной плоскости."),
+    CatalogExercise("Подъемы ног в висе", "core", ("gym", "outdoor"), 1, False, "Без раскачки, таз подкручивается вверху."),
+    CatalogExercise("Берпи", "cardio", _ALL, 1, True, "Ровный темп, мягкое приземление."),
+    CatalogExercise("Скалолаз", "cardio", _ALL, 0, False, "Таз на уровне плеч, колени к груди по очереди."),
+    CatalogExercise("Быстрая ходьба или велотренажер", "cardio", _ALL, 0, False, "Темп, при котором можно говорить, но не петь."),
+    CatalogExercise("Прыжки на скакалке", "cardio", _ALL, 0, True, "Низкие прыжки на носках."),
+    CatalogExercise("Кошка-корова", "mobility", _ALL, 0, False, "Медленно, синхронно с дыханием."),
+    CatalogExercise("Растяжка «Величайшая в мире»", "mobility", _ALL, 0, False, "Выпад, локоть к стопе, затем поворот корпуса."),
+    CatalogExercise("Круги тазом и плечами", "mobility", _ALL, 0, False, "Плавная амплитуда без боли."),
+]
+
+# Паттерны движений по фокусу дня (ключи - начало названий из prompts.WORKOUT_SPLITS)
+FOCUS_PATTERNS = [
+    ("Всё тело", ["squat", "push_h", "pull_h", "hinge", "push_v", "pull_v", "core"]),
+    ("Верх тела", ["push_h", "pull_h", "push_v", "pull_v", "biceps", "triceps"]),
+    ("Низ тела", ["squat", "hinge", "lunge", "core", "hinge", "lunge"]),
+    ("Жимовые", ["push_h", "push_v", "push_h", "triceps", "core", "push_v"]),
+    ("Тяговые", ["pull_v", "pull_h", "pull_v", "biceps", "core", "pull_h"]),
+    ("Ноги и кор", ["squat", "hinge", "lunge", "core", "core", "squat"]),
+    ("Активное восстановление", ["mobility", "cardio", "mobility", "core", "mobility"]),
+]
+
+_EXPERIENCE_LEVELS = {"newbie": 0, "intermediate": 1, "advanced": 2}
+# Упражнений в дне и подходов по опыту
+EXERCISES_PER_DAY = (4, 5, 6)
+SETS_BY_LEVEL = (2, 3, 4)
+
+# Повторения по цели: (основные упражнения, вспомогательные)
+REPS_BY_GOAL = {
+    "mass": ("8-10", "10-12"),
+    "strength": ("4-6", "8-10"),
+    "weight_loss": ("12-15", "15-20"),
+    "health": ("10-12", "12-15"),
+}
+TIMED_PATTERNS = {"core": "30-45 сек", "cardio": "40 сек", "mobility": "60 сек"}
+
+def _focus_patterns(focus: str) -> List[str]:
+    for prefix, patterns in FOCUS_PATTERNS:
+        if focus.startswith(prefix):
+            return patterns
+    return FOCUS_PATTERNS[0][1]
+
+def _candidates(pattern: str, place: str, level: int, injuries: bool) -> List[CatalogExercise]:
+    found = [exercise for exercise in EXERCISES
+             if exercise.pattern == pattern and place in exercise.places
+             and exercise.level <= level and not (injuries and exercise.joint_load)]
+    # Сначала более сложные из доступных уровню
+    return sorted(found, key=lambda exercise: -exercise.level)
+
+def build_workout_plan(profile: Dict[str, Any]) -> WorkoutPlan:
+    """План тренировок по шаблонам: структура недели из prompts.workout_split."""
+    level = _EXPERIENCE_LEVELS.get(profile.get("experience"), 0)
+    place = profile.get("location") if profile.get("location") in _ALL else "home"
+    injuries = bool(profile.get("injuries"))
+    main_reps, accessory_reps = REPS_BY_GOAL.get(profile.get("goal"), REPS_BY_GOAL["health"])
+    per_day, sets = EXERCISES_PER_DAY[level], SETS_BY_LEVEL[level]
+
+    days = []
+    seen_focus: Dict[str, int] = {}
+    for number, focus in enumerate(workout_split(profile.get("frequency")), start=1):
+        patterns = _focus_patterns(focus)
+        # Повтор фокуса за неделю (дни "объем") - сдвиг по каталогу, чтобы упражнения отличались
+        offset = seen_focus.get(patterns[0], 0)
+        seen_focus[patterns[0]] = offset + 1
+        exercises, used = [], set()
+        for position, pattern in enumerate(patterns):
+            if len(exercises) == per_day:
+                break
+            options = [exercise for exercise in _candidates(pattern, place, level, injuries)
+                       if exercise.name not in used]
+            if not options:
+                continue
+            chosen = options[offset % len(options)]
+            used.add(chosen.name)
+            reps = TIMED_PATTERNS.get(pattern) or (main_reps if position < 2 else accessory_reps)
+            exercises.append(Exercise(name=chosen.name, sets=sets, reps=reps, technique=chosen.technique))
+        if profile.get("goal") == "weight_loss" and "cardio" not in patterns:
+            finisher = _candidates("cardio", place, level, injuries)
+            if finisher:
+                exercises.append(Exercise(name=finisher[0].name, sets=3, reps="40 сек", technique=finisher[0].technique))
+        days.append(WorkoutDay(
+            title=f"День {number}: {focus}",
+            warmup="5-7 минут легкого кардио и суставная разминка, затем 1-2 легких подхода первого упражнения.",
+            exercises=exercises,
+            cooldown="5 минут спокойной ходьбы и растяжка проработанных мышц по 30 секунд.",
+        ))
+
+    notes = ["Отдых между подходами 60-90 секунд, в основных упражнениях - до 2 минут.",
+             "Когда верхняя граница повторений дается легко - добавляйте вес или сложность."]
+    if injuries:
+        notes.append("Упражнения с ударной и осевой нагрузкой исключены; любое движение с болью - пропускайте.")
+    return WorkoutPlan(notes=" ".join(notes), days=days)
+
+# --- Питание --- #
+
+class CatalogDish(NamedTuple):
+    name: str
+    slot: str  # breakfast, main, snack
+    calories: int
+    ingredients: Tuple[str, ...]
+
+DISHES = [
+    CatalogDish("Овсянка на молоке с ягодами и орехами", "breakfast", 450, ("овсяные хлопья", "молоко", "ягоды", "орехи")),
+    CatalogDish("Омлет из 3 яиц с овощами и цельнозерновым хлебом", "breakfast", 480, ("яйца", "помидоры", "шпинат", "цельнозерновой хлеб")),
+    CatalogDish("Творог с бананом и медом", "breakfast", 400, ("творог", "бананы", "мед")),
+    CatalogDish("Гречка с яйцом и огурцом", "breakfast", 420, ("гречка", "яйца", "огурцы")),
+    CatalogDish("Сырники из духовки со сметаной", "breakfast", 470, ("творог", "яйца", "мука", "сметана")),
+    CatalogDish("Куриная грудка с рисом и брокколи", "main", 600, ("куриная грудка", "рис", "брокколи")),
+    CatalogDish("Запеченная рыба с картофелем и салатом", "main", 580, ("белая рыба", "картофель", "огурцы", "помидоры")),
+    CatalogDish("Говядина тушеная с гречкой", "main", 650, ("говядина", "гречка", "морковь", "лук")),
+    CatalogDish("Индейка с булгуром и овощами", "main", 590, ("индейка", "булгур", "кабачки", "перец")),
+    CatalogDish("Паста из твердых сортов с курицей и томатами", "main", 640, ("макароны из твердых сортов", "куриная грудка", "помидоры")),
+    CatalogDish("Чечевичный суп и хлеб", "main", 520, ("чечевица", "морковь", "лук", "цельнозерновой хлеб")),
+    CatalogDish("Лосось с киноа и спаржевой фасолью", "main", 670, ("лосось", "киноа", "стручковая фасоль")),
+    CatalogDish("Греческий йогурт с орехами", "snack", 250, ("греческий йогурт", "орехи")),
+    CatalogDish("Яблоко и арахисовая паста", "snack", 230, ("яблоки", "арахисовая паста")),
+    CatalogDish("Кефир и цельнозерновой хлебец", "snack", 200, ("кефир", "хлебцы")),
+    CatalogDish("Творог с зеленью", "snack", 220, ("творог", "зелень")),
+    CatalogDish("Банан и горсть орехов", "snack", 280, ("бананы", "орехи")),
+]
+
+# Замена, если исключенные продукты убрали все блюда своего вида:
+# прием пищи не пропадает, а состав пользователь подбирает сам
+NEUTRAL_DISHES = {
+    "breakfast": CatalogDish("Завтрак из разрешенных продуктов: крупа, белковый продукт и фрукт", "breakfast", 420, ()),
+    "main": CatalogDish("Порция белка, гарнир и овощи из разрешенных продуктов", "main", 600, ()),
+    "snack": CatalogDish("Перекус из разрешенных продуктов: фрукт или белковый продукт", "snack", 220, ()),
+}
+
+# Приемы пищи по их числу в день и доля калорий каждого
+MEAL_SLOTS = {
+    3: [("Завтрак", "breakfast", 0.3), ("Обед", "main", 0.4), ("Ужин", "main", 0.3)],
+    4: [("Завтрак", "breakfast", 0.25), ("Обед", "main", 0.35), ("Перекус", "snack", 0.1), ("Ужин", "main", 0.3)],
+    5: [("Завтрак", "breakfast", 0.25), ("Перекус", "snack", 0.1), ("Обед", "main", 0.3),
+        ("Перекус", "snack", 0.1), ("Ужин", "main", 0.25)],
+}
+
+DAYS_IN_MEAL_PLAN = 7
+# Вес для расчета нормы, если в профиле его нет
+DEFAULT_WEIGHT = 70
+
+def _excluded_words(profile: Dict[str, Any]) -> List[str]:
+    text = " ".join(str(profile.get(field) or "") for field in ("food_allergies", "excluded_foods")).lower()
+    return [word.strip(" .") for word in text.replace(";", ",").split(",") if len(word.strip(" .")) >= 3]
+
+def _allowed(dish: CatalogDish, excluded: List[str]) -> bool:
+    haystack = " ".join((dish.name,) + dish.ingredients).lower()
+    # Сравниваем по основе слова: "орехов" исключает "орехи"
+    return not any(word[:max(3, len(word) - 2)] in haystack for word in excluded)
+
+def build_meal_plan(profile: Dict[str, Any]) -> MealPlan:
+    """Недельный план питания из каталога блюд с учетом исключенных продуктов."""
+    targets = nutrition_targets({**profile, "weight": profile.get("weight") or DEFAULT_WEIGHT})
+    calories = targets.calories
+    slots = MEAL_SLOTS.get(profile.get("meals_per_day"), MEAL_SLOTS[4])
+    excluded = _excluded_words(profile)
+    by_slot: Dict[str, List[CatalogDish]] = {}
+    for dish in DISHES:
+        if _allowed(dish, excluded):
+            by_slot.setdefault(dish.slot, []).append(dish)
+
+    days, shopping = [], {}
+    # Блюда каждого вида идут по кругу: обед и ужин одного дня не совпадают
+    used = {slot: 0 for slot in NEUTRAL_DISHES}
+    for day in range(DAYS_IN_MEAL_PLAN):
+        meals = []
+        for name, slot, share in slots:
+            options = by_slot.get(slot) or [NEUTRAL_DISHES[slot]]
+            dish = options[used[slot] % len(options)]
+            used[slot] += 1
+            shopping.update(dict.fromkeys(dish.ingredients))
+            meals.append(Meal(name=name, dishes=[dish.name], calories=int(round(calories * share, -1))))
+        days.append(MealDay(title=f"День {day + 1}", meals=meals))
+
+    return MealPlan(
+        calories=calories, protein=targets.protein, fat=targets.fat, carbs=targets.carbs,
+        notes="Размер порций подгоняйте под калорийность приема пищи. Пейте 30-35 мл воды на кг веса.",
+        days=days, shopping_list=list(shopping),
+    )
+
+PLAN_BUILDERS = {"workout": build_workout_plan, "meal": build_meal_plan}
+
+def build_plan(kind: str, profile: Dict[str, Any]):
+    """Мгновенный план вида kind (workout или meal) для профиля из User.to_dict()."""
+    return PLAN_BUILDERS[kind](profile)
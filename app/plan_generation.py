@@ -0,0 +1,493 @@
+"""Генерация плана с выводом в сообщение: общий код для бота и воркера очереди."""
+import asyncio
+import json
+import logging
+import os
+import random
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy.exc import SQLAlchemyError
+
+from app.keyboards import (suggest_meal_plan_kb, suggest_workout_plan_kb,
+                           refine_meal_plan_kb, refine_workout_plan_kb, next_step_kb, plan_pages_kb)
+from app.llm_router import llm_router
+from app.models import Plan
+from app.plan_engine import ENGINE_MODEL, build_plan
+from app.nutrition import nutrition_targets
+from app.plan_index import PLAN_REUSE, plan_index, profile_features
+from app.plan_schema import (PLAN_FORMAT, WorkoutPlan, dump_compact, page_count, parse_plan,
+                             render_day, render_markdown, render_page, split_plan, stream_progress)
+from app.plan_store import get_plan, get_plan_days, save_plan, save_plans
+from app.prompts import (create_workout_prompt, create_meal_plan_prompt,
+                         create_workout_day_prompt, meal_plan_cache_prompt, workout_split)
+from app.streaming import ProgressiveEditor
+
+# single - план тренировок одним запросом, days - по дню на запрос параллельно
+WORKOUT_GENERATION = os.getenv("WORKOUT_GENERATION", "single")
+# Сколько дней генерируется одновременно
+WORKOUT_DAY_CONCURRENCY = int(os.getenv("WORKOUT_DAY_CONCURRENCY", "4"))
+# Мгновенный план по шаблонам (app.plan_engine): first - сразу, затем план модели;
+# fallback - только если модель не ответила; off - не использовать
+INSTANT_PLAN = os.getenv("INSTANT_PLAN", "first")
+# В режиме first заменять мгновенный план персональным планом модели
+INSTANT_PLAN_LLM = os.getenv("INSTANT_PLAN_LLM", "1") == "1"
+
+# Константы для сообщений загрузки
+GENERATING_WORKOUT_MSG = [
+    "⚡️ Генерирую твой персональный план тренировок...",
+    "💪 Создаю идеальную программу для твоих целей...",
+    "🔥 Подбираю оптимальные упражнения..."
+]
+GENERATING_MEAL_MSG = [
+    "🍏 Составляю твой план питания...",
+    "🥗 Создаю сбалансированное меню...",
+    "🍽 Готовлю персональные рекомендации..."
+]
+
+# Параметры генерации для каждого вида плана
+PLAN_FLOWS = {
+    "workout": {
+        "name": "план тренировок",
+        "started": "Начинаю генерацию плана тренировок...",
+        "prompt": create_workout_prompt,
+        "loading": GENERATING_WORKOUT_MSG,
+        "title": "🎉 *Твой План Тренировок Готов!* 🎉",
+        "suggest_text": "✨ *Отличная работа!*\n\nХочешь теперь получить *план питания*? 👇",
+        "suggest_kb": suggest_meal_plan_kb,
+        "refine_kb": refine_workout_plan_kb,
+    },
+    "meal": {
+        "name": "план питания",
+        "started": "Начинаю генерацию плана питания...",
+        "prompt": create_meal_plan_prompt,
+        "loading": GENERATING_MEAL_MSG,
+        "title": "🍏 *Твой План Питания Готов!* 🍏",
+        "suggest_text": "✨ *Отличная работа!*\n\nХочешь теперь получить *план тренировок*? 👇",
+        "suggest_kb": suggest_workout_plan_kb,
+        "refine_kb": refine_meal_plan_kb,
+    },
+    # Полная программа: оба плана сразу (см. generate_full_program)
+    "full": {
+        "name": "программу",
+        "started": "Начинаю генерацию полной программы...",
+        "loading": GENERATING_WORKOUT_MSG,
+    },
+}
+
+def error_message(kind: str) -> str:
+    return (f"😔 *Упс! Что-то пошло не так...*\n\n"
+            f"Не удалось сгенерировать {PLAN_FLOWS[kind]['name']}. Попробуй позже!")
+
+async def _update_plan_index() -> None:
+    try:
+        await plan_index.refresh()
+    except Exception as e:
+        logging.warning(f"Plan index refresh failed: {e}")
+
+async def deliver_similar_plan(message, telegram_id: int, kind: str, profile: Dict[str, Any]) -> bool:
+    """
+    Показывает готовый план пользователя с похожим профилем, если такой есть
+    (см. app.plan_index), и сохраняет его копию как план этого пользователя.
+    Кнопка под планом запускает персональную генерацию.
+
+    Returns:
+        bool: True, если план показан
+    """
+    if not PLAN_REUSE:
+        return False
+    try:
+        match = await plan_index.find(kind, profile, telegram_id)
+        if match is None:
+            return False
+        source_id, distance = match
+        source = await get_plan(source_id)
+        if source is None:
+            return False
+        record = {"body": source.body, "model": source.model,
+                  "meta": {"provider": "reuse", "source_plan_id": source_id,
+                           "distance": round(distance, 3), "profile": profile_features(profile)}}
+        source_meta = source.meta or {}
+        if source_meta.get("format") == "json":
+            # Дни структурированного плана копируются вместе с общей частью
+            record["days"] = await get_plan_days(source_id)
+            record["meta"].update(format="json", days=source_meta["days"], pages=source_meta["pages"])
+        version = await save_plan(telegram_id, kind, record["body"], model=record["model"],
+                                  meta=record["meta"], days=record.get("days"))
+    except Exception as e:
+        logging.warning(f"Plan reuse failed for {telegram_id}/{kind}: {e}")
+        return False
+
+    flow = PLAN_FLOWS[kind]
+    logging.info(f"Reused {kind} plan {source_id} (distance {distance:.3f}) as v{version} for {telegram_id}")
+    plan_text, pages_kb = render_plan(kind, record, version, footer=flow["refine_kb"])
+    result_text = (f"{flow['title']}\n\n{plan_text}\n\n✅ *План сохранен в твоем профиле.*\n\n"
+                   f"⚡️ Это готовый план для профиля, очень похожего на твой. "
+                   f"Хочешь план, составленный только для тебя? Жми кнопку ниже 👇")
+    editor = ProgressiveEditor(message)
+    await editor.finish(result_text, parse_mode="Markdown", reply_markup=pages_kb or flow["refine_kb"])
+    return True
+
+async def generate_workout_by_days(editor: ProgressiveEditor, profile: Dict[str, Any],
+                                   concurrency: int = WORKOUT_DAY_CONCURRENCY) -> Tuple[str, Dict[str, str]]:
+    """
+    План тренировок по дням: структура недели берется из frequency
+    (prompts.workout_split), каждый день генерируется отдельным запросом,
+    не больше concurrency одновременно. Готовые дни сразу выводятся
+    в сообщение, итог собирается в порядке дней.
+
+    При PLAN_FORMAT=json, если все дни соответствуют схеме, итог - JSON
+    плана (app.plan_schema.WorkoutPlan), иначе - Markdown.
+
+    Returns:
+        tuple: (текст плана, {"provider", "model"} модели первого готового дня)
+    """
+    split = workout_split(profile.get("frequency"))
+    semaphore = asyncio.Semaphore(concurrency)
+    days: List[Optional[str]] = [None] * len(split)
+    structured: List[Optional[Any]] = [None] * len(split)
+    info: Dict[str, str] = {}
+
+    def stitch() -> str:
+        return "\n\n".join(
+            text if text is not None else f"*День {number}: {focus}*\n\n⏳ составляю..."
+            for number, (focus, text) in enumerate(zip(split, days), start=1)
+        )
+
+    async def run_day(index: int, focus: str) -> None:
+        async with semaphore:
+            day_info: Dict[str, str] = {}
+            text = await llm_router.generate(create_workout_day_prompt(profile, index + 1, focus, split), day_info)
+        if not text or not text.strip():
+            raise ValueError(f"LLM returned empty workout day {index + 1}")
+        title = f"День {index + 1}: {focus}"
+        day = parse_plan("workout", text, day=True) if PLAN_FORMAT == "json" else None
+        if day is not None:
+            # Заголовок дня задает структура недели, а не модель
+            day.title = title
+            structured[index] = day
+            days[index] = render_day("workout", day.model_dump(exclude_none=True))
+        else:
+            days[index] = f"*{title}*\n\n{text.strip()}"
+        if not info:
+            info.update(day_info)
+        await editor.show(stitch())
+
+    tasks = [asyncio.ensure_future(run_day(index, focus)) for index, focus in enumerate(split)]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        # Один день не получился - остальные запросы уже не нужны
+        for task in tasks:
+            task.cancel()
+        raise
+    if all(day is not None for day in structured):
+        return dump_compact(WorkoutPlan(days=structured)), info
+    return stitch(), info
+
+async def stream_plan(message, kind: str, profile: Dict[str, Any],
+                      loading_text: str = "") -> Tuple[str, Dict[str, str], ProgressiveEditor]:
+    """
+    Генерирует текст плана, по мере готовности выводя его в message.
+
+    Returns:
+        tuple: (текст плана, {"provider", "model"} ответившей модели, редактор сообщения)
+    """
+    # Частичный текст показываем под строкой загрузки
+    editor = ProgressiveEditor(message, header=f"{loading_text}\n\n" if loading_text else "")
+    if kind == "workout" and WORKOUT_GENERATION == "days":
+        generated_plan, info = await generate_workout_by_days(editor, profile)
+        return generated_plan, info, editor
+
+    prompt = PLAN_FLOWS[kind]["prompt"](profile)
+    # Общий ответ для похожих профилей питания - только при MEAL_CACHE_BUCKETS=1
+    cache_prompt = meal_plan_cache_prompt(profile) if kind == "meal" else None
+    # Провайдер выбирает маршрутизатор (хедж и переключение Gemini/OpenAI)
+    info: Dict[str, str] = {}
+    if PLAN_FORMAT == "json":
+        # Сырой JSON пользователю не показываем - только какой день расписывается
+        raw = ""
+        async for chunk in llm_router.stream(prompt, info, cache_prompt):
+            raw += chunk
+            await editor.show(stream_progress(kind, raw))
+        generated_plan = raw.strip()
+    else:
+        async for chunk in llm_router.stream(prompt, info, cache_prompt):
+            await editor.feed(chunk)
+        generated_plan = editor.text.strip()
+
+    if not generated_plan:
+        raise ValueError(f"LLM returned empty {kind} plan")
+    return generated_plan, info, editor
+
+def _plan_record(kind: str, text: str, info: Dict[str, str], profile: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Запись для save_plan/save_plans. Ответ по JSON-схеме сохраняется по
+    частям (общая часть в body, дни в days), иначе - текстом целиком.
+    """
+    record = {"body": text, "model": info.get("model"),
+              "meta": {"provider": info.get("provider", "cache"), "profile": profile_features(profile)}}
+    if PLAN_FORMAT != "json":
+        return record
+    plan = parse_plan(kind, text)
+    if plan is None:
+        logging.warning(f"{kind.capitalize()} plan does not match JSON schema, saving as Markdown")
+        return record
+    if kind == "meal":
+        # Норма из промпта посчитана точно - в плане храним ее, а не пересказ модели
+        targets = nutrition_targets(profile)
+        if targets is not None:
+            plan.calories, plan.protein, plan.fat, plan.carbs = (
+                targets.calories, targets.protein, targets.fat, targets.carbs)
+    return _structured_record(kind, plan, record)
+
+def _structured_record(kind: str, plan, record: Dict[str, Any]) -> Dict[str, Any]:
+    overview, days = split_plan(plan)
+    record["body"] = dump_compact(overview)
+    record["days"] = [dump_compact(day) for day in days]
+    record["meta"].update(format="json", days=len(days), pages=page_count(kind, overview, len(days)))
+    return record
+
+def _instant_record(kind: str, profile: Dict[str, Any]) -> Dict[str, Any]:
+    """Запись мгновенного плана по шаблонам (provider "rules")."""
+    record = {"model": ENGINE_MODEL, "meta": {"provider": "rules", "profile": profile_features(profile)}}
+    return _structured_record(kind, build_plan(kind, profile), record)
+
+def render_plan(kind: str, record: Dict[str, Any], version: Optional[int], footer=None) -> Tuple[str, Any]:
+    """
+    Текст плана для вывода после генерации: у сохраненного структурированного
+    плана - первая страница с кнопками страниц, иначе - весь план.
+
+    Returns:
+        tuple: (текст в Markdown, клавиатура страниц или None)
+    """
+    meta = record["meta"]
+    if meta.get("format") != "json":
+        return record["body"], None
+    overview = json.loads(record["body"])
+    days = [json.loads(day) for day in record["days"]]
+    if version is None:
+        # Без сохраненной версии страницы не откроются - показываем план целиком
+        return render_markdown(kind, overview, days), None
+    return (render_page(kind, overview, days[0], 0, meta["pages"]),
+            plan_pages_kb(kind, version, 0, meta["days"], meta["pages"], footer=footer))
+
+def render_plan_page(kind: str, plan: Plan, day: Optional[str], page: int) -> Tuple[str, Any]:
+    """Страница сохраненного структурированного плана (см. plan_store.get_plan_page)."""
+    meta = plan.meta
+    text = render_page(kind, json.loads(plan.body), json.loads(day) if day else None, page, meta["pages"])
+    return text, plan_pages_kb(kind, plan.version, page, meta["days"], meta["pages"])
+
+SAVED_NOTE = "\n\n✅ *План сохранен в твоем профиле.*"
+NOT_SAVED_NOTE = "\n\n⚠️ *Не удалось сохранить план в профиле из-за ошибки. Скопируй его сейчас.*"
+INSTANT_FIRST_NOTE = ("\n\n⚡️ *Это быстрый план по шаблону.* "
+                      "Персональный план появится в этом сообщении, как только будет готов.")
+INSTANT_ONLY_NOTE = ("\n\n⚡️ Это план по шаблону для твоего профиля. "
+                     "Хочешь план, составленный только для тебя? Жми кнопку ниже 👇")
+INSTANT_FALLBACK_NOTE = ("\n\n⚠️ Персональный план сейчас составить не получилось, поэтому это план по шаблону. "
+                         "Попробуй еще раз чуть позже 👇")
+
+async def deliver_instant_plan(message, telegram_id: int, kind: str, profile: Dict[str, Any],
+                               note: str, footer=None) -> Tuple[Dict[str, Any], Optional[int]]:
+    """
+    Строит план по шаблонам (без LLM), сохраняет и выводит его в message.
+
+    Returns:
+        tuple: (запись плана, номер сохраненной версии или None)
+    """
+    record = _instant_record(kind, profile)
+    version = None
+    try:
+        version = await save_plan(telegram_id, kind, record["body"], model=record["model"],
+                                  meta=record["meta"], days=record["days"])
+        logging.info(f"Instant {kind} plan v{version} saved for {telegram_id}")
+    except Exception as e:
+        logging.error(f"Error saving instant {kind} plan for {telegram_id}: {e}", exc_info=True)
+    await _show_instant_plan(message, kind, record, version, note, footer)
+    return record, version
+
+async def _show_instant_plan(message, kind: str, record: Dict[str, Any], version: Optional[int],
+                             note: str, footer=None) -> None:
+    plan_text, pages_kb = render_plan(kind, record, version, footer=footer)
+    await ProgressiveEditor(message).finish(f"{PLAN_FLOWS[kind]['title']}\n\n{plan_text}{note}",
+                                            parse_mode="Markdown", reply_markup=pages_kb or footer)
+
+async def generate_and_deliver(message, telegram_id: int, kind: str, profile: Dict[str, Any],
+                               loading_text: str = "", instant: str = INSTANT_PLAN) -> Dict[str, Any]:
+    """
+    Генерирует план, по мере готовности выводя текст в message, сохраняет
+    его и показывает целиком с разметкой, затем предлагает следующий план.
+
+    message - сообщение загрузки (или объект с методами edit_text/answer).
+    instant - режим мгновенного плана по шаблонам (см. INSTANT_PLAN):
+    при first он сразу заменяет сообщение загрузки, а план модели выводится
+    на его место по готовности (если шаблонный план не собрался, сразу
+    генерируется план модели). Если модель не ответила, в режимах first
+    и fallback пользователь получает план по шаблону, в режиме off
+    выбрасывается исключение. Ошибка сохранения в БД только отмечается
+    в тексте ответа.
+
+    Returns:
+        dict: {"version": номер сохраненной версии или None, "saved": bool, "instant": bool}
+    """
+    flow = PLAN_FLOWS[kind]
+    instant_plan = None
+    if instant == "first":
+        try:
+            instant_plan = await deliver_instant_plan(
+                message, telegram_id, kind, profile,
+                INSTANT_FIRST_NOTE if INSTANT_PLAN_LLM else INSTANT_ONLY_NOTE,
+                footer=None if INSTANT_PLAN_LLM else flow["refine_kb"]
+            )
+        except Exception as e:
+            # Шаблонный план не собрался - пользователь все равно получит план модели
+            logging.error(f"Error building instant {kind} plan for {telegram_id}, falling back to LLM: {e!r}")
+        else:
+            if not INSTANT_PLAN_LLM:
+                return {"version": instant_plan[1], "saved": instant_plan[1] is not None, "instant": True}
+
+    try:
+        # Поверх показанного мгновенного плана промежуточный текст модели не выводим
+        generated_plan, info, editor = await stream_plan(None if instant_plan else message,
+                                                         kind, profile, loading_text)
+    except Exception as e:
+        if instant == "off":
+            raise
+        logging.error(f"Error generating {kind} plan for {telegram_id}, keeping instant plan: {e!r}")
+        if instant_plan:
+            record, version = instant_plan
+            await _show_instant_plan(message, kind, record, version, INSTANT_FALLBACK_NOTE, flow["refine_kb"])
+        else:
+            record, version = await deliver_instant_plan(message, telegram_id, kind, profile,
+                                                         INSTANT_FALLBACK_NOTE, flow["refine_kb"])
+        return {"version": version, "saved": version is not None, "instant": True}
+    if instant_plan:
+        editor = ProgressiveEditor(message)
+
+    record = _plan_record(kind, generated_plan, info, profile)
+    # Пытаемся сохранить план в БД
+    version = None
+    try:
+        version = await save_plan(telegram_id, kind, record["body"], model=record["model"],
+                                  meta=record["meta"], days=record.get("days"))
+        logging.info(f"{kind.capitalize()} plan v{version} saved for {telegram_id}")
+        await _update_plan_index()
+    except SQLAlchemyError as e:
+        logging.error(f"DB error saving {kind} plan for {telegram_id}: {e}")
+    except Exception as e_inner:
+        logging.error(f"Unexpected error saving {kind} plan {telegram_id}: {e_inner}", exc_info=True)
+
+    plan_text, pages_kb = render_plan(kind, record, version)
+    result_text = f"{flow['title']}\n\n{plan_text}"
+    result_text += SAVED_NOTE if version is not None else NOT_SAVED_NOTE
+
+    # Структурированный план выводится по страницам, длинный текст - несколькими сообщениями
+    await editor.finish(result_text, parse_mode="Markdown", reply_markup=pages_kb)
+
+    await asyncio.sleep(1)
+    if message is not None:
+        try:
+            await message.answer(flow["suggest_text"], reply_markup=flow["suggest_kb"], parse_mode="Markdown")
+        except Exception as e:
+            logging.error(f"Error sending message: {e}")
+
+    return {"version": version, "saved": version is not None, "instant": False}
+
+async def generate_full_program(message, telegram_id: int, profile: Dict[str, Any],
+                                loading_text: str = "") -> Dict[str, Any]:
+    """
+    Полная программа: планы тренировок и питания генерируются одновременно,
+    каждый выводится в своем сообщении сразу по готовности, затем оба
+    сохраняются одной транзакцией (после этого у структурированных планов
+    появляются кнопки страниц).
+
+    message - сообщение загрузки для плана тренировок; для плана питания
+    отправляется отдельное сообщение. Если модель не ответила, вместо
+    плана сохраняется план по шаблону (кроме INSTANT_PLAN=off). Исключение
+    выбрасывается, только если не удалось получить ни один план.
+
+    Returns:
+        dict: {"versions": {вид: версия}, "saved": bool}
+    """
+    meal_loading = random.choice(PLAN_FLOWS["meal"]["loading"])
+    meal_message = None
+    if message is not None:
+        try:
+            meal_message = await message.answer(meal_loading)
+        except Exception as e:
+            logging.error(f"Error sending message: {e}")
+    targets = {"workout": (message, loading_text), "meal": (meal_message, meal_loading)}
+
+    async def run(kind: str) -> Tuple[Dict[str, Any], ProgressiveEditor]:
+        target, text = targets[kind]
+        try:
+            generated_plan, info, editor = await stream_plan(target, kind, profile, text)
+            record = _plan_record(kind, generated_plan, info, profile)
+        except Exception as e:
+            if INSTANT_PLAN == "off":
+                raise
+            logging.error(f"Error generating {kind} plan for {telegram_id}, using instant plan: {e!r}")
+            editor, record = ProgressiveEditor(target), _instant_record(kind, profile)
+        if record["meta"].get("format") == "json":
+            # До сохранения показываем первую страницу, кнопки добавятся после
+            overview = json.loads(record["body"])
+            plan_text = render_page(kind, overview, json.loads(record["days"][0]), 0, record["meta"]["pages"])
+        else:
+            plan_text = generated_plan
+        await editor.finish(f"{PLAN_FLOWS[kind]['title']}\n\n{plan_text}", parse_mode="Markdown")
+        return record, editor
+
+    results = await asyncio.gather(*(run(kind) for kind in targets), return_exceptions=True)
+    generated = {}
+    editors: Dict[str, ProgressiveEditor] = {}
+    for kind, result in zip(targets, results):
+        if isinstance(result, BaseException):
+            logging.error(f"Error generating {kind} plan for {telegram_id}: {result!r}")
+            target = targets[kind][0]
+            if target is not None:
+                try:
+                    await target.edit_text(error_message(kind), parse_mode="Markdown")
+                except Exception as e:
+                    logging.error(f"Error editing message: {e}")
+            continue
+        generated[kind], editors[kind] = result
+    if not generated:
+        raise RuntimeError(f"Full program generation failed for {telegram_id}")
+
+    versions: Dict[str, int] = {}
+    try:
+        versions = await save_plans(telegram_id, generated)
+        logging.info(f"Full program saved for {telegram_id}: {versions}")
+        await _update_plan_index()
+    except Exception as e:
+        logging.error(f"Error saving full program for {telegram_id}: {e}", exc_info=True)
+
+    for kind, record in generated.items():
+        if record["meta"].get("format") == "json":
+            # Сохранен - первая страница с кнопками, нет - весь план, чтобы его можно было скопировать
+            plan_text, pages_kb = render_plan(kind, record, versions.get(kind))
+            await editors[kind].finish(f"{PLAN_FLOWS[kind]['title']}\n\n{plan_text}",
+                                       parse_mode="Markdown", reply_markup=pages_kb)
+
+    if message is not None:
+        note = "✅ *Программа сохранена в твоем профиле.*" if versions else NOT_SAVED_NOTE.strip()
+        if len(generated) < len(targets):
+            note += "\n\nОдин из планов не получился - его можно сгенерировать отдельно 👇"
+        try:
+            await message.answer(note, parse_mode="Markdown",
+                                 reply_markup=next_step_kb if len(generated) < len(targets) else None)
+        except Exception as e:
+            logging.error(f"Error sending message: {e}")
+
+    return {"versions": versions, "saved": bool(versions)}
+
+async def deliver_plan(message, telegram_id: int, kind: str, profile: Dict[str, Any],
+                       loading_text: str = "", personal: bool = False) -> Dict[str, Any]:
+    """
+    Точка входа для бота и воркера: kind - вид плана или "full" (полная программа).
+    personal=True - пользователь явно попросил план модели: шаблон показывается,
+    только если модель не ответила.
+    """
+    if kind == "full":
+        return await generate_full_program(message, telegram_id, profile, loading_text)
+    instant = "fallback" if personal and INSTANT_PLAN == "first" else INSTANT_PLAN
+    return await generate_and_deliver(message, telegram_id, kind, profile, loading_text, instant)
@@ -0,0 +1,175 @@
+"""
+Повторное использование планов похожих пользователей.
+
+Каждый сохраненный план индексируется вектором признаков профиля владельца
+(цель, опыт, частота, место, травмы, пол и диапазоны возраста/веса/роста).
+Если ближайший план другого пользователя ближе порога, его можно показать
+сразу, без обращения к LLM.
+"""
+import asyncio
+import logging
+import os
+import time
+from typing import Any, Dict, Optional, Tuple
+
+import numpy as np
+from sqlalchemy import select
+
+from app.db import async_session_factory
+from app.models import Plan, User
+
+PLAN_REUSE = os.getenv("PLAN_REUSE", "1") == "1"
+# Максимальное расстояние между векторами профилей, при котором план переиспользуется
+PLAN_REUSE_MAX_DISTANCE = float(os.getenv("PLAN_REUSE_MAX_DISTANCE", "0.5"))
+# Как часто подтягивать в индекс планы, сохраненные другими процессами, секунд
+PLAN_INDEX_REFRESH_INTERVAL = float(os.getenv("PLAN_INDEX_REFRESH_INTERVAL", "60"))
+
+# Поля профиля, от которых зависит план (сохраняются в Plan.meta["profile"])
+FEATURE_FIELDS = ("goal", "experience", "frequency", "location", "injuries",
+                  "gender", "age", "weight", "height")
+
+_GOALS = ("mass", "weight_loss", "strength", "health", "other")
+_LOCATIONS = ("home", "gym", "outdoor", "other")
+_GENDERS = ("male", "female", "skip")
+_EXPERIENCE = {"newbie": 0, "intermediate": 1, "advanced": 2}
+
+# Ширина диапазонов и вес одного шага диапазона в расстоянии.
+# Несовпадение категорий дает расстояние >= 1, то есть всегда выше порога по умолчанию.
+AGE_BAND, AGE_WEIGHT = 5, 0.15
+WEIGHT_BAND, WEIGHT_WEIGHT = 5, 0.1
+HEIGHT_BAND, HEIGHT_WEIGHT = 5, 0.1
+FREQUENCY_WEIGHT = 0.6
+
+FEATURE_DIM = len(_GOALS) + len(_LOCATIONS) + len(_GENDERS) + 6
+
+def profile_features(profile: Dict[str, Any]) -> Dict[str, Any]:
+    """Часть профиля, по которой строится вектор."""
+    return {field: profile.get(field) for field in FEATURE_FIELDS}
+
+def _one_hot(value, choices) -> list:
+    return [1.0 if value == choice else 0.0 for choice in choices]
+
+def _band(value, width: int) -> float:
+    return float(int(value) // width) if value else -1.0
+
+def feature_vector(profile: Dict[str, Any]) -> np.ndarray:
+    """Вектор признаков профиля; евклидово расстояние между векторами - мера непохожести."""
+    vector = (
+        _one_hot(profile.get("goal"), _GOALS)
+        + _one_hot(profile.get("location"), _LOCATIONS)
+        + _one_hot(profile.get("gender"), _GENDERS)
+        + [
+            float(_EXPERIENCE.get(profile.get("experience"), -1)),
+            float(profile.get("frequency") or 0) * FREQUENCY_WEIGHT,
+            1.0 if profile.get("injuries") else 0.0,
+            _band(profile.get("age"), AGE_BAND) * AGE_WEIGHT,
+            _band(profile.get("weight"), WEIGHT_BAND) * WEIGHT_WEIGHT,
+            _band(profile.get("height"), HEIGHT_BAND) * HEIGHT_WEIGHT,
+        ]
+    )
+    return np.asarray(vector, dtype=np.float32)
+
+class PlanIndex:
+    """
+    Векторы последних планов одного вида, по одному на владельца.
+
+    Матрица растет удвоением, поиск ближайшего - одно векторное
+    вычисление расстояний по всем строкам.
+    """
+
+    def __init__(self, capacity: int = 1024):
+        self.vectors = np.zeros((capacity, FEATURE_DIM), dtype=np.float32)
+        self.plan_ids = np.zeros(capacity, dtype=np.int64)
+        self.size = 0
+        self._rows: Dict[int, int] = {}  # telegram_id -> строка
+
+    def __len__(self) -> int:
+        return self.size
+
+    def add(self, plan_id: int, telegram_id: int, vector: np.ndarray) -> None:
+        row = self._rows.get(telegram_id)
+        if row is None:
+            if self.size == len(self.vectors):
+                self.vectors = np.concatenate([self.vectors, np.zeros_like(self.vectors)])
+                self.plan_ids = np.concatenate([self.plan_ids, np.zeros_like(self.plan_ids)])
+            row = self._rows[telegram_id] = self.size
+            self.size += 1
+        # Более новый план владельца заменяет предыдущий
+        self.vectors[row] = vector
+        self.plan_ids[row] = plan_id
+
+    def nearest(self, vector: np.ndarray, exclude_owner: Optional[int] = None) -> Optional[Tuple[int, float]]:
+        """(plan_id, расстояние) ближайшего плана или None."""
+        if self.size == 0:
+            return None
+        distances = np.linalg.norm(self.vectors[:self.size] - vector, axis=1)
+        own_row = self._rows.get(exclude_owner)
+        if own_row is not None:
+            distances[own_row] = np.inf
+        row = int(np.argmin(distances))
+        if not np.isfinite(distances[row]):
+            return None
+        return int(self.plan_ids[row]), float(distances[row])
+
+class PlanReuseIndex:
+    """
+    Индексы по видам планов. Пополняется инкрементально: refresh() читает
+    только планы с id больше последнего прочитанного.
+    """
+
+    def __init__(self, max_distance: float = PLAN_REUSE_MAX_DISTANCE,
+                 refresh_interval: float = PLAN_INDEX_REFRESH_INTERVAL, batch_size: int = 5000):
+        self.max_distance = max_distance
+        self.refresh_interval = refresh_interval
+        self.batch_size = batch_size
+        self.indexes: Dict[str, PlanIndex] = {}
+        self.last_id = 0
+        self.refreshed_at = 0.0
+        self._lock: Optional[asyncio.Lock] = None
+
+    async def refresh(self) -> int:
+        """Добавляет в индекс новые планы. Returns: сколько планов добавлено."""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        added = 0
+        async with self._lock:
+            while True:
+                async with async_session_factory() as session:
+                    rows = (await session.execute(
+                        select(Plan.id, Plan.telegram_id, Plan.kind, Plan.meta, User)
+                        .join(User, User.telegram_id == Plan.telegram_id)
+                        .where(Plan.id > self.last_id)
+                        .order_by(Plan.id)
+                        .limit(self.batch_size)
+                    )).all()
+                for plan_id, telegram_id, kind, meta, user in rows:
+                    self.last_id = plan_id
+                    meta = meta or {}
+                    if meta.get("provider") in ("reuse", "rules"):
+                        # Копия чужого плана (оригинал уже в индексе) или план по шаблону
+                        continue
+                    # Старые планы без снимка профиля индексируем по текущему профилю
+                    profile = meta.get("profile") or user.to_dict()
+                    self.indexes.setdefault(kind, PlanIndex()).add(plan_id, telegram_id, feature_vector(profile))
+                    added += 1
+                if len(rows) < self.batch_size:
+                    break
+            self.refreshed_at = time.monotonic()
+        return added
+
+    async def find(self, kind: str, profile: Dict[str, Any], telegram_id: int) -> Optional[Tuple[int, float]]:
+        """Ближайший план другого пользователя ближе порога: (plan_id, расстояние) или None."""
+        if time.monotonic() - self.refreshed_at >= self.refresh_interval:
+            try:
+                await self.refresh()
+            except Exception as e:
+                logging.warning(f"Plan index refresh failed: {e}")
+        index = self.indexes.get(kind)
+        if index is None:
+            return None
+        match = index.nearest(feature_vector(profile), exclude_owner=telegram_id)
+        if match is None or match[1] > self.max_distance:
+            return None
+        return match
+
+plan_index = PlanReuseIndex()
@@ -0,0 +1,179 @@
+"""
+Структурированные планы: JSON-схема ответа модели, проверка pydantic и постраничный вывод.
+
+План хранится по частям: общая часть (КБЖУ, рекомендации, список покупок)
+в Plan.body, каждый день - отдельной строкой plan_days. Просмотр плана
+показывает одну страницу (день) и читает из БД только ее.
+"""
+import json
+import os
+import re
+from typing import Dict, List, Optional, Type, Union
+
+from pydantic import BaseModel, Field, ValidationError
+
+# Формат ответа модели: json (структурированный план по дням) или markdown (текст целиком)
+PLAN_FORMAT = os.getenv("PLAN_FORMAT", "json")
+
+class Exercise(BaseModel):
+    name: str
+    sets: Optional[int] = None
+    reps: Optional[str] = None  # "8-12", "30 сек" и т.п.
+    technique: Optional[str] = None
+
+class WorkoutDay(BaseModel):
+    title: str
+    warmup: Optional[str] = None
+    exercises: List[Exercise] = Field(min_length=1)
+    cooldown: Optional[str] = None
+
+class WorkoutPlan(BaseModel):
+    notes: Optional[str] = None
+    days: List[WorkoutDay] = Field(min_length=1)
+
+class Meal(BaseModel):
+    name: str  # завтрак, обед, перекус...
+    dishes: List[str] = Field(min_length=1)
+    calories: Optional[int] = None
+
+class MealDay(BaseModel):
+    title: str
+    meals: List[Meal] = Field(min_length=1)
+
+class MealPlan(BaseModel):
+    calories: Optional[int] = None
+    protein: Optional[int] = None
+    fat: Optional[int] = None
+    carbs: Optional[int] = None
+    notes: Optional[str] = None
+    days: List[MealDay] = Field(min_length=1)
+    shopping_list: List[str] = []
+
+PLAN_MODELS: Dict[str, Type[BaseModel]] = {"workout": WorkoutPlan, "meal": MealPlan}
+DAY_MODELS: Dict[str, Type[BaseModel]] = {"workout": WorkoutDay, "meal": MealDay}
+
+# Описание формата для промпта (короче, чем полная JSON Schema, и модели его понимают лучше)
+JSON_FORMATS = {
+    "workout": (
+        '{"notes": "общие рекомендации", "days": [{"title": "День 1: ...", "warmup": "...", '
+        '"exercises": [{"name": "...", "sets": 3, "reps": "8-12", "technique": "..."}], "cooldown": "..."}]}'
+    ),
+    "meal": (
+        '{"calories": 2200, "protein": 140, "fat": 70, "carbs": 250, "notes": "...", '
+        '"days": [{"title": "День 1", "meals": [{"name": "Завтрак", "dishes": ["..."], "calories": 500}]}], '
+        '"shopping_list": ["..."]}'
+    ),
+    # Норма калорий и БЖУ уже в промпте (app.nutrition) - модель пишет только меню
+    "meal_menu": (
+        '{"days": [{"title": "День 1", "meals": [{"name": "Завтрак", "dishes": ["..."], "calories": 500}]}], '
+        '"shopping_list": ["..."]}'
+    ),
+}
+DAY_JSON_FORMATS = {
+    "workout": ('{"title": "...", "warmup": "...", "exercises": [{"name": "...", "sets": 3, '
+                '"reps": "8-12", "technique": "..."}], "cooldown": "..."}'),
+}
+
+def json_instruction(kind: str, day: bool = False) -> str:
+    """Требование к формату ответа для промпта: строго JSON указанной структуры."""
+    example = DAY_JSON_FORMATS[kind] if day else JSON_FORMATS[kind]
+    return ("Верните ТОЛЬКО JSON без пояснений и без блока ```, строго в формате:\n"
+            f"{example}\n"
+            "Тексты внутри JSON пишите без Markdown-разметки.")
+
+def _extract_json(text: str) -> str:
+    # Модели иногда оборачивают JSON в ```json ... ``` или добавляют текст вокруг
+    fenced = re.search(r"```(?:json)?\s*(.*?)```", text, re.S)
+    if fenced:
+        text = fenced.group(1)
+    start, end = text.find("{"), text.rfind("}")
+    return text[start:end + 1] if start != -1 and end > start else text
+
+def parse_plan(kind: str, text: str, day: bool = False) -> Optional[BaseModel]:
+    """Разбирает и проверяет ответ модели. Возвращает None, если ответ не соответствует схеме."""
+    model = DAY_MODELS[kind] if day else PLAN_MODELS[kind]
+    try:
+        return model.model_validate_json(_extract_json(text))
+    except (ValidationError, ValueError):
+        return None
+
+def stream_progress(kind: str, raw: str) -> str:
+    """Вместо сырого JSON во время генерации показываем, какой день расписывается."""
+    days = raw.count('"title"')
+    if days == 0:
+        return "📝 Продумываю структуру плана..."
+    return f"📝 Расписываю день {days}..."
+
+def dump_compact(data: Union[BaseModel, dict]) -> str:
+    """Минимальная JSON-строка для хранения (без пробелов и пустых полей)."""
+    if isinstance(data, BaseModel):
+        data = data.model_dump(exclude_none=True)
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+
+def split_plan(plan: BaseModel) -> tuple:
+    """Делит план на общую часть и список дней для раздельного хранения."""
+    overview = plan.model_dump(exclude_none=True, exclude={"days"})
+    days = [day.model_dump(exclude_none=True) for day in plan.days]
+    return overview, days
+
+# --- Вывод --- #
+
+PAGE_TITLES = {"workout": "💪 *План тренировок*", "meal": "🥗 *План питания*"}
+
+def render_day(kind: str, day: dict) -> str:
+    """Markdown одного дня плана."""
+    lines = [f"*{day['title']}*"]
+    if kind == "workout":
+        if day.get("warmup"):
+            lines.append(f"\n🔥 _Разминка:_ {day['warmup']}")
+        lines.append("")
+        for number, exercise in enumerate(day.get("exercises", []), start=1):
+            volume = " × ".join(str(part) for part in (exercise.get("sets"), exercise.get("reps")) if part)
+            line = f"{number}. *{exercise['name']}*" + (f" - {volume}" if volume else "")
+            lines.append(line)
+            if exercise.get("technique"):
+                lines.append(f"   {exercise['technique']}")
+        if day.get("cooldown"):
+            lines.append(f"\n🧘 _Заминка:_ {day['cooldown']}")
+    else:
+        for meal in day.get("meals", []):
+            calories = f" (~{meal['calories']} ккал)" if meal.get("calories") else ""
+            lines.append(f"\n🍽 *{meal['name']}*{calories}")
+            lines.extend(f"• {dish}" for dish in meal.get("dishes", []))
+    return "\n".join(lines)
+
+def render_overview(kind: str, overview: dict) -> str:
+    """Общая часть плана (КБЖУ, рекомендации) - выводится над первой страницей."""
+    lines = []
+    if kind == "meal" and overview.get("calories"):
+        macros = "/".join(str(overview.get(key, "?")) for key in ("protein", "fat", "carbs"))
+        lines.append(f"🎯 *{overview['calories']} ккал*, Б/Ж/У: {macros} г")
+    if overview.get("notes"):
+        lines.append(overview["notes"])
+    return "\n".join(lines)
+
+def render_shopping_list(overview: dict) -> str:
+    items = overview.get("shopping_list") or []
+    return "*🛒 Список покупок*\n\n" + "\n".join(f"• {item}" for item in items)
+
+def page_count(kind: str, overview: dict, days: int) -> int:
+    """Страниц в плане: по одной на день плюс список покупок у плана питания."""
+    return days + (1 if kind == "meal" and overview.get("shopping_list") else 0)
+
+def render_page(kind: str, overview: dict, day: Optional[dict], page: int, total: int) -> str:
+    """
+    Страница плана (page с 0): день или, для последней страницы плана
+    питания, список покупок. Общая часть выводится на первой странице.
+    """
+    parts = [f"{PAGE_TITLES[kind]} · {page + 1}/{total}"]
+    if page == 0:
+        parts.append(render_overview(kind, overview))
+    parts.append(render_day(kind, day) if day is not None else render_shopping_list(overview))
+    return "\n\n".join(part for part in parts if part)
+
+def render_markdown(kind: str, overview: dict, days: List[dict]) -> str:
+    """Весь план одним Markdown-текстом (для копирования и старых клиентов)."""
+    parts = [render_overview(kind, overview)] + [render_day(kind, day) for day in days]
+    if kind == "meal" and overview.get("shopping_list"):
+        parts.append(render_shopping_list(overview))
+    return "\n\n".join(part for part in parts if part)
@@ -0,0 +1,140 @@
+"""Хранилище сгенерированных планов (таблица plans)."""
+import logging
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy import func, select, insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import undefer
+
+from app.db import async_session_factory
+from app.models import Plan, PlanDay
+
+PLAN_KINDS = ("workout", "meal")
+
+async def save_plan(telegram_id: int, kind: str, body: str,
+                    model: Optional[str] = None, meta: Optional[Dict[str, Any]] = None,
+                    session=None, days: Optional[List[str]] = None) -> int:
+    """
+    Сохраняет план новой версией.
+
+    Номер версии вычисляется в той же инструкции INSERT ... SELECT max(version) + 1;
+    при гонке двух сохранений уникальный индекс отклонит одно из них, и оно повторится.
+    Если передана session, коммит остается за вызывающим кодом.
+    days - JSON дней структурированного плана, сохраняются в plan_days.
+
+    Returns:
+        int: Номер сохраненной версии
+    """
+    next_version = (
+        select(func.coalesce(func.max(Plan.version), 0) + 1)
+        .where(Plan.telegram_id == telegram_id, Plan.kind == kind)
+        .scalar_subquery()
+    )
+    stmt = insert(Plan).values(
+        telegram_id=telegram_id, kind=kind, version=next_version,
+        body=body, model=model, meta=meta
+    ).returning(Plan.id, Plan.version)
+
+    async def run(target) -> int:
+        plan_id, version = (await target.execute(stmt)).one()
+        if days:
+            await target.execute(insert(PlanDay), [
+                {"plan_id": plan_id, "day": index, "data": data} for index, data in enumerate(days)
+            ])
+        return version
+
+    if session is not None:
+        return await run(session)
+
+    for attempt in range(3):
+        try:
+            async with async_session_factory() as own_session:
+                version = await run(own_session)
+                await own_session.commit()
+                return version
+        except IntegrityError:
+            logging.warning(f"Plan version conflict for {telegram_id}/{kind}, retrying ({attempt + 1})")
+    raise RuntimeError(f"Could not save {kind} plan for {telegram_id}")
+
+async def save_plans(telegram_id: int, plans: Dict[str, Dict[str, Any]]) -> Dict[str, int]:
+    """
+    Сохраняет несколько планов (вид -> {"body", "model", "meta", "days"}) одной
+    транзакцией: либо сохраняются все, либо ни один.
+
+    Returns:
+        dict: Номера сохраненных версий по видам
+    """
+    for attempt in range(3):
+        try:
+            async with async_session_factory() as session:
+                versions = {}
+                for kind, plan in plans.items():
+                    versions[kind] = await save_plan(
+                        telegram_id, kind, plan["body"],
+                        model=plan.get("model"), meta=plan.get("meta"), session=session,
+                        days=plan.get("days")
+                    )
+                await session.commit()
+                return versions
+        except IntegrityError:
+            logging.warning(f"Plan version conflict for {telegram_id}, retrying ({attempt + 1})")
+    raise RuntimeError(f"Could not save plans for {telegram_id}")
+
+async def get_latest_plan(telegram_id: int, kind: str) -> Optional[Plan]:
+    """Возвращает последнюю версию плана вместе с текстом."""
+    async with async_session_factory() as session:
+        result = await session.execute(
+            select(Plan)
+            .options(undefer(Plan.body))
+            .where(Plan.telegram_id == telegram_id, Plan.kind == kind)
+            .order_by(Plan.version.desc())
+            .limit(1)
+        )
+        return result.scalar_one_or_none()
+
+async def list_plan_versions(telegram_id: int, kind: str) -> List[Plan]:
+    """История версий плана без загрузки текстов."""
+    async with async_session_factory() as session:
+        result = await session.execute(
+            select(Plan)
+            .where(Plan.telegram_id == telegram_id, Plan.kind == kind)
+            .order_by(Plan.version.desc())
+        )
+        return list(result.scalars())
+
+async def get_plan(plan_id: int) -> Optional[Plan]:
+    """План по id вместе с текстом."""
+    async with async_session_factory() as session:
+        result = await session.execute(
+            select(Plan).options(undefer(Plan.body)).where(Plan.id == plan_id)
+        )
+        return result.scalar_one_or_none()
+
+async def get_plan_days(plan_id: int) -> List[str]:
+    """JSON всех дней структурированного плана по порядку."""
+    async with async_session_factory() as session:
+        result = await session.execute(
+            select(PlanDay.data).where(PlanDay.plan_id == plan_id).order_by(PlanDay.day)
+        )
+        return list(result.scalars())
+
+async def get_plan_page(telegram_id: int, kind: str, day: int,
+                        version: Optional[int] = None) -> Tuple[Optional[Plan], Optional[str]]:
+    """
+    Одна страница плана одним запросом: план (с общей частью в body) и JSON
+    дня day или None, если такого дня нет. version=None - последняя версия.
+    Поиск идет по telegram_id, поэтому чужой план получить нельзя.
+    """
+    stmt = (
+        select(Plan, PlanDay.data)
+        .options(undefer(Plan.body))
+        .outerjoin(PlanDay, (PlanDay.plan_id == Plan.id) & (PlanDay.day == day))
+        .where(Plan.telegram_id == telegram_id, Plan.kind == kind)
+    )
+    if version is not None:
+        stmt = stmt.where(Plan.version == version)
+    async with async_session_factory() as session:
+        row = (await session.execute(stmt.order_by(Plan.version.desc()).limit(1))).first()
+    if row is None:
+        return None, None
+    return row[0], row[1]
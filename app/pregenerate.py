@@ -0,0 +1,157 @@
+"""
+Пакетная предгенерация планов для самых частых архетипов профилей.
+
+Архетип - сочетание (goal, experience, frequency, location, injuries).
+Для top-N архетипов из таблицы users генерируются планы тренировок и
+питания; ответы попадают в кэш LLM (app.llm_cache), и новые пользователи
+с таким профилем получают план без обращения к модели. Промпт тренировок
+зависит только от полей архетипа. Промпт питания содержит точные возраст,
+вес и рост, поэтому планы питания прогреваются только при
+MEAL_CACHE_BUCKETS=1: тогда ключ кэша пользователя строится по округленным
+параметрам (app.prompts.meal_plan_cache_prompt) и совпадает с архетипом. Уже прогретые
+промпты пропускаются, поэтому прерванный запуск можно просто повторить.
+
+Запуск: python -m app.pregenerate [--top 20] [--concurrency 4] [--dry-run] [--fake-llm]
+"""
+import argparse
+import asyncio
+import logging
+from collections import defaultdict
+from typing import Any, Dict, List, Tuple
+
+from sqlalchemy import func, select
+
+from app.db import async_session_factory, engine, init_db
+from app.llm_cache import LLM_CACHE_BACKEND, cache_key, llm_cache
+from app.llm_router import LLMProvider, LLMRouter, llm_router
+from app.models import User
+from app.nutrition import nutrition_targets_batch
+from app.plan_generation import WORKOUT_GENERATION
+from app.prompts import (MEAL_CACHE_BUCKETS, create_meal_plan_prompt, create_workout_day_prompt,
+                         create_workout_prompt, round_to, workout_split)
+
+ARCHETYPE_FIELDS = ("goal", "experience", "frequency", "location", "injuries")
+KINDS = ("workout", "meal")
+
+class FakeLLMProvider(LLMProvider):
+    """Локальная заглушка модели для проверки предгенерации без API."""
+    name = "fake"
+    model = "fake-llm"
+
+    def __init__(self, delay: float = 0.2):
+        self.delay = delay
+
+    async def generate(self, prompt: str) -> str:
+        await asyncio.sleep(self.delay)
+        return f"# План (заглушка)\n\nПромпт: {len(prompt)} символов"
+
+    async def stream(self, prompt: str):
+        yield await self.generate(prompt)
+
+async def top_archetypes(limit: int) -> List[Tuple[Dict[str, Any], int]]:
+    """
+    Самые частые архетипы с представительным профилем: преобладающий пол
+    и средние возраст/вес/рост, округленные как в ключе кэша (app.prompts.bucket_profile).
+
+    Returns:
+        list: [(профиль, число пользователей)] по убыванию числа
+    """
+    group = [getattr(User, field) for field in ARCHETYPE_FIELDS]
+    async with async_session_factory() as session:
+        rows = (await session.execute(
+            select(*group, User.gender, func.count(),
+                   func.avg(User.age), func.avg(User.weight), func.avg(User.height))
+            .where(User.goal.is_not(None), User.experience.is_not(None))
+            .group_by(*group, User.gender)
+        )).all()
+
+    totals: Dict[tuple, Dict[str, Any]] = defaultdict(lambda: {"count": 0, "genders": defaultdict(int),
+                                                               "sums": defaultdict(float), "weights": defaultdict(int)})
+    for row in rows:
+        archetype = tuple(row[:len(ARCHETYPE_FIELDS)])
+        gender, count, age, weight, height = row[len(ARCHETYPE_FIELDS):]
+        entry = totals[archetype]
+        entry["count"] += count
+        entry["genders"][gender] += count
+        for field, value in (("age", age), ("weight", weight), ("height", height)):
+            if value is not None:
+                entry["sums"][field] += value * count
+                entry["weights"][field] += count
+
+    result = []
+    for archetype, entry in sorted(totals.items(), key=lambda item: -item[1]["count"])[:limit]:
+        profile = dict(zip(ARCHETYPE_FIELDS, archetype))
+        profile["gender"] = max(entry["genders"].items(), key=lambda item: item[1])[0]
+        for field in ("age", "weight", "height"):
+            if entry["weights"][field]:
+                profile[field] = round_to(entry["sums"][field] / entry["weights"][field])
+        result.append(({k: v for k, v in profile.items() if v is not None}, entry["count"]))
+    return result
+
+async def pregenerate(archetypes: List[Tuple[Dict[str, Any], int]], router: LLMRouter,
+                      concurrency: int = 4) -> Dict[str, int]:
+    """Генерирует недостающие в кэше планы. Returns: счетчики generated/skipped/failed."""
+    semaphore = asyncio.Semaphore(concurrency)
+    stats = {"generated": 0, "skipped": 0, "failed": 0}
+
+    # Нормы питания для всех архетипов - одним векторным расчетом
+    targets = nutrition_targets_batch([profile for profile, _ in archetypes])
+    kinds = KINDS if MEAL_CACHE_BUCKETS else ("workout",)
+    if not MEAL_CACHE_BUCKETS:
+        logging.info("MEAL_CACHE_BUCKETS=0: планы питания персональны и не прогреваются")
+
+    def prompts(index: int, kind: str) -> List[str]:
+        """Те же промпты, что отправит бот пользователю этого архетипа."""
+        profile = archetypes[index][0]
+        if kind == "meal":
+            return [create_meal_plan_prompt(profile, targets=targets[index])]
+        if WORKOUT_GENERATION == "days":
+            split = workout_split(profile.get("frequency"))
+            return [create_workout_day_prompt(profile, day, focus, split)
+                    for day, focus in enumerate(split, start=1)]
+        return [create_workout_prompt(profile)]
+
+    async def warm(profile: Dict[str, Any], kind: str, prompt: str) -> None:
+        async with semaphore:
+            if await llm_cache.get(cache_key(prompt, router.cache_model)) is not None:
+                stats["skipped"] += 1
+                return
+            try:
+                await router.generate(prompt)
+                stats["generated"] += 1
+                logging.info(f"Pregenerated {kind} plan for {profile}")
+            except Exception as e:
+                stats["failed"] += 1
+                logging.error(f"Pregeneration of {kind} plan for {profile} failed: {e}")
+
+    await asyncio.gather(*(
+        warm(archetypes[index][0], kind, prompt)
+        for index in range(len(archetypes)) for kind in kinds for prompt in prompts(index, kind)
+    ))
+    return stats
+
+async def main():
+    parser = argparse.ArgumentParser(description="Предгенерация планов для частых профилей")
+    parser.add_argument("--top", type=int, default=20, help="сколько самых частых архетипов прогреть")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--dry-run", action="store_true", help="только показать распределение")
+    parser.add_argument("--fake-llm", action="store_true", help="локальная заглушка вместо API моделей")
+    args = parser.parse_args()
+
+    await init_db()
+    archetypes = await top_archetypes(args.top)
+    for profile, count in archetypes:
+        logging.info(f"{count:>6}  {profile}")
+
+    if not args.dry_run:
+        if LLM_CACHE_BACKEND not in ("db", "redis"):
+            logging.warning(f"LLM_CACHE_BACKEND={LLM_CACHE_BACKEND}: результаты не сохранятся между процессами")
+        router = LLMRouter([FakeLLMProvider()]) if args.fake_llm else llm_router
+        stats = await pregenerate(archetypes, router, args.concurrency)
+        logging.info(f"Done: {stats}")
+    await engine.dispose()
+
+if __name__ == "__main__":
+    # force: импорт app.config уже мог настроить корневой логгер через logging.warning
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(name)s - %(message)s', force=True)
+    asyncio.run(main())
@@ -0,0 +1,116 @@
+"""Read-through кэш профилей пользователей (локальный TTL/LRU + опционально Redis)."""
+import json
+import logging
+import os
+from typing import Any, Dict, Optional
+
+from sqlalchemy import select
+
+from app import metrics
+from app.cache import TTLCache
+from app.db import async_session_factory
+from app.models import User
+
+PROFILE_CACHE_SIZE = int(os.getenv("PROFILE_CACHE_SIZE", "10000"))
+PROFILE_CACHE_TTL = float(os.getenv("PROFILE_CACHE_TTL", "300"))
+# Общий для нескольких процессов уровень кэша (необязательно)
+PROFILE_CACHE_REDIS_URL = os.getenv("PROFILE_CACHE_REDIS_URL")
+
+class ProfileCache:
+    """
+    Кэш строк users по telegram_id.
+
+    Хранит словари колонок, а не ORM-объекты: каждый get() возвращает
+    новый отсоединенный User, поэтому вызывающий код не делит состояние.
+
+    Без Redis кэш локален для процесса; с Redis локального уровня нет:
+    invalidate() в одном процессе не дошла бы до локальных копий других
+    (реплики webhook, воркер), и они отдавали бы старый профиль до ttl.
+    """
+
+    def __init__(self, max_size: int = PROFILE_CACHE_SIZE, ttl: float = PROFILE_CACHE_TTL,
+                 redis=None, prefix: str = "profile"):
+        self.local = TTLCache("profile_cache", max_size=max_size, ttl=ttl) if redis is None else None
+        self.ttl = ttl
+        self.redis = redis
+        self.prefix = prefix
+
+    def _redis_key(self, telegram_id: int) -> str:
+        return f"{self.prefix}:{telegram_id}"
+
+    @staticmethod
+    def _to_row(user: User) -> Dict[str, Any]:
+        return {column.key: getattr(user, column.key) for column in User.__table__.columns}
+
+    async def get(self, telegram_id: int) -> Optional[User]:
+        row = None
+        if self.local is not None:
+            row = self.local.get(telegram_id)
+        else:
+            try:
+                raw = await self.redis.get(self._redis_key(telegram_id))
+                if raw:
+                    row = json.loads(raw)
+                    metrics.inc("profile_cache.redis_hits")
+            except Exception as e:
+                logging.warning(f"Profile cache Redis read failed: {e}")
+        if row is None:
+            return None
+        # Колонки, которых уже нет в модели (старые записи Redis), пропускаем
+        return User(**{k: v for k, v in row.items() if k in User.__table__.columns})
+
+    async def set(self, user: User) -> None:
+        row = self._to_row(user)
+        if self.local is not None:
+            self.local.set(user.telegram_id, row)
+        else:
+            try:
+                await self.redis.set(self._redis_key(user.telegram_id), json.dumps(row), ex=int(self.ttl))
+            except Exception as e:
+                logging.warning(f"Profile cache Redis write failed: {e}")
+
+    async def invalidate(self, telegram_id: int) -> None:
+        if self.local is not None:
+            self.local.delete(telegram_id)
+        else:
+            try:
+                await self.redis.delete(self._redis_key(telegram_id))
+            except Exception as e:
+                logging.warning(f"Profile cache Redis invalidate failed: {e}")
+
+    def stats(self) -> Dict[str, float]:
+        stats = self.local.stats() if self.local is not None else {}
+        stats["redis_hits"] = metrics.get("profile_cache.redis_hits")
+        return stats
+
+def _create_profile_cache() -> ProfileCache:
+    redis = None
+    if PROFILE_CACHE_REDIS_URL:
+        from redis.asyncio import Redis
+        redis = Redis.from_url(PROFILE_CACHE_REDIS_URL)
+    return ProfileCache(redis=redis)
+
+profile_cache = _create_profile_cache()
+
+async def get_cached_user(telegram_id: int) -> Optional[User]:
+    """Возвращает пользователя из кэша, при промахе читает из БД и кладет в кэш."""
+    user = await profile_cache.get(telegram_id)
+    if user is not None:
+        return user
+    return await load_user(telegram_id)
+
+async def load_user(telegram_id: int) -> Optional[User]:
+    """
+    Читает пользователя из БД в обход кэша и обновляет кэш.
+
+    Для отдельных процессов (воркер), которые не видят инвалидацию
+    локального кэша бота: иначе профиль мог бы устареть на PROFILE_CACHE_TTL.
+    """
+    async with async_session_factory() as session:
+        result = await session.execute(
+            select(User).where(User.telegram_id == telegram_id)
+        )
+        user = result.scalar_one_or_none()
+    if user is not None:
+        await profile_cache.set(user)
+    return user
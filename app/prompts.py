@@ -1,11 +1,45 @@
-from typing import Dict, Any
+import os
+from typing import Optional
 
-def create_workout_prompt(user_data: dict) -> str:
+from app.nutrition import NutritionTargets, nutrition_targets
+from app.plan_schema import PLAN_FORMAT, json_instruction
+
+MARKDOWN_INSTRUCTION = "Выходной формат должен быть в виде Markdown."
+
+def output_instruction(kind: str, output_format: str, day: bool = False) -> str:
+    """Последняя строка промпта: Markdown или JSON по схеме app.plan_schema."""
+    return json_instruction(kind, day) if output_format == "json" else MARKDOWN_INSTRUCTION
+
+# Версия шаблонов промптов. Увеличивайте при любом изменении текста шаблонов,
+# чтобы кэш ответов LLM не отдавал планы, сгенерированные по старым шаблонам.
+PROMPT_TEMPLATE_VERSION = "3"
+
+# Общий ответ кэша LLM для похожих профилей питания (по умолчанию выключено).
+# При 1 ключ кэша плана питания строится по профилю с возрастом, весом и ростом,
+# округленными до PROFILE_BUCKET_STEP: пользователь может получить план,
+# составленный для соседних значений (в том числе предгенерированный для
+# архетипа, app.pregenerate). Промпт и норма КБЖУ всегда по точному профилю
+MEAL_CACHE_BUCKETS = os.getenv("MEAL_CACHE_BUCKETS", "0") == "1"
+PROFILE_BUCKET_STEP = 5
+
+def round_to(value, step: int = PROFILE_BUCKET_STEP):
+    return int(round(value / step) * step) if value else None
+
+def bucket_profile(user_data: dict, step: int = PROFILE_BUCKET_STEP) -> dict:
+    """Копия профиля с возрастом, весом и ростом, округленными до step."""
+    bucketed = dict(user_data)
+    for field in ("age", "weight", "height"):
+        if bucketed.get(field):
+            bucketed[field] = round_to(bucketed[field], step)
+    return bucketed
+
+def create_workout_prompt(user_data: dict, output_format: str = PLAN_FORMAT) -> str:
     """
     Создает промпт для генерации плана тренировок на основе данных пользователя.
     
     Args:
         user_data: Словарь с данными пользователя
+        output_format: markdown или json (см. app.plan_schema)
     
     Returns:
         str: Текст промпта для модели
@@ -46,16 +80,93 @@ def create_workout_prompt(user_data: dict) -> str:
 - Количество повторений или время выполнения
 - Краткое описание техники выполнения
 
-Выходной формат должен быть в виде Markdown.
+{output_instruction("workout", output_format)}
 """
     return prompt
 
-def create_meal_plan_prompt(user_data: dict) -> str:
+# Детерминированная структура недели по числу тренировок: фокус каждого дня
+WORKOUT_SPLITS = {
+    1: ["Всё тело"],
+    2: ["Верх тела", "Низ тела"],
+    3: ["Жимовые мышцы (грудь, плечи, трицепс)", "Тяговые мышцы (спина, бицепс)", "Ноги и кор"],
+    4: ["Верх тела (сила)", "Низ тела (сила)", "Верх тела (объем)", "Низ тела (объем)"],
+    5: ["Жимовые мышцы", "Тяговые мышцы", "Ноги и кор", "Верх тела", "Низ тела"],
+    6: ["Жимовые мышцы", "Тяговые мышцы", "Ноги и кор",
+        "Жимовые мышцы (объем)", "Тяговые мышцы (объем)", "Ноги и кор (объем)"],
+    7: ["Жимовые мышцы", "Тяговые мышцы", "Ноги и кор",
+        "Жимовые мышцы (объем)", "Тяговые мышцы (объем)", "Ноги и кор (объем)",
+        "Активное восстановление и мобильность"],
+}
+
+def workout_split(frequency) -> list:
+    """Фокус каждого тренировочного дня для указанного числа тренировок в неделю."""
+    try:
+        days = min(7, max(1, int(frequency)))
+    except (TypeError, ValueError):
+        days = 3
+    return WORKOUT_SPLITS[days]
+
+def create_workout_day_prompt(user_data: dict, day: int, focus: str, split: list,
+                              output_format: str = PLAN_FORMAT) -> str:
+    """
+    Создает промпт для генерации одного дня плана тренировок.
+
+    Args:
+        user_data: Словарь с данными пользователя
+        day: Номер тренировочного дня (с 1)
+        focus: Фокус этого дня
+        split: Фокусы всех дней недели (чтобы модель не дублировала нагрузку)
+        output_format: markdown или json (см. app.plan_schema)
+
+    Returns:
+        str: Текст промпта для модели
+    """
+    field_mapping = {
+        "experience": "fitness_level",
+        "location": "workout_place",
+        "injuries": "injuries"
+    }
+    prompt_data = {}
+    for user_field, prompt_field in field_mapping.items():
+        if user_field in user_data and user_data[user_field]:
+            prompt_data[prompt_field] = user_data[user_field]
+    user_info = "\n".join([f"{key}: {value}" for key, value in prompt_data.items()])
+    week = "\n".join([f"День {number}: {name}" for number, name in enumerate(split, start=1)])
+
+    prompt = f"""
+На основе следующей информации о пользователе распишите ОДИН тренировочный день из недельного плана:
+
+{user_info}
+
+Структура недели:
+{week}
+
+Распишите только День {day} (фокус: {focus}):
+1. Разминку (5-10 минут)
+2. Основную часть с четкими упражнениями, подходами и повторениями
+3. Заминку (5-10 минут)
+
+Для каждого упражнения укажите название, количество подходов, количество
+повторений или время выполнения и краткое описание техники.
+Учитывайте уровень подготовки и травмы. Не пишите вступление и заголовок дня -
+начните сразу с разминки.
+{output_instruction("workout", output_format, day=True)}
+"""
+    return prompt
+
+def create_meal_plan_prompt(user_data: dict, output_format: str = PLAN_FORMAT,
+                            targets: Optional[NutritionTargets] = None) -> str:
     """
     Создает промпт для генерации плана питания на основе данных пользователя.
+
+    Норма калорий и БЖУ считается заранее (app.nutrition) и передается
+    модели готовой: модель пишет только меню. Если вес не указан, расчет
+    нормы остается модели.
     
     Args:
         user_data: Словарь с данными пользователя
+        output_format: markdown или json (см. app.plan_schema)
+        targets: Уже рассчитанная норма (для пакетного расчета), иначе считается здесь
     
     Returns:
         str: Текст промпта для модели
@@ -79,6 +190,25 @@ def create_meal_plan_prompt(user_data: dict) -> str:
     
     # Форматируем информацию о пользователе
     user_info = "\n".join([f"{key}: {value}" for key, value in prompt_data.items()])
+
+    targets = targets or nutrition_targets(user_data)
+    if targets is not None:
+        return f"""
+На основе следующей информации о пользователе создайте план питания на неделю:
+
+{user_info}
+
+Суточная норма уже рассчитана: {targets.as_prompt()}.
+Не пересчитывайте и не объясняйте ее - составьте меню под эти цифры.
+
+План должен включать:
+1. План питания на 7 дней с конкретными блюдами на завтрак, обед, ужин и перекусы
+2. Список продуктов для закупки на неделю
+
+Учтите пищевые аллергии и предпочтения, включайте разнообразные продукты.
+
+{output_instruction("meal_menu", output_format)}
+"""
     
     prompt = f"""
 На основе следующей информации о пользователе создайте план питания на неделю:
@@ -95,6 +225,15 @@ def create_meal_plan_prompt(user_data: dict) -> str:
 - Учитывайте пищевые аллергии и предпочтения
 - Включайте разнообразные продукты для сбалансированного рациона
 
-Выходной формат должен быть в виде Markdown.
+{output_instruction("meal", output_format)}
 """
-    return prompt
\ No newline at end of file
+    return prompt
+
+def meal_plan_cache_prompt(user_data: dict) -> Optional[str]:
+    """
+    Текст для ключа кэша плана питания при MEAL_CACHE_BUCKETS=1: промпт
+    для профиля с округленными параметрами. None - ключ по самому промпту.
+    """
+    if not MEAL_CACHE_BUCKETS:
+        return None
+    return create_meal_plan_prompt(bucket_profile(user_data))
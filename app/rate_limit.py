@@ -0,0 +1,200 @@
+"""
+Клиентское ограничение частоты запросов к LLM и политика повторов.
+
+Для каждой пары провайдер/модель - два token bucket: запросы в минуту и
+токены в минуту. Повторы - экспоненциальная задержка со случайным
+разбросом или значение Retry-After из ответа, в пределах общего
+дедлайна на один пользовательский запрос.
+"""
+import asyncio
+import logging
+import os
+import random
+import time
+from contextvars import ContextVar
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, Dict, Optional, Tuple, TypeVar
+
+from app import metrics
+
+# Лимиты вида "gemini/gemini-2.0-flash-lite=30:1000000,openai/gpt-3.5-turbo=3500:90000"
+# (запросов в минуту : токенов в минуту; 0 - без ограничения). Модель можно опустить: "gemini=30:0"
+LLM_RATE_LIMITS = os.getenv("LLM_RATE_LIMITS", "")
+LLM_RETRY_MAX_ATTEMPTS = int(os.getenv("LLM_RETRY_MAX_ATTEMPTS", "4"))
+LLM_RETRY_BASE_DELAY = float(os.getenv("LLM_RETRY_BASE_DELAY", "1"))  # секунд
+LLM_RETRY_MAX_DELAY = float(os.getenv("LLM_RETRY_MAX_DELAY", "20"))
+# Общий дедлайн пользовательского запроса, включая ожидание лимита и повторы
+LLM_REQUEST_DEADLINE = float(os.getenv("LLM_REQUEST_DEADLINE", "90"))
+
+# Момент (time.monotonic()), после которого ждать уже бессмысленно
+current_deadline: ContextVar[Optional[float]] = ContextVar("llm_deadline", default=None)
+
+T = TypeVar("T")
+
+class RateLimitTimeout(Exception):
+    """Свободной квоты не дождаться до дедлайна запроса."""
+
+def estimate_tokens(prompt: str, max_tokens: int = 2048) -> int:
+    """Грубая оценка расхода токенов: ~3 символа на токен для промпта плюс лимит ответа."""
+    return len(prompt) // 3 + max_tokens
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Retry-After: число секунд или HTTP-дата."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        moment = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return max(0.0, (moment - datetime.now(timezone.utc)).total_seconds())
+
+class TokenBucket:
+    """Ведро на per_minute единиц в минуту; емкость (допустимый всплеск) по умолчанию - минутная квота."""
+
+    def __init__(self, per_minute: float, capacity: Optional[float] = None):
+        self.rate = per_minute / 60.0
+        self.capacity = capacity or per_minute
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """Сколько секунд ждать, пока в ведре наберется amount."""
+        self._refill()
+        amount = min(amount, self.capacity)
+        return 0.0 if self.tokens >= amount else (amount - self.tokens) / self.rate
+
+    def take(self, amount: float) -> None:
+        self.tokens -= min(amount, self.capacity)
+
+class RateLimiter:
+    """
+    Лимит запросов и токенов в минуту для одной модели.
+
+    Ожидающие обслуживаются по очереди; если квоты не дождаться до
+    current_deadline, выбрасывается RateLimitTimeout.
+    Метрики: rate_limit.<name>.wait (count/sum/max), rate_limit.<name>.rejected.
+    """
+
+    def __init__(self, name: str, requests_per_minute: float = 0, tokens_per_minute: float = 0):
+        self.name = name
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self._lock: Optional[asyncio.Lock] = None
+
+    @property
+    def unlimited(self) -> bool:
+        return self.requests is None and self.tokens is None
+
+    def _wait_time(self, tokens: int) -> float:
+        wait = 0.0
+        if self.requests is not None:
+            wait = max(wait, self.requests.wait_time(1))
+        if self.tokens is not None:
+            wait = max(wait, self.tokens.wait_time(tokens))
+        return wait
+
+    async def acquire(self, tokens: int = 0) -> None:
+        if self.unlimited:
+            return
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            waited = 0.0
+            while True:
+                wait = self._wait_time(tokens)
+                if wait <= 0:
+                    break
+                deadline = current_deadline.get()
+                if deadline is not None and time.monotonic() + wait > deadline:
+                    metrics.inc(f"rate_limit.{self.name}.rejected")
+                    raise RateLimitTimeout(f"{self.name}: квота освободится через {wait:.1f}s, это позже дедлайна")
+                await asyncio.sleep(wait)
+                waited += wait
+            if self.requests is not None:
+                self.requests.take(1)
+            if self.tokens is not None:
+                self.tokens.take(tokens)
+        metrics.observe(f"rate_limit.{self.name}.wait", waited)
+
+def _parse_limits(spec: str) -> Dict[str, Tuple[float, float]]:
+    limits = {}
+    for item in spec.split(","):
+        if "=" not in item:
+            continue
+        key, _, value = item.partition("=")
+        rpm, _, tpm = value.partition(":")
+        try:
+            limits[key.strip()] = (float(rpm or 0), float(tpm or 0))
+        except ValueError:
+            logging.warning(f"Некорректный лимит в LLM_RATE_LIMITS: {item}")
+    return limits
+
+_limits = _parse_limits(LLM_RATE_LIMITS)
+_limiters: Dict[str, RateLimiter] = {}
+
+def get_rate_limiter(provider: str, model: str) -> RateLimiter:
+    """Общий для процесса лимитер пары провайдер/модель (настройки из LLM_RATE_LIMITS)."""
+    name = f"{provider}/{model}"
+    limiter = _limiters.get(name)
+    if limiter is None:
+        rpm, tpm = _limits.get(name, _limits.get(provider, (0, 0)))
+        limiter = _limiters[name] = RateLimiter(name, rpm, tpm)
+    return limiter
+
+def retry_delay(attempt: int, error: BaseException,
+                base: float = LLM_RETRY_BASE_DELAY, cap: float = LLM_RETRY_MAX_DELAY) -> float:
+    """Retry-After из ошибки, иначе full jitter: случайное значение в [0, min(cap, base * 2^(attempt-1))]."""
+    retry_after = getattr(error, "retry_after", None)
+    if retry_after is not None:
+        return retry_after
+    return random.uniform(0, min(cap, base * 2 ** (attempt - 1)))
+
+async def with_retry(fn: Callable[[], Awaitable[T]], is_retryable: Callable[[BaseException], bool],
+                     deadline: float = LLM_REQUEST_DEADLINE,
+                     max_attempts: int = LLM_RETRY_MAX_ATTEMPTS) -> T:
+    """
+    Вызывает fn() с повторами при повторяемых ошибках.
+
+    Все попытки, ожидание квоты и паузы укладываются в deadline секунд
+    (или в уже действующий дедлайн внешнего вызова, если он раньше).
+    Метрика: llm_retry.retries.
+    """
+    until = time.monotonic() + deadline
+    outer = current_deadline.get()
+    if outer is not None:
+        until = min(until, outer)
+    token = current_deadline.set(until)
+    try:
+        attempt = 0
+        while True:
+            attempt += 1
+            remaining = until - time.monotonic()
+            if remaining <= 0:
+                raise asyncio.TimeoutError("LLM request deadline exceeded")
+            try:
+                return await asyncio.wait_for(fn(), remaining)
+            except RateLimitTimeout:
+                raise
+            except Exception as e:
+                if attempt >= max_attempts or not is_retryable(e):
+                    raise
+                delay = retry_delay(attempt, e)
+                if time.monotonic() + delay >= until:
+                    raise
+                metrics.inc("llm_retry.retries")
+                logging.warning(f"LLM request failed ({e!r}), retry {attempt}/{max_attempts - 1} in {delay:.1f}s")
+                await asyncio.sleep(delay)
+    finally:
+        current_deadline.reset(token)
@@ -0,0 +1,114 @@
+"""Хранилище FSM на базе Redis: состояние и данные в одном хэше на ключ."""
+import json
+import logging
+import os
+from typing import Any, Dict, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StorageKey, StateType, DEFAULT_DESTINY
+from redis.asyncio import Redis
+from redis.exceptions import WatchError
+
+# Адрес Redis для FSM_STORAGE=redis
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+# Время жизни ключей FSM в секундах (0 - без истечения)
+FSM_TTL = int(os.getenv("FSM_TTL", "0"))
+
+class RedisHashStorage(BaseStorage):
+    """
+    Хранит state и data одного ключа FSM в хэше Redis.
+
+    set_state/set_data выполняются одним пайплайном (запись + EXPIRE),
+    update_data - слиянием в Python внутри WATCH/MULTI: при конкурентной
+    записи транзакция повторяется, поэтому слияния не теряют ключи.
+    Слияние не на сервере: cjson в Lua путает {} и [] и округляет большие целые.
+    Принимает любой клиент с API redis.asyncio, в том числе fakeredis.
+    """
+
+    def __init__(self, redis: Redis, ttl: Optional[int] = FSM_TTL, prefix: str = "fsm"):
+        self.redis = redis
+        self.ttl = ttl or None
+        self.prefix = prefix
+
+    @classmethod
+    def from_url(cls, url: str = REDIS_URL, **kwargs) -> "RedisHashStorage":
+        return cls(Redis.from_url(url), **kwargs)
+
+    def _key(self, key: StorageKey) -> str:
+        parts = [self.prefix, str(key.bot_id), str(key.chat_id), str(key.user_id)]
+        if key.thread_id:
+            parts.append(str(key.thread_id))
+        if key.destiny != DEFAULT_DESTINY:
+            parts.append(key.destiny)
+        return ":".join(parts)
+
+    async def _write(self, key: StorageKey, field: str, value: Optional[str]) -> None:
+        redis_key = self._key(key)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            if value is None:
+                pipe.hdel(redis_key, field)
+            else:
+                pipe.hset(redis_key, field, value)
+                if self.ttl:
+                    pipe.expire(redis_key, self.ttl)
+            await pipe.execute()
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        state = state.state if isinstance(state, State) else state
+        try:
+            await self._write(key, "state", state)
+        except Exception as e:
+            logging.error(f"Error setting state in Redis: {e}")
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        try:
+            value = await self.redis.hget(self._key(key), "state")
+            if isinstance(value, bytes):
+                value = value.decode("utf-8")
+            return value
+        except Exception as e:
+            logging.error(f"Error getting state from Redis: {e}")
+            return None
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        try:
+            await self._write(key, "data", json.dumps(data) if data else None)
+        except Exception as e:
+            logging.error(f"Error setting data in Redis: {e}")
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        try:
+            value = await self.redis.hget(self._key(key), "data")
+            return json.loads(value) if value else {}
+        except Exception as e:
+            logging.error(f"Error getting data from Redis: {e}")
+            return {}
+
+    async def update_data(self, key: StorageKey, data: Dict[str, Any]) -> Dict[str, Any]:
+        redis_key = self._key(key)
+        try:
+            async with self.redis.pipeline(transaction=True) as pipe:
+                while True:
+                    try:
+                        await pipe.watch(redis_key)
+                        current = await pipe.hget(redis_key, "data")
+                        merged = json.loads(current) if current else {}
+                        merged.update(data)
+                        pipe.multi()
+                        pipe.hset(redis_key, "data", json.dumps(merged))
+                        if self.ttl:
+                            pipe.expire(redis_key, self.ttl)
+                        await pipe.execute()
+                        return merged
+                    except WatchError:
+                        # Ключ изменили между чтением и записью - сливаем заново
+                        continue
+        except Exception as e:
+            logging.error(f"Error updating data in Redis: {e}")
+            return data
+
+    async def close(self) -> None:
+        if hasattr(self.redis, "aclose"):
+            await self.redis.aclose()
+        else:
+            await self.redis.close()
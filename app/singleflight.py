@@ -0,0 +1,49 @@
+"""Объединение одинаковых одновременных запросов (single-flight)."""
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable, Tuple
+
+from app import metrics
+
+class SingleFlight:
+    """
+    Пока выполняется вызов с ключом key, повторные вызовы с тем же ключом
+    не запускают работу заново, а ждут результата первого (или его исключения).
+
+    Работает в пределах одного процесса. Счетчик объединенных вызовов:
+    <name>.coalesced в app.metrics.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._calls: Dict[Hashable, asyncio.Future] = {}
+
+    def in_flight(self, key: Hashable) -> bool:
+        return key in self._calls
+
+    def start(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Tuple[asyncio.Future, bool]:
+        """
+        Запускает fn() как задачу или присоединяется к уже идущей.
+
+        Возвращает (future, leader): leader=True, если вызов запущен этим
+        обращением. Регистрация происходит без await, поэтому между
+        проверкой и запуском другой вызов вклиниться не может.
+        """
+        future = self._calls.get(key)
+        if future is not None:
+            metrics.inc(f"{self.name}.coalesced")
+            return future, False
+
+        future = asyncio.ensure_future(fn())
+        self._calls[key] = future
+
+        def _forget(done: asyncio.Future) -> None:
+            if self._calls.get(key) is done:
+                del self._calls[key]
+
+        future.add_done_callback(_forget)
+        return future, True
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        future, _ = self.start(key, fn)
+        # shield: отмена одного ожидающего не отменяет общий вызов
+        return await asyncio.shield(future)
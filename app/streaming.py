@@ -0,0 +1,110 @@
+"""Постепенный вывод генерируемого текста в сообщение Telegram."""
+import asyncio
+import logging
+import os
+import time
+from typing import List, Optional
+
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.types import Message
+
+# Лимит длины текста одного сообщения Telegram
+TELEGRAM_MESSAGE_LIMIT = 4096
+# Минимальный интервал между правками одного сообщения, секунд
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.5"))
+
+def split_message(text: str, limit: int = TELEGRAM_MESSAGE_LIMIT) -> List[str]:
+    """Делит текст на части не длиннее limit, по возможности по границам строк."""
+    parts = []
+    while len(text) > limit:
+        cut = text.rfind("\n", 0, limit)
+        if cut <= 0:
+            cut = limit
+        parts.append(text[:cut])
+        text = text[cut:].lstrip("\n")
+    if text:
+        parts.append(text)
+    return parts
+
+class ProgressiveEditor:
+    """
+    Показывает частичный результат генерации, редактируя одно сообщение.
+
+    Правки не чаще min_interval секунд (ограничение Telegram на edit_text),
+    при TelegramRetryAfter следующая правка откладывается на указанное время.
+    Промежуточный текст выводится без разметки (незакрытый Markdown ломает
+    разбор) и обрезается до лимита сообщения.
+    """
+
+    def __init__(self, message: Optional[Message], header: str = "",
+                 min_interval: float = STREAM_EDIT_INTERVAL,
+                 limit: int = TELEGRAM_MESSAGE_LIMIT):
+        self.message = message
+        self.header = header
+        self.min_interval = min_interval
+        self.limit = limit
+        self.text = ""
+        self._shown = ""
+        self._next_edit_at = 0.0
+
+    async def feed(self, chunk: str) -> None:
+        """Добавляет фрагмент и, если пора, обновляет сообщение."""
+        self.text += chunk
+        if time.monotonic() >= self._next_edit_at:
+            await self._edit(self._preview())
+
+    async def show(self, text: str) -> None:
+        """Заменяет накопленный текст целиком (например, собранный из частей) и, если пора, обновляет сообщение."""
+        self.text = text
+        if time.monotonic() >= self._next_edit_at:
+            await self._edit(self._preview())
+
+    def _preview(self) -> str:
+        preview = self.header + self.text
+        if len(preview) > self.limit:
+            preview = preview[:self.limit - 1] + "…"
+        return preview
+
+    async def _edit(self, text: str, wait: bool = False, **kwargs) -> bool:
+        if self.message is None or text == self._shown:
+            return True
+        try:
+            await self.message.edit_text(text, **kwargs)
+            self._shown = text
+            self._next_edit_at = time.monotonic() + self.min_interval
+            return True
+        except TelegramRetryAfter as e:
+            if wait:
+                # Итоговую правку нельзя пропустить - ждем и повторяем
+                await asyncio.sleep(e.retry_after)
+                return await self._edit(text, **kwargs)
+            self._next_edit_at = time.monotonic() + e.retry_after
+        except TelegramBadRequest as e:
+            if "message is not modified" in str(e):
+                return True
+            logging.warning(f"Streaming edit failed: {e}")
+        except Exception as e:
+            logging.warning(f"Streaming edit failed: {e}")
+        return False
+
+    async def finish(self, text: str, parse_mode: Optional[str] = "Markdown", reply_markup=None) -> None:
+        """
+        Выводит итоговый текст: первая часть заменяет сообщение, остальные
+        (если текст длиннее лимита) отправляются следующими сообщениями.
+        Если разметка не разбирается, часть выводится простым текстом.
+        """
+        parts = split_message(text, self.limit)
+        for index, part in enumerate(parts):
+            markup = reply_markup if index == len(parts) - 1 else None
+            if index == 0 and self.message is not None:
+                self._shown = ""  # итоговую правку делаем даже при совпадении текста
+                if not await self._edit(part, wait=True, parse_mode=parse_mode, reply_markup=markup):
+                    await self._edit(part, wait=True, reply_markup=markup)
+                continue
+            target = self.message
+            if target is None:
+                return
+            try:
+                await target.answer(part, parse_mode=parse_mode, reply_markup=markup)
+            except TelegramBadRequest:
+                await target.answer(part, reply_markup=markup)
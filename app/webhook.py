@@ -0,0 +1,160 @@
+"""
+Прием апдейтов через webhook (BOT_MODE=webhook) вместо long polling.
+
+aiohttp-приложение:
+    POST WEBHOOK_PATH - апдейт от Telegram: проверка секретного токена,
+                        ответ 200 сразу, обработка диспетчером в фоне
+    GET  /healthz     - процесс жив
+    GET  /readyz      - готов принимать апдейты (запущен и БД отвечает)
+    GET  /metrics     - счетчики app.metrics в JSON
+
+Несколько реплик за балансировщиком принимают апдейты одного бота;
+регистрирует webhook в Telegram та, у которой WEBHOOK_SET=1.
+При остановке (SIGTERM/SIGINT) реплика перестает быть готовой и отвечает
+503 на новые апдейты (Telegram их повторит), еще WEBHOOK_DRAIN_GRACE секунд
+принимает соединения, пока балансировщик по /readyz не снимет ее с
+трафика, затем дожидается обработки уже принятых апдейтов.
+"""
+import asyncio
+import logging
+import os
+import signal
+from typing import Any
+
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
+from sqlalchemy import text
+
+from app import metrics
+from app.db import engine
+
+# Режим приема апдейтов: polling (по умолчанию) или webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+# Публичный адрес, который регистрируется в Telegram (без пути), например https://bot.example.com
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+# Секрет из заголовка X-Telegram-Bot-Api-Secret-Token (A-Z, a-z, 0-9, _ и -)
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+# Регистрировать webhook при запуске (достаточно одной реплики)
+WEBHOOK_SET = os.getenv("WEBHOOK_SET", "1") == "1"
+# Сколько секунд при остановке ждать обработки уже принятых апдейтов
+WEBHOOK_SHUTDOWN_TIMEOUT = float(os.getenv("WEBHOOK_SHUTDOWN_TIMEOUT", "30"))
+# Сколько секунд после SIGTERM отвечать 503 до закрытия сервера: не меньше
+# интервала проверки /readyz балансировщиком
+WEBHOOK_DRAIN_GRACE = float(os.getenv("WEBHOOK_DRAIN_GRACE", "10"))
+# Число реплик за балансировщиком: с несколькими репликами апдейты одного
+# пользователя попадают в разные процессы (FSM_STORAGE=cached недопустим)
+WEBHOOK_REPLICAS = int(os.getenv("WEBHOOK_REPLICAS", "1"))
+
+class WebhookRequestHandler(SimpleRequestHandler):
+    """
+    SimpleRequestHandler с подсчетом апдейтов и мягкой остановкой:
+    при остановке новые апдейты получают 503, принятые дорабатываются.
+    """
+
+    def __init__(self, *args: Any, shutdown_timeout: float = WEBHOOK_SHUTDOWN_TIMEOUT, **kwargs: Any):
+        super().__init__(*args, **kwargs)
+        self.shutdown_timeout = shutdown_timeout
+        self.draining = False
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if self.draining:
+            metrics.inc("webhook.rejected_draining")
+            return web.Response(status=503, text="Shutting down")
+        response = await super().handle(request)
+        metrics.inc("webhook.unauthorized" if response.status == 401 else "webhook.updates")
+        return response
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._background_feed_update_tasks)
+
+    async def close(self) -> None:
+        self.draining = True
+        tasks = list(self._background_feed_update_tasks)
+        if tasks:
+            logging.info(f"Webhook: waiting for {len(tasks)} updates in progress")
+            done, pending = await asyncio.wait(tasks, timeout=self.shutdown_timeout)
+            if pending:
+                logging.warning(f"Webhook: {len(pending)} updates not finished in {self.shutdown_timeout}s, cancelling")
+                for task in pending:
+                    task.cancel()
+        await super().close()
+
+async def healthz(request: web.Request) -> web.Response:
+    return web.json_response({"status": "ok"})
+
+async def readyz(request: web.Request) -> web.Response:
+    if not request.app["state"]["ready"]:
+        return web.json_response({"status": "not ready"}, status=503)
+    try:
+        async with engine.connect() as conn:
+            await asyncio.wait_for(conn.execute(text("SELECT 1")), timeout=2)
+    except Exception as e:
+        logging.warning(f"Readiness check failed: {e}")
+        return web.json_response({"status": "db unavailable"}, status=503)
+    return web.json_response({"status": "ready", "in_flight": request.app["webhook_handler"].in_flight})
+
+def start_draining(app: web.Application) -> None:
+    """Снимает реплику с трафика: /readyz и новые апдейты получают 503."""
+    app["state"]["ready"] = False
+    app["webhook_handler"].draining = True
+
+async def metrics_view(request: web.Request) -> web.Response:
+    return web.json_response(metrics.snapshot())
+
+def create_app(dp: Dispatcher, bot: Bot, secret: str = WEBHOOK_SECRET, path: str = WEBHOOK_PATH) -> web.Application:
+    """aiohttp-приложение с webhook и служебными эндпоинтами (без запуска сервера)."""
+    app = web.Application()
+    # Изменяемый словарь: менять ключи запущенного приложения aiohttp не разрешает
+    app["state"] = {"ready": False}
+    handler = WebhookRequestHandler(dispatcher=dp, bot=bot, secret_token=secret or None)
+    handler.register(app, path=path)
+    app["webhook_handler"] = handler
+    app.router.add_get("/healthz", healthz)
+    app.router.add_get("/readyz", readyz)
+    app.router.add_get("/metrics", metrics_view)
+    # startup/shutdown диспетчера - как при start_polling
+    setup_application(app, dp, bot=bot)
+    return app
+
+async def run_webhook(dp: Dispatcher, bot: Bot) -> None:
+    """Запускает сервер и работает до SIGTERM/SIGINT, затем мягко останавливается."""
+    if not WEBHOOK_SECRET:
+        logging.warning("WEBHOOK_SECRET не задан: апдейты принимаются без проверки отправителя")
+    app = create_app(dp, bot)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT)
+    await site.start()
+    logging.info(f"Webhook server listening on {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:  # Windows
+            pass
+
+    try:
+        if WEBHOOK_URL and WEBHOOK_SET:
+            await bot.set_webhook(
+                WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET or None,
+                allowed_updates=dp.resolve_used_update_types(),
+            )
+            logging.info(f"Webhook registered: {WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}")
+        app["state"]["ready"] = True
+        await stop.wait()
+    finally:
+        # Балансировщик по /readyz перестает слать трафик; пока он это не заметил,
+        # сервер еще работает и отвечает 503, затем принятые апдейты дорабатываются
+        start_draining(app)
+        logging.info(f"Webhook server draining for {WEBHOOK_DRAIN_GRACE}s")
+        await asyncio.sleep(WEBHOOK_DRAIN_GRACE)
+        logging.info("Webhook server stopping")
+        await runner.cleanup()
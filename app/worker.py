@@ -0,0 +1,137 @@
+"""
+Воркер очереди генерации планов.
+
+Запуск отдельно от бота (процессов может быть несколько):
+    python -m app.worker --concurrency 4
+"""
+import argparse
+import asyncio
+import logging
+import os
+from typing import Any, Awaitable, Dict, Optional
+
+from app.config import bot
+from app.db import init_db
+from app.jobs import PLAN_JOB_LEASE, claim_plan_job, complete_plan_job, extend_plan_job_lease, fail_plan_job
+from app.llm_service import llm_service
+from app.models import PlanJob
+from app.plan_generation import deliver_plan, error_message
+from app.profile_cache import load_user
+
+# Сколько заданий один процесс выполняет одновременно
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", "4"))
+# Пауза между опросами пустой очереди, секунд
+WORKER_POLL_INTERVAL = float(os.getenv("WORKER_POLL_INTERVAL", "1"))
+
+class MessageRef:
+    """Сообщение загрузки по chat_id/message_id: то, что ProgressiveEditor ждет от Message."""
+
+    def __init__(self, chat_id: int, message_id: int):
+        self.chat_id = chat_id
+        self.message_id = message_id
+
+    async def edit_text(self, text: str, **kwargs):
+        return await bot.edit_message_text(text, chat_id=self.chat_id, message_id=self.message_id, **kwargs)
+
+    async def answer(self, text: str, **kwargs):
+        return await bot.send_message(self.chat_id, text, **kwargs)
+
+async def hold_lease(job: PlanJob, lease: float = PLAN_JOB_LEASE) -> None:
+    """Продлевает аренду, пока задание выполняется. Завершается, если аренду перехватили."""
+    while True:
+        await asyncio.sleep(lease / 3)
+        try:
+            if not await extend_plan_job_lease(job, lease):
+                return
+        except Exception as e:
+            # Аренда еще действует - попробуем продлить на следующем шаге
+            logging.error(f"Plan job {job.id}: error extending lease: {e}")
+
+async def run_with_lease(job: PlanJob, work: Awaitable[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """Выполняет work, продлевая аренду. Returns: None, если аренда потеряна и work отменен."""
+    task = asyncio.ensure_future(work)
+    heartbeat = asyncio.create_task(hold_lease(job))
+    try:
+        await asyncio.wait({task, heartbeat}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        heartbeat.cancel()
+    if not task.done():
+        # Задание уже выполняет другой воркер - не дублируем его вывод
+        task.cancel()
+        logging.warning(f"Plan job {job.id}: lease lost, attempt {job.attempts} cancelled")
+        return None
+    return task.result()
+
+async def process_job(job: PlanJob) -> None:
+    message = MessageRef(job.chat_id, job.message_id) if job.message_id is not None else None
+    try:
+        if message is None:
+            # Бот не смог отправить сообщение загрузки - отправляем свое
+            sent = await bot.send_message(job.chat_id, job.loading_text or "⏳")
+            message = MessageRef(job.chat_id, sent.message_id)
+        # Из БД, а не из кэша: профиль могли изменить в боте после постановки задания
+        user = await load_user(job.telegram_id)
+        if user is None:
+            raise ValueError(f"User {job.telegram_id} not found")
+        result = await run_with_lease(job, deliver_plan(message, job.telegram_id, job.kind,
+                                                        user.to_dict(), job.loading_text or ""))
+    except Exception as e:
+        logging.error(f"Plan job {job.id} attempt {job.attempts} failed: {e}", exc_info=True)
+        if await fail_plan_job(job, str(e)) and message is not None:
+            try:
+                await message.edit_text(error_message(job.kind), parse_mode="Markdown")
+            except Exception as e_edit:
+                logging.error(f"Error editing message: {e_edit}")
+        return
+
+    if result is None:
+        return
+    if not await complete_plan_job(job, result):
+        logging.warning(f"Plan job {job.id}: lease lost before completion, result not recorded")
+        return
+    logging.info(f"Plan job {job.id} done: {result}")
+
+async def worker_loop(index: int, poll_interval: float) -> None:
+    while True:
+        try:
+            job = await claim_plan_job()
+        except Exception as e:
+            logging.error(f"Worker {index}: error claiming job: {e}")
+            job = None
+        if job is None:
+            await asyncio.sleep(poll_interval)
+            continue
+        try:
+            await process_job(job)
+        except Exception:
+            # Ошибка записи статуса (БД недоступна и т.п.) не должна останавливать воркер:
+            # задание вернется в очередь по истечении аренды
+            logging.exception(f"Worker {index}: error processing plan job {job.id}")
+
+async def main(concurrency: int = WORKER_CONCURRENCY, poll_interval: float = WORKER_POLL_INTERVAL) -> None:
+    await init_db()
+    logging.info(f"Plan worker started: concurrency={concurrency}")
+    tasks = [asyncio.create_task(worker_loop(i, poll_interval)) for i in range(concurrency)]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await llm_service.aclose()
+        await bot.session.close()
+
+if __name__ == "__main__":
+    # force: импорт app.config уже мог настроить корневой логгер через logging.warning
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(name)s - %(message)s',
+        force=True
+    )
+    parser = argparse.ArgumentParser(description="Воркер очереди генерации планов")
+    parser.add_argument("--concurrency", type=int, default=WORKER_CONCURRENCY)
+    parser.add_argument("--poll-interval", type=float, default=WORKER_POLL_INTERVAL)
+    args = parser.parse_args()
+    try:
+        asyncio.run(main(args.concurrency, args.poll_interval))
+    except KeyboardInterrupt:
+        pass
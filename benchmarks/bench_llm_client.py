@@ -0,0 +1,154 @@
+"""
+Бенчмарк HTTP-клиента LLMService против локальной заглушки OpenAI API.
+
+Сравнивает задержку запроса при создании нового httpx.AsyncClient на каждый
+запрос (прежнее поведение) и при общем пуле keep-alive соединений.
+
+По умолчанию заглушка отвечает по HTTP/1.1 без TLS, поэтому измеряется
+только переиспользование TCP-соединений. С --tls заглушка работает по
+HTTPS с самоподписанным сертификатом (нужен пакет cryptography) - тогда
+в задержку нового клиента входит и TLS-рукопожатие, как с настоящим API.
+HTTP/2 не измеряется: сервер aiohttp его не поддерживает, и с заглушкой
+клиент работает по HTTP/1.1 даже при OPENAI_HTTP2=1.
+
+Запуск: python -m benchmarks.bench_llm_client --requests 200 --concurrency 1 [--tls]
+"""
+import argparse
+import asyncio
+import datetime
+import ipaddress
+import os
+import ssl
+import statistics
+import tempfile
+import time
+from typing import Optional
+
+from aiohttp import web
+
+# Модули приложения требуют эти переменные при импорте; бенчмарку БД не нужна
+os.environ.setdefault("BOT_TOKEN", "123456:benchmark")
+os.environ.setdefault("DATABASE_URL", "sqlite+aiosqlite://")
+
+import httpx
+
+from app.llm_service import LLMService
+
+COMPLETION = {"choices": [{"message": {"content": "План тренировок: приседания 3x12"}}]}
+
+def self_signed_context(directory: str) -> ssl.SSLContext:
+    """
+    Серверный TLS-контекст с самоподписанным сертификатом для 127.0.0.1.
+
+    Сертификат дописывается к копии пакета certifi в directory/ca.pem:
+    клиент доверяет ему через SSL_CERT_FILE и, как с настоящим API,
+    загружает полный набор корневых сертификатов при создании.
+    """
+    import certifi
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from cryptography.x509.oid import NameOID
+
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "127.0.0.1")])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(name).issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(minutes=1))
+        .not_valid_after(now + datetime.timedelta(days=1))
+        .add_extension(x509.SubjectAlternativeName([x509.IPAddress(ipaddress.ip_address("127.0.0.1"))]), critical=False)
+        .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True)
+        .sign(key, hashes.SHA256())
+    )
+    cert_path = os.path.join(directory, "cert.pem")
+    key_path = os.path.join(directory, "key.pem")
+    cert_pem = cert.public_bytes(serialization.Encoding.PEM)
+    with open(cert_path, "wb") as f:
+        f.write(cert_pem)
+    with open(certifi.where(), "rb") as bundle, open(os.path.join(directory, "ca.pem"), "wb") as f:
+        f.write(bundle.read() + b"\n" + cert_pem)
+    with open(key_path, "wb") as f:
+        f.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                  serialization.NoEncryption()))
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.load_cert_chain(cert_path, key_path)
+    return context
+
+async def start_stub(latency: float, ssl_context: Optional[ssl.SSLContext] = None) -> web.AppRunner:
+    async def completions(request: web.Request) -> web.Response:
+        await request.json()
+        if latency:
+            await asyncio.sleep(latency)
+        return web.json_response(COMPLETION)
+
+    app = web.Application()
+    app.router.add_post("/v1/chat/completions", completions)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0, ssl_context=ssl_context)
+    await site.start()
+    return runner
+
+async def new_client_request(service: LLMService) -> None:
+    """Прежнее поведение: новый клиент (и новое соединение) на каждый запрос."""
+    async with httpx.AsyncClient() as client:
+        response = await client.post(
+            service.api_url, headers=service.headers,
+            json={"model": service.model, "messages": [{"role": "user", "content": "x"}]},
+            timeout=60.0
+        )
+        response.raise_for_status()
+
+async def pooled_request(service: LLMService) -> None:
+    await service._complete("x", max_tokens=16)
+
+async def measure(label: str, call, service: LLMService, requests: int, concurrency: int) -> None:
+    latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one():
+        async with semaphore:
+            started = time.perf_counter()
+            await call(service)
+            latencies.append((time.perf_counter() - started) * 1000)
+
+    await call(service)  # прогрев
+    started = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(requests)))
+    total = time.perf_counter() - started
+    latencies.sort()
+    p95 = latencies[int(len(latencies) * 0.95) - 1]
+    print(f"{label:<22} mean={statistics.mean(latencies):7.2f}ms  p50={statistics.median(latencies):7.2f}ms  "
+          f"p95={p95:7.2f}ms  throughput={requests / total:8.1f} req/s")
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--latency", type=float, default=0.0, help="задержка ответа заглушки, секунд")
+    parser.add_argument("--tls", action="store_true", help="HTTPS-заглушка с самоподписанным сертификатом")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        ssl_context = None
+        if args.tls:
+            ssl_context = self_signed_context(directory)
+            # httpx доверяет сертификату заглушки (trust_env по умолчанию включен)
+            os.environ["SSL_CERT_FILE"] = os.path.join(directory, "ca.pem")
+        runner = await start_stub(args.latency, ssl_context)
+        port = runner.addresses[0][1]
+        scheme = "https" if args.tls else "http"
+        service = LLMService(api_key="stub", api_url=f"{scheme}://127.0.0.1:{port}/v1/chat/completions")
+        try:
+            await measure("new client per request", new_client_request, service, args.requests, args.concurrency)
+            await measure("pooled client", pooled_request, service, args.requests, args.concurrency)
+        finally:
+            await service.aclose()
+            await runner.cleanup()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,76 @@
+"""
+Бенчмарк мгновенных планов по шаблонам (app.plan_engine).
+
+Измеряет задержку построения плана тренировок и плана питания по
+случайным профилям, а также полный путь до вывода: план, разбиение для
+хранения (JSON общей части и дней) и первая страница. Работает без
+сети и без БД.
+
+Запуск: python -m benchmarks.bench_plan_engine --profiles 2000
+"""
+import argparse
+import os
+import random
+import statistics
+import time
+
+# Модули приложения требуют эти переменные при импорте; бенчмарку БД не нужна
+os.environ.setdefault("BOT_TOKEN", "123456:benchmark")
+os.environ.setdefault("DATABASE_URL", "sqlite+aiosqlite://")
+
+from app.plan_engine import build_plan
+from app.plan_schema import dump_compact, page_count, render_page, split_plan
+
+def random_profile(rng: random.Random) -> dict:
+    return {
+        "goal": rng.choice(["mass", "weight_loss", "strength", "health", "other"]),
+        "experience": rng.choice(["newbie", "intermediate", "advanced"]),
+        "frequency": rng.randint(1, 7),
+        "location": rng.choice(["home", "gym", "outdoor", "other"]),
+        "injuries": rng.random() < 0.2,
+        "gender": rng.choice(["male", "female", "skip"]),
+        "age": rng.randint(16, 65),
+        "weight": rng.randint(45, 130),
+        "height": rng.randint(150, 200),
+        "meals_per_day": rng.choice([3, 4, 5, None]),
+        "excluded_foods": rng.choice([None, "рыба", "орехи, мед"]),
+    }
+
+def build_only(kind: str, profile: dict) -> None:
+    build_plan(kind, profile)
+
+def build_and_render(kind: str, profile: dict) -> None:
+    """То, что делает бот до сохранения: план, JSON для хранения и первая страница."""
+    overview, days = split_plan(build_plan(kind, profile))
+    dump_compact(overview)
+    [dump_compact(day) for day in days]
+    render_page(kind, overview, days[0], 0, page_count(kind, overview, len(days)))
+
+def measure(label: str, call, kind: str, profiles: list) -> None:
+    latencies = []
+    call(kind, profiles[0])  # прогрев
+    started = time.perf_counter()
+    for profile in profiles:
+        call_started = time.perf_counter()
+        call(kind, profile)
+        latencies.append((time.perf_counter() - call_started) * 1000)
+    total = time.perf_counter() - started
+    latencies.sort()
+    p95 = latencies[int(len(latencies) * 0.95) - 1]
+    print(f"{label:<22} mean={statistics.mean(latencies):7.3f}ms  p50={statistics.median(latencies):7.3f}ms  "
+          f"p95={p95:7.3f}ms  throughput={len(profiles) / total:8.1f} plans/s")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--profiles", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    profiles = [random_profile(rng) for _ in range(args.profiles)]
+    for kind in ("workout", "meal"):
+        measure(f"{kind} build", build_only, kind, profiles)
+        measure(f"{kind} build+render", build_and_render, kind, profiles)
+
+if __name__ == "__main__":
+    main()
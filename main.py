@@ -11,7 +11,12 @@ from aiogram.fsm.storage.memory import MemoryStorage
 # Импортируем объединенный роутер из пакета handlers
 from app.handlers import handlers_router 
 from app.config import bot # Импортируем инициализированного бота
-from app.db import init_db, engine, SQLAlchemyStorage
+from app.db import init_db, engine, SQLAlchemyStorage, CachedSQLAlchemyStorage, FSM_STORAGE, run_fsm_sweeper
+from app.llm_cache import run_llm_cache_purger
+from app.llm_service import llm_service
+from app.middlewares import setup_unit_of_work, UNIT_OF_WORK
+from app.redis_storage import RedisHashStorage, REDIS_URL, FSM_TTL
+from app.webhook import BOT_MODE, WEBHOOK_REPLICAS, run_webhook
 
 # Настройка логирования
 logging.basicConfig(
@@ -21,20 +26,49 @@ logging.basicConfig(
 
 # Инициализация бота и диспетчера
 # Заменяем MemoryStorage на SQLAlchemyStorage для персистентности
-storage = SQLAlchemyStorage(engine)
+if FSM_STORAGE == "cached" and BOT_MODE == "webhook" and WEBHOOK_REPLICAS > 1:
+    # Кэш состояний живет в памяти одного процесса: реплики видели бы устаревшие
+    # состояния друг друга и перезаписывали их при сбросе в БД
+    sys.exit("FSM_STORAGE=cached работает только в одном процессе: "
+             "при WEBHOOK_REPLICAS > 1 используйте FSM_STORAGE=sql или redis")
+if FSM_STORAGE == "cached":
+    storage = CachedSQLAlchemyStorage(engine)
+elif FSM_STORAGE == "redis":
+    # FSM-трафик полностью уходит с основной БД
+    storage = RedisHashStorage.from_url(REDIS_URL, ttl=FSM_TTL)
+else:
+    storage = SQLAlchemyStorage(engine)
 dp = Dispatcher(storage=storage)
 
+# Одна сессия и один коммит на апдейт
+if UNIT_OF_WORK:
+    setup_unit_of_work(dp)
+
 # Регистрация основного роутера
 dp.include_router(handlers_router)
 
 async def main():
     # Инициализация базы данных
     await init_db()
+
+    # Очистка брошенных состояний FSM (в Redis за это отвечает TTL)
+    sweeper_task = None
+    if FSM_STORAGE != "redis":
+        sweeper_task = asyncio.create_task(run_fsm_sweeper())
+    # Удаление просроченных записей кэша ответов LLM
+    purger_task = asyncio.create_task(run_llm_cache_purger())
     
-    # Запуск бота
+    # Запуск бота: long polling или webhook-сервер (BOT_MODE)
     try:
-        await dp.start_polling(bot)
+        if BOT_MODE == "webhook":
+            await run_webhook(dp, bot)
+        else:
+            await dp.start_polling(bot)
     finally:
+        if sweeper_task:
+            sweeper_task.cancel()
+        purger_task.cancel()
+        await llm_service.aclose()
         await bot.session.close()
 
 if __name__ == '__main__':
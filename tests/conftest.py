@@ -0,0 +1,46 @@
+"""
+Общие настройки тестов.
+
+Модули приложения читают переменные окружения при импорте, поэтому они
+задаются здесь, до первого импорта app. База - всегда временная SQLite:
+тесты очищают таблицы и не должны попасть в настоящую БД из .env.
+"""
+import asyncio
+import os
+import tempfile
+
+import pytest
+
+os.environ.setdefault("BOT_TOKEN", "123456:test")
+os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{tempfile.mkdtemp(prefix='fitbot-tests-')}/test.db"
+
+@pytest.fixture
+def run():
+    """Выполняет корутину в новом цикле событий и закрывает пул соединений этого цикла."""
+    from app.db import engine
+
+    def runner(coro):
+        async def wrapper():
+            try:
+                return await coro
+            finally:
+                await engine.dispose()
+        return asyncio.run(wrapper())
+    return runner
+
+@pytest.fixture
+def db(run):
+    """Пустая схема БД перед тестом."""
+    from sqlalchemy import delete
+
+    from app.db import async_session_factory, init_db
+    from app.models import Base
+
+    async def reset():
+        await init_db()
+        async with async_session_factory() as session:
+            for table in reversed(Base.metadata.sorted_tables):
+                await session.execute(delete(table))
+            await session.commit()
+
+    run(reset())
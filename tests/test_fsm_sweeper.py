@@ -0,0 +1,33 @@
+"""Очистка брошенных состояний FSM."""
+from datetime import datetime, timedelta
+
+from sqlalchemy import select
+
+from app.db import FSMState, FSMStateArchive, async_session_factory, sweep_expired_fsm_states
+
+def test_archive_moves_only_expired_rows(db, run):
+    old = datetime.utcnow() - timedelta(days=60)
+
+    async def scenario():
+        async with async_session_factory() as session:
+            session.add_all([
+                FSMState(chat_id=str(n), user_id=str(n), state="Onboarding:age", data={"n": n}, updated_at=old)
+                for n in range(3)
+            ])
+            session.add(FSMState(chat_id="fresh", user_id="fresh", state="Onboarding:age", data={}))
+            # Старая запись архива того же ключа заменяется новой
+            session.add(FSMStateArchive(chat_id="0", user_id="0", state="stale", data={}))
+            await session.commit()
+        swept = await sweep_expired_fsm_states(max_age=timedelta(days=30), batch_size=2, mode="archive")
+        async with async_session_factory() as session:
+            left = (await session.execute(select(FSMState.chat_id))).scalars().all()
+            archived = (await session.execute(select(FSMStateArchive).order_by(FSMStateArchive.chat_id))).scalars().all()
+        return swept, left, archived
+
+    swept, left, archived = run(scenario())
+    assert swept == 3
+    assert left == ["fresh"]
+    assert [(row.chat_id, row.state, row.data) for row in archived] == [
+        ("0", "Onboarding:age", {"n": 0}), ("1", "Onboarding:age", {"n": 1}), ("2", "Onboarding:age", {"n": 2}),
+    ]
+    assert all(row.updated_at == old for row in archived)
@@ -0,0 +1,57 @@
+"""Очередь заданий и версии планов в БД."""
+import asyncio
+
+from app.db import async_session_factory, upsert_user
+from app.jobs import claim_plan_job, enqueue_plan_job
+from app.plan_store import save_plan
+
+async def add_user(telegram_id: int = 42) -> None:
+    async with async_session_factory() as session:
+        await upsert_user(session, telegram_id, {"goal": "mass"})
+        await session.commit()
+
+def test_enqueue_deduplicates_active_jobs(db, run):
+    async def scenario():
+        await add_user()
+        first = await enqueue_plan_job(42, "workout", chat_id=42)
+        second = await enqueue_plan_job(42, "workout", chat_id=42)
+        other = await enqueue_plan_job(42, "meal", chat_id=42)
+        return first, second, other
+
+    (first, created), (second, duplicate), (other, other_created) = run(scenario())
+    assert created and not duplicate
+    assert second.id == first.id
+    assert other_created and other.id != first.id
+
+def test_expired_lease_is_reclaimed_then_failed(db, run):
+    async def scenario():
+        await add_user()
+        await enqueue_plan_job(42, "workout", chat_id=42)
+        first = await claim_plan_job(lease=0, max_attempts=2)
+        await asyncio.sleep(0.01)
+        second = await claim_plan_job(lease=0, max_attempts=2)
+        await asyncio.sleep(0.01)
+        third = await claim_plan_job(lease=0, max_attempts=2)
+        return first, second, third
+
+    first, second, third = run(scenario())
+    assert first.attempts == 1
+    assert second.id == first.id and second.attempts == 2
+    assert second.locked_by != first.locked_by
+    assert third is None
+
+def test_active_lease_is_not_reclaimed(db, run):
+    async def scenario():
+        await add_user()
+        await enqueue_plan_job(42, "workout", chat_id=42)
+        return await claim_plan_job(lease=60), await claim_plan_job(lease=60)
+
+    first, second = run(scenario())
+    assert first is not None and second is None
+
+def test_concurrent_saves_get_distinct_versions(db, run):
+    async def scenario():
+        await add_user()
+        return await asyncio.gather(*(save_plan(42, "workout", f"plan {n}") for n in range(5)))
+
+    assert sorted(run(scenario())) == [1, 2, 3, 4, 5]
@@ -0,0 +1,86 @@
+"""Маршрутизатор LLM: хедж, переключение провайдеров и повторы."""
+import asyncio
+import time
+
+from app import metrics
+from app.llm_router import LLMProvider, LLMRouter
+from app.llm_service import LLMAPIError, is_retryable
+from app.rate_limit import retry_delay, with_retry
+
+class FakeProvider(LLMProvider):
+    def __init__(self, name, reply="ok", delay=0.0, error=None):
+        self.name = name
+        self.model = f"{name}-model"
+        self.reply = reply
+        self.delay = delay
+        self.error = error
+        self.calls = 0
+
+    async def generate(self, prompt: str) -> str:
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+        return self.reply
+
+    async def stream(self, prompt: str):
+        yield await self.generate(prompt)
+
+def router(*providers) -> LLMRouter:
+    return LLMRouter(list(providers), hedge=True, hedge_default_delay=0.05)
+
+def test_slow_primary_is_hedged(db, run):
+    slow, fast = FakeProvider("slow", "slow", delay=5), FakeProvider("fast", "fast")
+    info = {}
+    wins = metrics.get("llm_router.hedge_wins")
+
+    started = time.monotonic()
+    assert run(router(slow, fast).generate("hedge", info)) == "fast"
+    assert time.monotonic() - started < 2
+    assert info == {"provider": "fast", "model": "fast-model"}
+    assert metrics.get("llm_router.hedge_wins") == wins + 1
+
+def test_server_error_fails_over(db, run):
+    broken, backup = FakeProvider("broken", error=LLMAPIError(503, "unavailable")), FakeProvider("backup", "backup")
+    llm = router(broken, backup)
+
+    assert run(llm.generate("failover")) == "backup"
+    assert broken.calls == 1
+    assert llm.breakers["broken"].failures == 1
+
+def test_bad_request_is_not_retried(db, run):
+    broken, backup = FakeProvider("broken", error=LLMAPIError(400, "bad request")), FakeProvider("backup")
+    llm = router(broken, backup)
+
+    try:
+        run(llm.generate("bad request"))
+    except LLMAPIError as e:
+        assert e.status_code == 400
+    else:
+        raise AssertionError("400 must not fail over")
+    assert (broken.calls, backup.calls) == (1, 0)
+    assert llm.breakers["broken"].failures == 0
+
+def test_errors_without_status_are_not_retryable():
+    assert is_retryable(LLMAPIError(429, "quota"))
+    assert is_retryable(ConnectionError("reset"))
+    assert not is_retryable(KeyError("choices"))
+    assert not is_retryable(TypeError("bad argument"))
+
+def test_retry_delay_honors_retry_after():
+    assert retry_delay(1, LLMAPIError(429, "quota", retry_after=7.5)) == 7.5
+    for attempt in range(1, 6):
+        assert 0 <= retry_delay(attempt, LLMAPIError(503), base=1, cap=4) <= min(4, 2 ** (attempt - 1))
+
+def test_with_retry_waits_retry_after():
+    calls = []
+
+    async def flaky():
+        calls.append(time.monotonic())
+        if len(calls) == 1:
+            raise LLMAPIError(429, "quota", retry_after=0.2)
+        return "ok"
+
+    assert asyncio.run(with_retry(flaky, is_retryable, deadline=5)) == "ok"
+    assert len(calls) == 2
+    assert calls[1] - calls[0] >= 0.2
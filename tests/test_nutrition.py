@@ -0,0 +1,23 @@
+"""Нормы калорий и БЖУ по формуле Миффлина - Сан Жеора."""
+from app.nutrition import NutritionTargets, nutrition_targets, nutrition_targets_batch
+
+def test_male_mass_targets():
+    # BMR = 10*80 + 6.25*180 - 5*30 + 5 = 1780; TDEE = 1780*1.55 = 2759; калории = 2759*1.15 = 3172.85
+    # Белок 1.8*80 = 144; жиры max(1.0*80, 3172.85*0.2/9) = 80; углеводы (3172.85 - 576 - 720) / 4 = 469.2
+    targets = nutrition_targets({"gender": "male", "age": 30, "weight": 80, "height": 180,
+                                 "activity_level": "medium", "goal": "mass"})
+    assert targets == NutritionTargets(bmr=1780, tdee=2759, calories=3170, protein=144, fat=80, carbs=469)
+
+def test_female_weight_loss_targets():
+    # BMR = 600 + 1031.25 - 125 - 161 = 1345.25; TDEE = *1.375 = 1849.72; калории = *0.8 = 1479.78
+    # Белок 2.0*60 = 120; жиры max(0.8*60, 1479.78*0.2/9) = 48; углеводы (1479.78 - 480 - 432) / 4 = 141.9
+    targets = nutrition_targets({"gender": "female", "age": 25, "weight": 60, "height": 165,
+                                 "activity_level": "low", "goal": "weight_loss"})
+    assert targets == NutritionTargets(bmr=1345, tdee=1850, calories=1480, protein=120, fat=48, carbs=142)
+
+def test_weight_loss_floor_and_missing_weight():
+    # BMR = 450 + 937.5 - 300 - 161 = 926.5; 926.5*1.375*0.8 = 1019 - ниже минимума 1200
+    small = {"gender": "female", "age": 60, "weight": 45, "height": 150, "goal": "weight_loss"}
+    targets, missing = nutrition_targets_batch([small, {"goal": "mass"}])
+    assert targets.calories == 1200
+    assert missing is None
@@ -0,0 +1,34 @@
+"""Планы по шаблонам и их доставка пользователю."""
+import app.plan_generation as plan_generation
+from app.db import async_session_factory, upsert_user
+from app.plan_engine import NEUTRAL_DISHES, build_meal_plan
+from app.streaming import ProgressiveEditor
+
+def test_meal_plan_keeps_slots_when_everything_is_excluded():
+    breakfast = "овсяные, омлет, творог, гречка, сырники"
+    plan = build_meal_plan({"meals_per_day": 3, "excluded_foods": breakfast})
+
+    assert len(plan.days) == 7
+    for day in plan.days:
+        assert [meal.name for meal in day.meals] == ["Завтрак", "Обед", "Ужин"]
+        assert day.meals[0].dishes == [NEUTRAL_DISHES["breakfast"].name]
+
+def test_instant_plan_failure_falls_back_to_llm(db, run, monkeypatch):
+    async def broken(*args, **kwargs):
+        raise ValueError("template failed")
+
+    async def stream_plan(message, kind, profile, loading_text=""):
+        return "День 1: все тело", {"provider": "fake", "model": "fake"}, ProgressiveEditor(message)
+
+    monkeypatch.setattr(plan_generation, "deliver_instant_plan", broken)
+    monkeypatch.setattr(plan_generation, "stream_plan", stream_plan)
+
+    async def scenario():
+        async with async_session_factory() as session:
+            await upsert_user(session, 42, {"goal": "mass"})
+            await session.commit()
+        return await plan_generation.generate_and_deliver(None, 42, "workout", {"goal": "mass"}, instant="first")
+
+    result = run(scenario())
+    assert result["instant"] is False
+    assert result["saved"] is True
@@ -0,0 +1,25 @@
+"""Разбор ответа модели и раздельное хранение дней плана."""
+from app.plan_schema import MealPlan, WorkoutPlan, parse_plan, split_plan
+
+MEAL_JSON = (
+    '{"calories": 2200, "protein": 140, "fat": 70, "carbs": 250, "notes": "Пейте воду", '
+    '"days": [{"title": "День 1", "meals": [{"name": "Завтрак", "dishes": ["Овсянка"], "calories": 500}]}, '
+    '{"title": "День 2", "meals": [{"name": "Обед", "dishes": ["Рис", "Курица"]}]}], '
+    '"shopping_list": ["овсянка", "рис"]}'
+)
+
+def test_parse_and_split_round_trip():
+    plan = parse_plan("meal", f"Вот ваш план:\n```json\n{MEAL_JSON}\n```")
+    overview, days = split_plan(plan)
+
+    assert "days" not in overview
+    assert [day["title"] for day in days] == ["День 1", "День 2"]
+    assert MealPlan(**overview, days=days) == plan
+
+def test_invalid_plan_is_rejected():
+    assert parse_plan("workout", '{"days": []}') is None
+    assert parse_plan("workout", "не JSON") is None
+    day = parse_plan("workout", '{"title": "День 1", "exercises": [{"name": "Присед"}]}', day=True)
+    assert day.exercises[0].name == "Присед"
+    assert isinstance(parse_plan("workout", '{"days": [{"title": "День 1", "exercises": [{"name": "Присед"}]}]}'),
+                      WorkoutPlan)
@@ -0,0 +1,35 @@
+"""Кэш профилей: с Redis изменение в одном процессе видно остальным."""
+import asyncio
+
+import pytest
+
+fakeredis = pytest.importorskip("fakeredis")
+
+from app.models import User
+from app.profile_cache import ProfileCache
+
+def test_invalidate_is_seen_by_other_processes():
+    async def scenario():
+        server = fakeredis.FakeServer()
+        bot_cache = ProfileCache(redis=fakeredis.FakeAsyncRedis(server=server))
+        worker_cache = ProfileCache(redis=fakeredis.FakeAsyncRedis(server=server))
+        await bot_cache.set(User(telegram_id=1, goal="mass"))
+        before = await worker_cache.get(1)
+        await bot_cache.invalidate(1)
+        return before, await worker_cache.get(1)
+
+    before, after = asyncio.run(scenario())
+    assert before.goal == "mass"
+    assert after is None
+
+def test_local_tier_without_redis():
+    async def scenario():
+        cache = ProfileCache()
+        await cache.set(User(telegram_id=1, goal="mass"))
+        cached = await cache.get(1)
+        await cache.invalidate(1)
+        return cached, await cache.get(1)
+
+    cached, after = asyncio.run(scenario())
+    assert cached.goal == "mass"
+    assert after is None
@@ -0,0 +1,62 @@
+"""RedisHashStorage на fakeredis: слияние данных без искажения значений."""
+import asyncio
+
+import pytest
+
+fakeredis = pytest.importorskip("fakeredis")
+
+from aiogram.fsm.storage.base import StorageKey
+
+from app.redis_storage import RedisHashStorage
+
+KEY = StorageKey(bot_id=1, chat_id=10, user_id=20)
+
+def run(coro):
+    return asyncio.run(coro)
+
+def make_storage() -> RedisHashStorage:
+    return RedisHashStorage(fakeredis.FakeAsyncRedis(), ttl=60)
+
+def test_update_data_keeps_empty_and_nested_values():
+    async def scenario():
+        storage = make_storage()
+        await storage.set_data(KEY, {"empty_dict": {}, "empty_list": [], "big": 2 ** 63 - 1})
+        result = await storage.update_data(KEY, {"nested": {"a": [], "b": {"c": {}}}, "ids": [1, 2]})
+        return result, await storage.get_data(KEY)
+
+    result, stored = run(scenario())
+    expected = {
+        "empty_dict": {}, "empty_list": [], "big": 2 ** 63 - 1,
+        "nested": {"a": [], "b": {"c": {}}}, "ids": [1, 2],
+    }
+    assert result == expected
+    assert stored == expected
+
+def test_update_data_on_missing_key_and_ttl():
+    async def scenario():
+        storage = make_storage()
+        result = await storage.update_data(KEY, {"goal": "mass"})
+        ttl = await storage.redis.ttl(storage._key(KEY))
+        return result, ttl
+
+    result, ttl = run(scenario())
+    assert result == {"goal": "mass"}
+    assert 0 < ttl <= 60
+
+def test_concurrent_updates_do_not_lose_keys():
+    async def scenario():
+        storage = make_storage()
+        await asyncio.gather(*(storage.update_data(KEY, {f"k{i}": i}) for i in range(20)))
+        return await storage.get_data(KEY)
+
+    assert run(scenario()) == {f"k{i}": i for i in range(20)}
+
+def test_state_and_data_are_independent():
+    async def scenario():
+        storage = make_storage()
+        await storage.set_state(KEY, "Onboarding:Goal")
+        await storage.update_data(KEY, {"goal": "mass"})
+        await storage.set_state(KEY, None)
+        return await storage.get_state(KEY), await storage.get_data(KEY)
+
+    assert run(scenario()) == (None, {"goal": "mass"})
@@ -0,0 +1,43 @@
+"""Объединение одинаковых одновременных вызовов."""
+import asyncio
+
+from app import metrics
+from app.singleflight import SingleFlight
+
+def test_concurrent_calls_share_one_execution():
+    flight = SingleFlight("test_flight")
+    calls = []
+
+    async def load():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return "value"
+
+    async def scenario():
+        results = await asyncio.gather(*(flight.do("key", load) for _ in range(5)))
+        return results, flight.in_flight("key")
+
+    coalesced = metrics.get("test_flight.coalesced")
+    results, in_flight = asyncio.run(scenario())
+    assert results == ["value"] * 5
+    assert len(calls) == 1
+    assert not in_flight
+    assert metrics.get("test_flight.coalesced") == coalesced + 4
+
+def test_errors_reach_every_caller_and_are_not_cached():
+    flight = SingleFlight("test_flight_errors")
+    calls = []
+
+    async def broken():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        raise RuntimeError("boom")
+
+    async def scenario():
+        first = await asyncio.gather(flight.do("key", broken), flight.do("key", broken), return_exceptions=True)
+        second = await asyncio.gather(flight.do("key", broken), return_exceptions=True)
+        return first + second
+
+    results = asyncio.run(scenario())
+    assert all(isinstance(result, RuntimeError) for result in results)
+    assert len(calls) == 2
@@ -0,0 +1,36 @@
+"""Webhook: проверка секрета и мягкая остановка."""
+import asyncio
+
+from aiogram import Dispatcher
+from aiohttp.test_utils import TestClient, TestServer
+
+from app.config import bot
+from app.webhook import create_app, start_draining
+
+UPDATE = {"update_id": 1, "message": {"message_id": 1, "date": 0, "chat": {"id": 1, "type": "private"},
+                                      "from": {"id": 1, "is_bot": False, "first_name": "T"}, "text": "hi"}}
+SECRET = "test-secret"
+
+async def post_update(client: TestClient, secret: str = SECRET):
+    return await client.post("/webhook", json=UPDATE, headers={"X-Telegram-Bot-Api-Secret-Token": secret})
+
+def webhook_scenario(check):
+    async def scenario():
+        app = create_app(Dispatcher(), bot, secret=SECRET, path="/webhook")
+        app["state"]["ready"] = True
+        async with TestClient(TestServer(app)) as client:
+            return await check(app, client)
+    return asyncio.run(scenario())
+
+def test_secret_token_is_checked():
+    async def check(app, client):
+        return (await post_update(client, "wrong")).status, (await post_update(client)).status
+
+    assert webhook_scenario(check) == (401, 200)
+
+def test_draining_rejects_updates_and_fails_readiness():
+    async def check(app, client):
+        start_draining(app)
+        return (await post_update(client)).status, (await client.get("/readyz")).status
+
+    assert webhook_scenario(check) == (503, 503)
@@ -0,0 +1,55 @@
+"""Воркер очереди планов: ошибки одного задания не останавливают воркер."""
+import asyncio
+
+import app.worker as worker
+from app.db import async_session_factory, upsert_user
+from app.jobs import claim_plan_job, enqueue_plan_job
+from app.models import PlanJob
+
+async def queued_job(message_id=None) -> PlanJob:
+    async with async_session_factory() as session:
+        await upsert_user(session, 42, {"goal": "mass"})
+        await session.commit()
+    await enqueue_plan_job(42, "workout", chat_id=42, message_id=message_id, loading_text="⏳")
+    return await claim_plan_job()
+
+def test_failed_loading_message_fails_the_job(db, run, monkeypatch):
+    async def blocked(*args, **kwargs):
+        raise RuntimeError("Forbidden: bot was blocked by the user")
+    monkeypatch.setattr(worker.bot, "send_message", blocked)
+
+    async def scenario():
+        job = await queued_job()
+        await worker.process_job(job)
+        async with async_session_factory() as session:
+            return await session.get(PlanJob, job.id)
+
+    job = run(scenario())
+    assert job.status == "pending"
+    assert job.attempts == 1
+    assert "blocked" in job.error
+
+def test_worker_loop_survives_job_errors(monkeypatch):
+    claims = []
+
+    async def claim():
+        await asyncio.sleep(0)
+        claims.append(1)
+        return PlanJob(id=len(claims), attempts=1)
+
+    async def broken(job):
+        raise RuntimeError("database is locked")
+
+    monkeypatch.setattr(worker, "claim_plan_job", claim)
+    monkeypatch.setattr(worker, "process_job", broken)
+
+    async def scenario():
+        loop = asyncio.create_task(worker.worker_loop(0, poll_interval=0))
+        while len(claims) < 3 and not loop.done():
+            await asyncio.sleep(0)
+        alive = not loop.done()
+        loop.cancel()
+        return alive
+
+    assert asyncio.run(scenario())
+    assert len(claims) >= 3